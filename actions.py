@@ -0,0 +1,239 @@
+"""Writes on messages and follows, shared by the HTML views and the
+JSON API.
+
+Posting, deleting and liking a message, and following a user, each touch
+several stores besides the row itself (counters, the search index,
+materialized timelines, the follow graph, the card cache, metrics);
+doing it all here keeps the two front ends in step. Each function
+commits, except that likes and follows are only queued when write-behind
+is on (see write_behind.py).
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import delete, insert, select, text
+from werkzeug.exceptions import Forbidden, NotFound
+
+import cache
+import counters
+import follow_graph
+import fragments
+import metrics
+import search
+import timeline
+import write_behind
+from models import (db, insert_ignoring_duplicates, Follows, Likes, Message,
+                    User)
+
+LikeResult = namedtuple('LikeResult', ['liked', 'likes_count'])
+
+
+def post_message(user, text):
+    """Post a new message by `user` and return it."""
+
+    msg = Message(text=text, user_id=user.id)
+    db.session.add(msg)
+    counters.bump_user(user.id, messages_count=1)
+
+    db.session.flush()
+    search.index_message(msg)
+
+    if timeline.is_enabled():
+        timeline.fan_out_message(msg)
+
+    db.session.commit()
+    metrics.messages_total.inc()
+
+    return msg
+
+
+def delete_message(msg):
+    """Delete `msg` and take it out of every derived store."""
+
+    message_id = msg.id
+
+    if timeline.is_enabled():
+        timeline.remove_message(message_id)
+
+    counters.forget_message(msg)
+    search.unindex_message(msg)
+    db.session.delete(msg)
+    db.session.commit()
+
+    fragments.invalidate_message(message_id)
+
+
+# Postgres: the whole toggle as one statement. Every CTE sees the same
+# snapshot, so `existing` decides the direction once; two toggles racing
+# (a double-click) both pick the same one, and the loser's DELETE or
+# ON CONFLICT DO NOTHING changes nothing, so the pair counts as one
+# toggle and the counters move by the rows really added or removed.
+TOGGLE_LIKE_SQL = text("""
+WITH author AS (
+    SELECT messages.user_id FROM messages
+    JOIN users ON users.id = messages.user_id
+    WHERE messages.id = :message_id AND users.deleted_at IS NULL
+),
+target AS (
+    SELECT id FROM messages
+    WHERE id = :message_id AND user_id <> :user_id
+    AND user_id IN (SELECT user_id FROM author)
+),
+existing AS (
+    SELECT 1 FROM likes
+    WHERE user_id = :user_id AND message_id IN (SELECT id FROM target)
+),
+removed AS (
+    DELETE FROM likes
+    WHERE user_id = :user_id AND message_id IN (SELECT id FROM target)
+    AND EXISTS (SELECT 1 FROM existing)
+    RETURNING 1
+),
+added AS (
+    INSERT INTO likes (user_id, message_id)
+    SELECT :user_id, id FROM target
+    WHERE NOT EXISTS (SELECT 1 FROM existing)
+    ON CONFLICT DO NOTHING
+    RETURNING 1
+),
+delta AS (
+    SELECT (SELECT count(*) FROM added) - (SELECT count(*) FROM removed) AS n
+),
+liked_message AS (
+    UPDATE messages SET likes_count = likes_count + (SELECT n FROM delta)
+    WHERE id IN (SELECT id FROM target)
+    RETURNING likes_count
+),
+liker AS (
+    UPDATE users SET likes_count = likes_count + (SELECT n FROM delta),
+                     version = version + 1
+    WHERE id = :user_id AND EXISTS (SELECT 1 FROM target)
+    RETURNING id
+)
+SELECT (SELECT user_id FROM author) AS author_id,
+       NOT EXISTS (SELECT 1 FROM existing) AS liked,
+       (SELECT likes_count FROM liked_message) AS likes_count
+""")
+
+
+def _toggle_like_statement(user_id, message_id):
+    row = db.session.execute(
+        TOGGLE_LIKE_SQL,
+        {'user_id': user_id, 'message_id': message_id}).one()
+
+    return row.author_id, row.liked, row.likes_count
+
+
+def _toggle_like_steps(user_id, message_id):
+    """The same toggle as a few statements in one transaction, for
+    databases that serialize writes anyway (SQLite).
+    """
+
+    author_id = db.session.execute(
+        select(Message.user_id)
+        .join(User, User.id == Message.user_id)
+        .where(Message.id == message_id, User.deleted_at.is_(None))).scalar()
+
+    if author_id is None or author_id == user_id:
+        return author_id, None, None
+
+    removed = db.session.execute(
+        delete(Likes).where(Likes.message_id == message_id,
+                            Likes.user_id == user_id)).rowcount
+
+    if not removed:
+        db.session.execute(
+            insert(Likes).values(message_id=message_id, user_id=user_id))
+
+    counters.record_like(user_id, message_id, -1 if removed else 1)
+
+    likes_count = db.session.execute(
+        select(Message.likes_count).where(Message.id == message_id)).scalar()
+
+    return author_id, not removed, likes_count
+
+
+def toggle_like(user, message_id):
+    """Like `message_id` as `user`, or unlike it if they already do.
+
+    Raises NotFound for a missing message (or one whose author has
+    deleted their account) and Forbidden for the user's own message.
+    """
+
+    queued = write_behind.is_enabled()
+
+    if queued:
+        author_id, liked, likes_count = write_behind.toggle_like(
+            user.id, message_id)
+    elif db.engine.dialect.name == 'postgresql':
+        author_id, liked, likes_count = _toggle_like_statement(
+            user.id, message_id)
+    else:
+        author_id, liked, likes_count = _toggle_like_steps(
+            user.id, message_id)
+
+    if author_id is None:
+        db.session.rollback()
+        raise NotFound("No such message")
+
+    if author_id == user.id:
+        db.session.rollback()
+        raise Forbidden("You cannot like your own messages.")
+
+    if not queued:
+        db.session.commit()
+        cache.invalidate_user(user.id)
+
+    metrics.likes_total.inc(action='like' if liked else 'unlike')
+
+    return LikeResult(liked, likes_count)
+
+
+def follow(user, followed_user):
+    """Make `user` follow `followed_user`."""
+
+    if write_behind.is_enabled():
+        write_behind.set_follow(user.id, followed_user.id, True)
+
+    else:
+        # The follow buttons come from a per-worker follow graph that can
+        # be a little stale, so the follow may already be there.
+        added = db.session.execute(
+            insert_ignoring_duplicates(Follows).values(
+                user_following_id=user.id,
+                user_being_followed_id=followed_user.id)).rowcount
+
+        if added:
+            counters.record_follow(user.id, followed_user.id)
+
+            if timeline.is_enabled():
+                timeline.backfill_follow(user.id, followed_user.id)
+
+        db.session.commit()
+        follow_graph.graph.add(user.id, followed_user.id)
+
+    metrics.follows_total.inc(action='follow')
+
+
+def unfollow(user, followed_user):
+    """Make `user` stop following `followed_user`."""
+
+    if write_behind.is_enabled():
+        write_behind.set_follow(user.id, followed_user.id, False)
+
+    else:
+        removed = db.session.execute(
+            delete(Follows).where(
+                Follows.user_following_id == user.id,
+                Follows.user_being_followed_id == followed_user.id)).rowcount
+
+        if removed:
+            counters.record_follow(user.id, followed_user.id, -1)
+
+            if timeline.is_enabled():
+                timeline.prune_follow(user.id, followed_user.id)
+
+        db.session.commit()
+        follow_graph.graph.remove(user.id, followed_user.id)
+
+    metrics.follows_total.inc(action='unfollow')
@@ -0,0 +1,357 @@
+"""Versioned JSON API, under /api/v1.
+
+Lets clients update a page in place (post, delete, like) instead of
+reloading it. It uses the same session login as the HTML pages. Writes
+must be sent as JSON: browsers will not send a cross-site JSON request
+without asking first, so unlike the HTML forms they need no CSRF token.
+
+Lists use the same `?before=` cursors as the pages (see pagination.py)
+and return the next one as `next_cursor`. `?fields=id,text,user.username`
+picks what each item contains. Rows are selected column by column and
+written straight out, without loading ORM objects; only the columns
+asked for are read, and `users` is only joined for `user.*` fields.
+"""
+
+from datetime import datetime
+import json
+
+from flask import Blueprint, Response, g, request, url_for
+from sqlalchemy import select
+from werkzeug.exceptions import (BadRequest, Forbidden, HTTPException,
+                                 NotFound, Unauthorized, UnsupportedMediaType)
+
+import actions
+import follow_graph
+import pagination
+import timeline
+import write_behind
+from models import Follows, Message, User, db
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+MAX_PER_PAGE = 100
+
+MAX_MESSAGE_LENGTH = Message.text.type.length
+
+MESSAGE_COLUMNS = {
+    'id': Message.id,
+    'text': Message.text,
+    'timestamp': Message.timestamp,
+    'likes_count': Message.likes_count,
+    'user.id': Message.user_id,
+    'user.username': User.username,
+    'user.image_url': User.image_url,
+}
+
+# Fields that depend on who is asking, filled in after the select.
+MESSAGE_VIEWER_FIELDS = ['liked']
+
+USER_COLUMNS = {
+    name: getattr(User, name)
+    for name in ['id', 'username', 'bio', 'location', 'image_url',
+                 'header_image_url', 'messages_count', 'following_count',
+                 'followers_count', 'likes_count']
+}
+
+USER_VIEWER_FIELDS = ['following']
+
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+##############################################################################
+# Serialization
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    raise TypeError(f"Can't serialize {type(value).__name__}")
+
+
+def dumps(data):
+    """Compact JSON bytes (orjson when installed)."""
+
+    if orjson is not None:
+        return orjson.dumps(data, default=_default)
+
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False,
+                      default=_default).encode('UTF-8')
+
+
+def json_response(data, status=200, headers=None):
+    return Response(dumps(data), status, headers,
+                    mimetype='application/json')
+
+
+def _nest(names, values):
+    """{'user.id': 1} style pairs as {'user': {'id': 1}}."""
+
+    item = {}
+
+    for name, value in zip(names, values):
+        target = item
+        *parents, leaf = name.split('.')
+
+        for parent in parents:
+            target = target.setdefault(parent, {})
+
+        target[leaf] = value
+
+    return item
+
+
+def requested_fields(columns, viewer_fields):
+    """The `?fields=` asked for, in order; every field if none are."""
+
+    fields = request.args.get('fields')
+
+    if not fields:
+        return list(columns) + viewer_fields
+
+    fields = list(dict.fromkeys(
+        field.strip() for field in fields.split(',') if field.strip()))
+    unknown = [field for field in fields
+               if field not in columns and field not in viewer_fields]
+
+    if unknown:
+        raise BadRequest(f"Unknown fields: {', '.join(unknown)}")
+
+    return fields
+
+
+def per_page():
+    limit = request.args.get('limit', pagination.MESSAGES_PER_PAGE, type=int)
+    return min(max(limit, 1), MAX_PER_PAGE)
+
+
+##############################################################################
+# Messages
+
+
+def select_messages(fields, *criteria):
+    """SELECT of the timestamp and id (for cursors) and then `fields`."""
+
+    columns = [MESSAGE_COLUMNS[field].label(f'f{i}')
+               for i, field in enumerate(fields) if field in MESSAGE_COLUMNS]
+
+    query = select(Message.timestamp.label('cursor_timestamp'),
+                   Message.id.label('cursor_id'),
+                   *columns).where(*criteria)
+
+    if any(field.startswith('user.') and field != 'user.id'
+           for field in fields):
+        query = query.join(User, User.id == Message.user_id)
+
+    return query
+
+
+def serialize_messages(fields, rows):
+    """Turn selected rows into dicts, adding the viewer's fields."""
+
+    names = [field for field in fields if field in MESSAGE_COLUMNS]
+    liked_ids = set()
+
+    if 'liked' in fields and g.user:
+        liked_ids = write_behind.liked_message_ids(
+            g.user, [row[1] for row in rows])
+
+    items = []
+
+    for row in rows:
+        item = _nest(names, row[2:])
+
+        if 'liked' in fields:
+            item['liked'] = row[1] in liked_ids
+
+        items.append(item)
+
+    return items
+
+
+def message_page(fields, rows, limit):
+    """The response for one page of (limit + 1) selected rows."""
+
+    next_cursor = None
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = pagination.encode_cursor(rows[-1][0], rows[-1][1])
+
+    return json_response({'messages': serialize_messages(fields, rows),
+                          'next_cursor': next_cursor})
+
+
+def keyset_rows(fields, cursor, limit, *criteria):
+    query = pagination.before(select_messages(fields, *criteria),
+                              Message.timestamp, Message.id, cursor)
+
+    return db.session.execute(query.limit(limit + 1)).all()
+
+
+def materialized_rows(fields, user_id, cursor, limit):
+    """Rows for the materialized timeline, in its merged order."""
+
+    message_ids = timeline.home_timeline_ids(
+        user_id, limit + 1, cursor, *write_behind.queued_follows(user_id))
+
+    rows = db.session.execute(
+        select_messages(fields, Message.id.in_(message_ids))).all()
+    by_id = {row[1]: row for row in rows}
+
+    return [by_id[message_id] for message_id in message_ids
+            if message_id in by_id]
+
+
+def current_user():
+    if not g.user:
+        raise Unauthorized("Log in first.")
+
+    return g.user
+
+
+@bp.get('/timeline')
+def home_timeline():
+    """The logged-in user's home timeline, a page at a time."""
+
+    user = current_user()
+    fields = requested_fields(MESSAGE_COLUMNS, MESSAGE_VIEWER_FIELDS)
+    cursor = pagination.decode_cursor(request.args.get('before'))
+    limit = per_page()
+
+    if timeline.is_enabled():
+        rows = materialized_rows(fields, user.id, cursor, limit)
+
+    else:
+        followed_ids = (select(Follows.user_being_followed_id)
+                        .where(Follows.user_following_id == user.id))
+
+        rows = keyset_rows(fields, cursor, limit,
+                           write_behind.home_authors(user.id, followed_ids))
+
+    return message_page(fields, rows, limit)
+
+
+@bp.get('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages, a page at a time."""
+
+    user = db.session.get(User, user_id)
+
+    if user is None or user.deleted_at is not None:
+        raise NotFound("No such user")
+
+    fields = requested_fields(MESSAGE_COLUMNS, MESSAGE_VIEWER_FIELDS)
+    cursor = pagination.decode_cursor(request.args.get('before'))
+    limit = per_page()
+
+    return message_page(fields,
+                        keyset_rows(fields, cursor, limit,
+                                    Message.user_id == user_id),
+                        limit)
+
+
+@bp.post('/messages')
+def create_message():
+    """Post a message: {"text": "..."}."""
+
+    user = current_user()
+    body = request.get_json()
+
+    if not isinstance(body, dict):
+        raise BadRequest("expected a JSON object")
+
+    text = body.get('text')
+
+    if not isinstance(text, str) or not text.strip():
+        raise BadRequest("text is required")
+
+    if len(text) > MAX_MESSAGE_LENGTH:
+        raise BadRequest(
+            f"text is longer than {MAX_MESSAGE_LENGTH} characters")
+
+    msg = actions.post_message(user, text)
+
+    fields = requested_fields(MESSAGE_COLUMNS, MESSAGE_VIEWER_FIELDS)
+    rows = db.session.execute(
+        select_messages(fields, Message.id == msg.id)).all()
+
+    return json_response(
+        serialize_messages(fields, rows)[0], 201,
+        {'Location': url_for('messages_show', message_id=msg.id)})
+
+
+@bp.delete('/messages/<int:message_id>')
+def delete_message(message_id):
+    """Delete one of your own messages."""
+
+    user = current_user()
+    msg = db.session.get(Message, message_id)
+
+    if msg is None:
+        raise NotFound("No such message")
+
+    if msg.user_id != user.id:
+        raise Forbidden("You can only delete your own messages.")
+
+    actions.delete_message(msg)
+
+    return '', 204
+
+
+@bp.post('/messages/<int:message_id>/like')
+def toggle_like(message_id):
+    """Like a message, or unlike it if you already do."""
+
+    result = actions.toggle_like(current_user(), message_id)
+
+    return json_response(result._asdict())
+
+
+##############################################################################
+# Users
+
+
+@bp.get('/users/<int:user_id>')
+def user_profile(user_id):
+    """A user's profile and counters."""
+
+    fields = requested_fields(USER_COLUMNS, USER_VIEWER_FIELDS)
+    names = [field for field in fields if field in USER_COLUMNS]
+
+    row = db.session.execute(
+        select(User.id, *(USER_COLUMNS[name] for name in names))
+        .where(User.id == user_id, User.deleted_at.is_(None))).first()
+
+    if row is None:
+        raise NotFound("No such user")
+
+    item = _nest(names, row[1:])
+
+    if 'following' in fields:
+        item['following'] = bool(g.user) and user_id in (
+            follow_graph.get_graph().following_among(g.user.id, [user_id]))
+
+    return json_response(item)
+
+
+##############################################################################
+# Requests and errors
+
+
+@bp.before_request
+def require_json_writes():
+    """Only take writes sent as JSON (this is the API's CSRF defense)."""
+
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and not request.is_json:
+        raise UnsupportedMediaType("Send writes as application/json.")
+
+
+@bp.errorhandler(HTTPException)
+def json_error(error):
+    return json_response({'error': {'status': error.code,
+                                    'message': error.description}},
+                         error.code)
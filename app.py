@@ -1,13 +1,33 @@
 from http.client import UNAUTHORIZED
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, url_for
+from flask.ctx import _AppCtxGlobals
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 from dotenv import load_dotenv
-from werkzeug.exceptions import Unauthorized
-from sqlalchemy import or_
-
+from werkzeug.exceptions import Forbidden, Unauthorized
+from sqlalchemy.orm import joinedload
+
+import actions
+import api
+import assets
+import cache
+import counters
+import follow_graph
+import fragments
+import http_cache
+import jobs
+import metrics
+import migrations
+import pagination
+import passwords
+import replicas
+import search
+import sql_stats
+import timeline
+import write_behind
 from forms import CSRFProtectForm, EditUserForm, UserAddForm, LoginForm, MessageForm
 from models import db, connect_db, User, Message, Likes, DEFAULT_PROFILE_IMAGE, DEFAULT_HEADER_IMAGE
 
@@ -18,42 +38,121 @@ CURR_USER_KEY = "curr_user"
 database_url = os.getenv('DATABASE_URL')
 database_url = database_url.replace('postgres://', 'postgresql://')
 
+
+
+class LazyGlobals(_AppCtxGlobals):
+    """Flask `g` that builds `g.user` and `g.form` on first access.
+
+    Requests that never touch them (static files, 404s, redirects) pay
+    nothing for them.
+    """
+
+    def __getattr__(self, name):
+        loader = LAZY_GLOBALS.get(name)
+
+        if loader is None:
+            return super().__getattr__(name)
+
+        value = loader()
+        setattr(self, name, value)
+        return value
+
+
 app = Flask(__name__)
+app.app_ctx_globals_class = LazyGlobals
 
 # Get DB_URI from environ variable (useful for production/testing) or,
 # if not set there, use development local db.
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Read replicas for GET requests (see replicas.py), comma-separated.
+app.config['SQLALCHEMY_BINDS'] = replicas.binds(
+    [url for url in os.getenv('REPLICA_DATABASE_URLS', '').split(',') if url])
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 
+# bcrypt work factor, and the per-worker process pool that does the hashing
+# (0 workers hashes inline); by default the CPUs are split between the
+# web workers.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.getenv('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_POOL_WORKERS'] = int(
+    os.getenv('PASSWORD_POOL_WORKERS', passwords.default_workers()))
+
+# Read home timelines from the fan-out-on-write `timeline_entries` store
+# instead of rebuilding them from the follow graph on every request.
+app.config['TIMELINE_MATERIALIZED'] = os.getenv('TIMELINE_MATERIALIZED') == '1'
+
+# Queue like and follow writes and flush them in batches (see
+# write_behind.py) instead of committing each one.
+app.config['WRITE_BEHIND'] = os.getenv('WRITE_BEHIND') == '1'
+app.config['WRITE_BEHIND_INTERVAL'] = float(
+    os.getenv('WRITE_BEHIND_INTERVAL', write_behind.DEFAULT_INTERVAL))
+
+# Requests running more SQL statements than this are logged (see sql_stats.py).
+app.config['SQL_QUERY_BUDGET'] = int(os.getenv('SQL_QUERY_BUDGET', 50))
+
 debug = DebugToolbarExtension(app)
 
 
 connect_db(app)
+replicas.init_app(app)
+
+app.jinja_env.globals['static_url'] = http_cache.static_url
+fragments.init_app(app)
+assets.init_app(app)
+app.register_blueprint(api.bp)
+sql_stats.init_app(app)
+metrics.init_app(app, db)
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+def load_current_user():
+    """If we're logged in, the current user (from the user cache)."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        return cache.load_user(session[CURR_USER_KEY])
 
-    else:
-        g.user = None
+    return None
+
+
+LAZY_GLOBALS = {
+    'user': load_current_user,
+    'form': CSRFProtectForm,
+}
 
 
 @app.before_request
-def add_csrf_token_to_g():
-    """Add CSRF token to Flask global"""
+def reset_lazy_globals():
+    """Make `g.user` and `g.form` reload lazily for this request, even if
+    `g` outlives a single request (e.g. inside an outer app context).
+    """
+
+    for name in LAZY_GLOBALS:
+        g.pop(name, None)
 
-    g.form = CSRFProtectForm()
+
+def liked_ids_for(messages):
+    """Ids of `messages` liked by the logged-in user, for the like stars."""
+
+    if not g.user:
+        return set()
+
+    return write_behind.liked_message_ids(g.user, [msg.id for msg in messages])
+
+
+def following_ids_for(users):
+    """Ids of `users` that the logged-in user follows, for follow buttons."""
+
+    if not g.user:
+        return set()
+
+    return follow_graph.get_graph().following_among(
+        g.user.id, [user.id for user in users])
 
 
 def do_login(user):
@@ -116,6 +215,7 @@ def login():
                                  g.form.password.data)
 
         if user:
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -146,32 +246,64 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username (or
+    location), with 'page' for further pages of results. Without 'q',
+    lists everyone by username, continuing 'after' a given username.
     """
 
-    search = request.args.get('q')
+    term = request.args.get('q', '').strip()
+
+    if not term:
+        after = request.args.get('after')
+        users, has_next = search.list_users(after)
+        next_url = (url_for('list_users', after=users[-1].username)
+                    if has_next else None)
 
-    if not search:
-        users = User.query.all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = search.search_users(term, request.args.get('page', 1, type=int))
+        users = page.users
+        next_url = (url_for('list_users', q=term, page=page.page + 1)
+                    if page.has_next else None)
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html',
+                           users=users,
+                           next_url=next_url,
+                           following_ids=following_ids_for(users))
+
+
+def get_user_or_404(user_id):
+    """The user with `user_id`, or a 404 if there is none or they have
+    deleted their account.
+    """
+
+    return User.query.filter_by(id=user_id, deleted_at=None).first_or_404()
 
 
 @app.get('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
-
-    liked_messages_count = Likes.query.filter(Likes.user_id == user_id).count()
+    user = write_behind.overlay_counters(get_user_or_404(user_id))
 
     session['LAST_URL'] = f'/users/{user_id}'
 
+    # The counters are there for queued (write-behind) follows and likes,
+    # which haven't bumped `version` yet.
+    if http_cache.is_fresh('user', user.id, user.version,
+                           user.following_count, user.followers_count,
+                           user.likes_count):
+        return http_cache.not_modified()
+
+    cursor = pagination.decode_cursor(request.args.get('before'))
+    page = pagination.keyset_page(
+        Message.query.filter(Message.user_id == user_id), cursor)
+
     return render_template('users/show.html',
                            user=user,
-                           liked_messages_count=liked_messages_count)
+                           messages=page.items,
+                           next_cursor=page.next_cursor,
+                           liked_ids=liked_ids_for(page.items),
+                           following_ids=following_ids_for([user]))
 
 
 @app.get('/users/<int:user_id>/following')
@@ -182,11 +314,14 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-
-    liked_messages_count = Likes.query.filter(Likes.user_id == user_id).count()
+    user = write_behind.overlay_counters(get_user_or_404(user_id))
+    following = write_behind.overlay_following(user)
 
-    return render_template('users/following.html', user=user, liked_messages_count=liked_messages_count)
+    return render_template('users/following.html',
+                           user=user,
+                           following=following,
+                           following_ids=following_ids_for(
+                               [user, *following]))
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -197,11 +332,14 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-
-    liked_messages_count = Likes.query.filter(Likes.user_id == user_id).count()
+    user = write_behind.overlay_counters(get_user_or_404(user_id))
+    followers = write_behind.overlay_followers(user)
 
-    return render_template('users/followers.html', user=user, liked_messages_count=liked_messages_count)
+    return render_template('users/followers.html',
+                           user=user,
+                           followers=followers,
+                           following_ids=following_ids_for(
+                               [user, *followers]))
 
 
 @app.get('/users/<int:user_id>/liked_messages')
@@ -212,14 +350,24 @@ def show_users_liked_messages(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = write_behind.overlay_counters(get_user_or_404(user_id))
 
-    liked_messages_count = Likes.query.filter(Likes.user_id == user_id).count()
-    #CODE REVIEW len(user.likes)
+    cursor = pagination.decode_cursor(request.args.get('before'))
+    page = pagination.keyset_page(
+        Message.query
+        .join(Likes, Likes.message_id == Message.id)
+        .filter(Likes.user_id == user_id,
+                Message.user.has(User.deleted_at.is_(None)))
+        .options(joinedload(Message.user)),
+        cursor)
 
     session['LAST_URL'] = f'/users/{user_id}/liked_messages'
 
-    return render_template('users/likes.html', user=user, liked_messages_count=liked_messages_count)
+    return render_template('users/likes.html',
+                           user=user,
+                           messages=page.items,
+                           next_cursor=page.next_cursor,
+                           following_ids=following_ids_for([user]))
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -231,9 +379,7 @@ def add_follow(follow_id):
         return redirect("/")
 
     if g.form.validate_on_submit():
-        followed_user = User.query.get_or_404(follow_id)
-        g.user.following.append(followed_user)
-        db.session.commit()
+        actions.follow(g.user, get_user_or_404(follow_id))
 
         return redirect(f"/users/{g.user.id}/following")
 
@@ -250,9 +396,7 @@ def stop_following(follow_id):
         return redirect("/")
 
     if g.form.validate_on_submit():
-        followed_user = User.query.get(follow_id)
-        g.user.following.remove(followed_user)
-        db.session.commit()
+        actions.unfollow(g.user, get_user_or_404(follow_id))
 
         return redirect(f"/users/{g.user.id}/following")
 
@@ -277,8 +421,13 @@ def profile():
             g.user.image_url = g.form.image_url.data or DEFAULT_PROFILE_IMAGE
             g.user.header_image_url = g.form.header_image_url.data or DEFAULT_HEADER_IMAGE
             g.user.bio = g.form.bio.data
+            # In SQL: g.user may be a cached row, older than the database.
+            g.user.version = User.version + 1
 
             db.session.commit()
+            cache.invalidate_user(g.user.id)
+            fragments.invalidate_user(g.user.id)
+
             return redirect(f'/users/{g.user.id}')
         else:
             bad_form = EditUserForm(
@@ -306,11 +455,18 @@ def delete_user():
         return redirect("/")
 
     if g.form.validate_on_submit():
+        user_id = g.user.id
         do_logout()
 
-        db.session.delete(g.user)
+        # The account is hidden now; everything in it is deleted in chunks
+        # by a background worker (see jobs.py).
+        g.user.mark_deleted()
+        jobs.enqueue('delete_user', user_id=user_id)
         db.session.commit()
 
+        cache.invalidate_user(user_id)
+        fragments.invalidate_user(user_id)
+
         return redirect("/signup")
 
     else:
@@ -335,21 +491,49 @@ def messages_add():
     g.form = MessageForm()
 
     if g.form.validate_on_submit():
-        msg = Message(text=g.form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        actions.post_message(g.user, g.form.text.data)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html')
 
 
+@app.get('/messages/search')
+def messages_search():
+    """Full-text search over message text.
+
+    Takes a 'q' param in querystring, and a 'before' cursor for later pages.
+    """
+
+    term = request.args.get('q', '')
+    cursor = search.decode_score_cursor(request.args.get('before'))
+
+    page = search.search_messages(term, cursor)
+
+    return render_template('messages/search.html',
+                           term=term,
+                           messages=page.items,
+                           next_cursor=page.next_cursor,
+                           liked_ids=liked_ids_for(page.items))
+
+
 @app.get('/messages/<int:message_id>')
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = (Message.query
+           .options(joinedload(Message.user))
+           .filter(Message.id == message_id,
+                   Message.user.has(User.deleted_at.is_(None)))
+           .first_or_404())
+
+    if http_cache.is_fresh('message', msg.id, msg.likes_count,
+                           msg.user.id, msg.user.version):
+        return http_cache.not_modified()
+
+    return render_template('messages/show.html',
+                           message=msg,
+                           following_ids=following_ids_for([msg.user]))
 
 
 @app.post('/messages/<int:message_id>/delete')
@@ -361,9 +545,7 @@ def messages_destroy(message_id):
         return redirect("/")
 
     if g.form.validate_on_submit():
-        msg = Message.query.get(message_id)
-        db.session.delete(msg)
-        db.session.commit()
+        actions.delete_message(Message.query.get_or_404(message_id))
 
         return redirect(f"/users/{g.user.id}")
 
@@ -379,28 +561,89 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
+      (older pages via the `?before=` cursor)
     """
 
     if g.user:
-        following_ids = [user.id for user in g.user.following]
+        cursor = pagination.decode_cursor(request.args.get('before'))
+        per_page = pagination.MESSAGES_PER_PAGE
+
+        if timeline.is_enabled():
+            page = pagination.paginate(
+                timeline.home_timeline(
+                    g.user, per_page + 1, cursor,
+                    *write_behind.queued_follows(g.user.id)),
+                per_page)
 
-        messages = (Message
-                    .query
-                    .filter(or_(Message.user_id.in_(following_ids),
-                                Message.user_id == g.user.id))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        else:
+            following_ids = [user.id for user in g.user.following]
 
+            page = pagination.keyset_page(
+                Message.query
+                .filter(write_behind.home_authors(g.user.id, following_ids))
+                .options(joinedload(Message.user)),
+                cursor,
+                per_page)
+
+        write_behind.overlay_counters(g.user)
         session['LAST_URL'] = '/'
 
-        return render_template('home.html', messages=messages)
+        return render_template('home.html',
+                               messages=page.items,
+                               next_cursor=page.next_cursor,
+                               liked_ids=liked_ids_for(page.items))
 
     else:
         return render_template('home-anon.html')
 
 
+@app.cli.command('rebuild-timelines')
+@click.option('--background', is_flag=True,
+              help="Queue the rebuild for `flask worker` instead.")
+def rebuild_timelines(background):
+    """Rebuild every user's materialized home timeline from scratch."""
+
+    if background:
+        jobs.enqueue('rebuild_timelines')
+    else:
+        for user in User.query.all():
+            timeline.rebuild_timeline(user)
+
+    db.session.commit()
+
+
+@app.cli.command('repair-counters')
+@click.option('--background', is_flag=True,
+              help="Queue the repair for `flask worker` instead.")
+def repair_counters(background):
+    """Recompute every denormalized user and message counter."""
+
+    if background:
+        jobs.enqueue('repair_counters')
+    else:
+        counters.recompute_all()
+
+    db.session.commit()
+
+
+@app.cli.command('migrate')
+def migrate():
+    """Bring an existing database's schema up to date."""
+
+    for name in migrations.migrate(db.engine):
+        print(f"applied {name}")
+
+
+@app.cli.command('worker')
+@click.option('--burst', is_flag=True,
+              help="Exit once there are no jobs left to run.")
+def worker(burst):
+    """Run queued background jobs (see jobs.py)."""
+
+    jobs.work(burst=burst)
+
+
 ##############################################################################
 # Routes for Like and Unliking
 
@@ -418,37 +661,24 @@ def like_message(message_id):
         return redirect("/")
 
     if g.form.validate_on_submit():
-        liked_message = Likes.query.filter(
-                        Likes.message_id == message_id and 
-                        Likes.user_id == g.user.id).one_or_none()
+        try:
+            actions.toggle_like(g.user, message_id)
 
-        if g.user.is_author(message_id):
-            flash("You cannot like your own messages..", "danger")
+        except Forbidden as error:
+            flash(error.description, "danger")
             return redirect("/")
 
-        if not liked_message:
-            like = Likes(message_id=message_id, user_id=g.user.id)
-            db.session.add(like)
-
-        else:
-            db.session.delete(liked_message)
-
-        db.session.commit()
-
         return redirect(session['LAST_URL'])
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Caching policy: validators for message and user pages, long-lived
+# static files, and no-store for everything else (see http_cache.py).
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add each response's caching headers."""
 
-    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
-    return response
+    return http_cache.apply_policy(response)
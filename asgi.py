@@ -0,0 +1,433 @@
+"""ASGI entry point for Warbler, with async database reads.
+
+    gunicorn asgi:app -k uvicorn_worker.UvicornWorker
+
+Under sync workers every request holds a whole process while it waits on
+the database. Here, GET and HEAD requests for the read-heavy pages (the
+homepage timeline, profiles, the user listing and message pages) are
+served by the coroutines below, which query through SQLAlchemy's asyncio
+engine (asyncpg on Postgres, aiosqlite on SQLite), so one worker keeps
+many of them in flight at once.
+
+Requests are matched against the Flask app's own URL map and rendered
+inside a Flask request context, so the async views use the same models,
+templates, session cookie, before/after-request hooks (caching headers,
+metrics) and error pages as the sync ones. Everything else (writes,
+searches, the JSON API, static files, the materialized timeline) is
+passed to the Flask app, which runs on a pool of `WSGI_THREADS` threads.
+
+Async reads always go to DATABASE_URL; read replicas (replicas.py) are
+only used by the sync views.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+import sys
+
+from flask import abort, g, render_template, request, session, url_for
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import HTTPException
+
+from app import app as flask_app, CURR_USER_KEY
+import cache
+import follow_graph
+import http_cache
+import pagination
+import search
+import timeline
+import write_behind
+from models import Follows, Likes, Message, User
+
+ASYNC_DRIVERS = {
+    'postgresql': 'asyncpg',
+    'sqlite': 'aiosqlite',
+}
+
+READ_METHODS = ('GET', 'HEAD')
+
+DEFAULT_WSGI_THREADS = 8
+
+_engine = None
+_executor = ThreadPoolExecutor(
+    int(os.getenv('WSGI_THREADS', DEFAULT_WSGI_THREADS)),
+    thread_name_prefix='wsgi')
+
+
+def async_url(url):
+    """`url` with the asyncio driver for its database."""
+
+    url = make_url(url)
+    backend = url.get_backend_name()
+
+    return url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}')
+
+
+def engine():
+    """This worker's asyncio engine, made on first use."""
+
+    global _engine
+
+    if _engine is None:
+        _engine = create_async_engine(
+            async_url(flask_app.config['SQLALCHEMY_DATABASE_URI']))
+
+    return _engine
+
+
+##############################################################################
+# Helpers
+
+
+async def load_current_user(db_session):
+    """`g.user`: the logged-in user, from the user cache when possible.
+
+    Also sets `g.viewer_version` from the database, since the cached row
+    may miss other workers' writes (see `http_cache._viewer`).
+    """
+
+    user_id = session.get(CURR_USER_KEY)
+
+    if user_id is None:
+        return None
+
+    user = cache.cached_user(user_id)
+
+    if user is None:
+        user = await db_session.get(User, user_id)
+
+        if user is not None:
+            cache.remember_user(user)
+            g.viewer_version = user.version
+
+    else:
+        g.viewer_version = (await db_session.execute(
+            select(User.version).where(User.id == user_id))).scalar()
+
+    if user is None or user.deleted_at is not None:
+        return None
+
+    return user
+
+
+async def liked_ids_for(db_session, messages):
+    """Ids of `messages` liked by the logged-in user, for the like stars."""
+
+    message_ids = [msg.id for msg in messages]
+
+    if not g.user or not message_ids:
+        return set()
+
+    liked = set((await db_session.execute(
+        select(Likes.message_id)
+        .where(Likes.user_id == g.user.id,
+               Likes.message_id.in_(message_ids)))).scalars())
+
+    return write_behind.overlay_likes(g.user.id, message_ids, liked)
+
+
+async def following_ids_for(db_session, users):
+    """Ids of `users` that the logged-in user follows, for follow buttons."""
+
+    if not g.user:
+        return set()
+
+    # Loading the graph blocks, so it happens on the thread pool (behind
+    # the graph's own load lock).
+    if follow_graph.needs_load():
+        await asyncio.get_running_loop().run_in_executor(
+            _executor, follow_graph.refresh_graph, flask_app)
+
+    return follow_graph.graph.following_among(
+        g.user.id, [user.id for user in users])
+
+
+async def keyset_page(db_session, query, per_page=pagination.MESSAGES_PER_PAGE):
+    """One page of a Message SELECT, newest first, before `?before=`."""
+
+    cursor = pagination.decode_cursor(request.args.get('before'))
+    query = pagination.before(query, Message.timestamp, Message.id, cursor)
+
+    messages = (await db_session.execute(
+        query.options(joinedload(Message.user)).limit(per_page + 1))
+    ).scalars().all()
+
+    return pagination.paginate(messages, per_page)
+
+
+##############################################################################
+# Views
+#
+# Async versions of the views in app.py, by endpoint. They return what a
+# Flask view would, or None to hand the request to the Flask view.
+
+
+async def homepage(db_session):
+    if not g.user:
+        return render_template('home-anon.html')
+
+    if timeline.is_enabled():
+        return None
+
+    followed = (select(Follows.user_being_followed_id)
+                .where(Follows.user_following_id == g.user.id))
+
+    page = await keyset_page(
+        db_session,
+        select(Message).where(write_behind.home_authors(g.user.id, followed)))
+
+    write_behind.overlay_counters(g.user)
+    session['LAST_URL'] = '/'
+
+    return render_template('home.html',
+                           messages=page.items,
+                           next_cursor=page.next_cursor,
+                           liked_ids=await liked_ids_for(db_session,
+                                                         page.items))
+
+
+async def list_users(db_session):
+    if request.args.get('q', '').strip():
+        return None
+
+    users = (await db_session.execute(
+        search.list_users_query(request.args.get('after')))).scalars().all()
+
+    users, has_next = (users[:search.USERS_PER_PAGE],
+                       len(users) > search.USERS_PER_PAGE)
+    next_url = (url_for('list_users', after=users[-1].username)
+                if has_next else None)
+
+    return render_template('users/index.html',
+                           users=users,
+                           next_url=next_url,
+                           following_ids=await following_ids_for(db_session,
+                                                                 users))
+
+
+async def users_show(db_session, user_id):
+    user = write_behind.overlay_counters(await db_session.get(User, user_id))
+
+    if user is None or user.deleted_at is not None:
+        abort(404)
+
+    session['LAST_URL'] = f'/users/{user_id}'
+
+    if http_cache.is_fresh('user', user.id, user.version,
+                           user.following_count, user.followers_count,
+                           user.likes_count):
+        return http_cache.not_modified()
+
+    page = await keyset_page(
+        db_session, select(Message).where(Message.user_id == user_id))
+
+    return render_template('users/show.html',
+                           user=user,
+                           messages=page.items,
+                           next_cursor=page.next_cursor,
+                           liked_ids=await liked_ids_for(db_session,
+                                                         page.items),
+                           following_ids=await following_ids_for(db_session,
+                                                                 [user]))
+
+
+async def messages_show(db_session, message_id):
+    msg = (await db_session.execute(
+        select(Message)
+        .options(joinedload(Message.user))
+        .where(Message.id == message_id))).scalar()
+
+    if msg is None or msg.user.deleted_at is not None:
+        abort(404)
+
+    if http_cache.is_fresh('message', msg.id, msg.likes_count,
+                           msg.user.id, msg.user.version):
+        return http_cache.not_modified()
+
+    return render_template('messages/show.html',
+                           message=msg,
+                           following_ids=await following_ids_for(db_session,
+                                                                 [msg.user]))
+
+
+ASYNC_VIEWS = {
+    'homepage': homepage,
+    'list_users': list_users,
+    'users_show': users_show,
+    'messages_show': messages_show,
+}
+
+
+##############################################################################
+# Serving
+
+
+def wsgi_environ(scope, body):
+    """The WSGI environ for an ASGI HTTP `scope` and request `body`."""
+
+    server = scope.get('server') or ('localhost', 80)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = (
+            scope['client'][0], str(scope['client'][1]))
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+
+        environ[name] = (f'{environ[name]},{value}' if name in environ
+                         else value)
+
+    return environ
+
+
+def run_wsgi(environ):
+    """Run the Flask app on `environ`; returns (status, headers, body)."""
+
+    started = {}
+    chunks = []
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+        return chunks.append
+
+    result = flask_app(environ, start_response)
+
+    try:
+        chunks.extend(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+    return started['status'], started['headers'], b''.join(chunks)
+
+
+async def run_async_view(view, environ, view_args):
+    """Serve a request with an async view, like Flask's own dispatch;
+    returns (status, headers, body), or None if the view passed.
+    """
+
+    with flask_app.request_context(environ):
+        try:
+            rv = flask_app.preprocess_request()
+
+            if rv is None:
+                async with AsyncSession(engine(),
+                                        expire_on_commit=False) as db_session:
+                    g.user = await load_current_user(db_session)
+                    rv = await view(db_session, **view_args)
+
+                if rv is None:
+                    return None
+
+            response = flask_app.finalize_request(rv)
+
+        except HTTPException as error:
+            response = flask_app.finalize_request(
+                flask_app.handle_user_exception(error))
+
+        except Exception as error:
+            response = flask_app.handle_exception(error)
+
+        return (response.status_code, list(response.headers.items()),
+                response.get_data())
+
+
+def async_view_for(environ):
+    """The async view for this request and its arguments, or (None, None)."""
+
+    if environ['REQUEST_METHOD'] not in READ_METHODS:
+        return None, None
+
+    try:
+        endpoint, view_args = (flask_app.url_map
+                               .bind_to_environ(environ).match())
+    except HTTPException:
+        return None, None
+
+    return ASYNC_VIEWS.get(endpoint), view_args
+
+
+async def read_body(receive):
+    body = b''
+
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+
+        if not message.get('more_body'):
+            return body
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+
+        elif message['type'] == 'lifespan.shutdown':
+            if _engine is not None:
+                await _engine.dispose()
+
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """The ASGI application."""
+
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] != 'http':
+        raise ValueError(f"unsupported ASGI scope: {scope['type']}")
+
+    environ = wsgi_environ(scope, await read_body(receive))
+    view, view_args = async_view_for(environ)
+
+    served = None
+    if view is not None:
+        served = await run_async_view(view, environ, view_args)
+
+    if served is None:
+        served = await asyncio.get_running_loop().run_in_executor(
+            _executor, run_wsgi, environ)
+
+    status, headers, body = served
+
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers],
+    })
+    await send({
+        'type': 'http.response.body',
+        'body': b'' if scope['method'] == 'HEAD' else body,
+    })
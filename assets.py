@@ -0,0 +1,253 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies every file under static/ into static/dist/
+with a content hash in its name (style.css -> style.3f2a9c1b7d4e.css),
+writes gzip and, if the `brotli` package is installed, brotli variants
+of text files, and records the mapping in static/dist/manifest.json.
+`url()` references in stylesheets are rewritten to the hashed names, so
+a stylesheet's hash also changes when an image it uses does.
+
+Templates link to assets with `asset_url('stylesheets/style.css')`, and
+pass URLs stored in the database, which may be /static/ paths (the
+default profile and header images), through the `asset` filter. The
+/assets/ route serves the smallest variant the client accepts, and since
+a hashed name never changes content, with a one-year immutable
+Cache-Control; browsers and the CDN then stop asking the app for them.
+
+Without a build (e.g. in development), `asset_url` falls back to plain
+/static/ URLs.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+
+from flask import abort, current_app, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+import http_cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.html'}
+
+# (Accept-Encoding token, file suffix), best first.
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+STATIC_PREFIX = '/static/'
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")\s]+)\1\s*\)""")
+
+
+def assets_dir():
+    return current_app.config.get(
+        'ASSETS_DIR', os.path.join(current_app.static_folder, 'dist'))
+
+
+##############################################################################
+# Building
+
+
+def fingerprinted_name(path, content):
+    stem, ext = os.path.splitext(path)
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    return f"{stem}.{digest}{ext}"
+
+
+def _write_compressed(path, content):
+    """Write .gz (and .br) next to `path` when they are smaller."""
+
+    variants = [('.gz', gzip.compress(content, 9, mtime=0))]
+
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content)))
+
+    for suffix, compressed in variants:
+        if len(compressed) < len(content):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+
+
+def rewrite_css_urls(logical, css, manifest):
+    """Point the `url()`s in the stylesheet `logical` at the hashed names
+    in `manifest`, relative to where the hashed stylesheet will be.
+    """
+
+    def replace(match):
+        quote, url = match.groups()
+        path = url.split('#', 1)[0].split('?', 1)[0]
+
+        if path.startswith(STATIC_PREFIX):
+            path = path[len(STATIC_PREFIX):]
+        elif path.startswith('/') or ':' in path:
+            return match.group(0)
+        else:
+            path = posixpath.normpath(
+                posixpath.join(posixpath.dirname(logical), path))
+
+        hashed = manifest.get(path)
+
+        if hashed is None:
+            return match.group(0)
+
+        relative = posixpath.relpath(hashed, posixpath.dirname(logical))
+        return f'url({quote}{relative}{quote})'
+
+    return CSS_URL.sub(replace, css.decode('UTF-8')).encode('UTF-8')
+
+
+def build(static_dir, out_dir):
+    """Fingerprint and compress everything under `static_dir` into
+    `out_dir`; returns the manifest.
+
+    Stylesheets are built last, so that their `url()`s can be rewritten
+    to the other files' hashed names.
+    """
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    manifest = {}
+    sources = []
+
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d))
+                   != os.path.abspath(out_dir)]
+
+        for filename in sorted(files):
+            source = os.path.join(root, filename)
+            logical = os.path.relpath(source, static_dir).replace(os.sep, '/')
+            sources.append((logical.endswith('.css'), logical, source))
+
+    for is_css, logical, source in sorted(sources):
+        with open(source, 'rb') as f:
+            content = f.read()
+
+        if is_css:
+            content = rewrite_css_urls(logical, content, manifest)
+
+        hashed = fingerprinted_name(logical, content)
+        target = os.path.join(out_dir, hashed)
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(content)
+
+        if os.path.splitext(logical)[1].lower() in COMPRESSIBLE:
+            _write_compressed(target, content)
+
+        manifest[logical] = hashed
+
+    with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+##############################################################################
+# Serving
+
+
+_manifest = {'mtime': None, 'entries': {}, 'version': ''}
+
+
+def manifest():
+    """The build's {logical path: hashed path}, reloaded after a rebuild."""
+
+    path = os.path.join(assets_dir(), MANIFEST)
+
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        _manifest.update(mtime=None, entries={}, version='')
+        return {}
+
+    if mtime != _manifest['mtime']:
+        with open(path, 'rb') as f:
+            content = f.read()
+        _manifest['entries'] = json.loads(content)
+        _manifest['version'] = hashlib.sha256(content).hexdigest()[:12]
+        _manifest['mtime'] = mtime
+
+    return _manifest['entries']
+
+
+def manifest_version():
+    """A hash of the build's manifest ('' without a build), for caches of
+    markup that links to assets.
+    """
+
+    manifest()
+    return _manifest['version']
+
+
+def asset_url(filename):
+    """URL for a static file: fingerprinted if built, plain otherwise."""
+
+    hashed = manifest().get(filename)
+
+    if hashed is None:
+        return http_cache.static_url(filename)
+
+    return url_for('assets', filename=hashed)
+
+
+def stored_url(url):
+    """A URL stored in the database, with /static/ paths (the default
+    images) sent through `asset_url`; others are returned as they are.
+    """
+
+    if url and url.startswith(STATIC_PREFIX):
+        return asset_url(url[len(STATIC_PREFIX):])
+
+    return url
+
+
+def serve_asset(filename):
+    """Send `filename` from the build, precompressed if the client can
+    take it.
+    """
+
+    directory = assets_dir()
+    path = safe_join(directory, filename)
+
+    if (path is None or filename.endswith(('.gz', '.br'))
+            or not os.path.isfile(path)):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    accepted = request.accept_encodings
+
+    for encoding, suffix in ENCODINGS:
+        if accepted[encoding] and os.path.isfile(path + suffix):
+            response = send_from_directory(directory, filename + suffix,
+                                           mimetype=mimetype)
+            response.content_encoding = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename, mimetype=mimetype)
+
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_app(app):
+    app.add_url_rule('/assets/<path:filename>', 'assets', serve_asset)
+    app.jinja_env.globals['asset_url'] = asset_url
+    app.jinja_env.filters['asset'] = stored_url
+
+    @app.cli.command('build-assets')
+    def build_assets():
+        """Fingerprint and precompress static files into static/dist."""
+
+        built = build(app.static_folder, assets_dir())
+        print(f"built {len(built)} assets into {assets_dir()}"
+              + ("" if brotli else " (no brotli: pip install brotli)"))
@@ -0,0 +1,288 @@
+"""Compare requests/sec of sync and async (ASGI) workers at the same
+memory budget.
+
+Run from the project root, e.g.:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/asgi_bench.py \
+        --memory-mb 800 --concurrency 64 --duration 20
+
+Starts gunicorn twice on the same database: first with sync workers
+serving app:app (the Procfile's `web`), then with uvicorn workers
+serving asgi:app. Each gets as many workers as fit in --memory-mb, going
+by the resident memory of a warmed-up one-worker server. Both are then
+driven for --duration seconds by --concurrency connections, as a
+rotating sample of logged-in users, with the read routes that asgi.py
+serves asynchronously: the homepage, the user listing, profiles and
+message pages.
+
+The dataset is seeded as in routes_bench.py (--no-seed reuses what is
+already in the database). The gap between the two grows with database
+round-trip time, so numbers against a local SQLite file understate what
+a networked Postgres shows.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import routes_bench
+from routes_bench import ROOT, app, CURR_USER_KEY, Message, User, percentile
+
+SERVERS = {
+    'sync': ['app:app'],
+    'async': ['asgi:app', '--worker-class', 'uvicorn_worker.UvicornWorker'],
+}
+
+
+def read_paths(ids, i):
+    return ['/', '/users', f'/users/{ids["users"][i]}',
+            f'/messages/{ids["messages"][i]}'][i % 4]
+
+
+##############################################################################
+# Servers
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def rss_mb(pid):
+    """Resident memory of `pid` and all its descendants, in MB."""
+
+    children = {}
+
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except OSError:
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    stack = [pid]
+
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, []))
+
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+
+    return total / 1024
+
+
+class Server:
+    """A gunicorn server running one of SERVERS in the background."""
+
+    def __init__(self, mode, workers):
+        self.port = free_port()
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', *SERVERS[mode],
+             '--workers', str(workers), '--bind', f'127.0.0.1:{self.port}',
+             '--log-level', 'warning'],
+            cwd=ROOT, env=os.environ.copy())
+
+    def wait_until_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(('127.0.0.1', self.port), 1):
+                    return
+            except OSError:
+                time.sleep(0.1)
+
+        raise RuntimeError("server did not start")
+
+    def rss_mb(self):
+        return rss_mb(self.process.pid)
+
+    def stop(self):
+        self.process.send_signal(signal.SIGTERM)
+        self.process.wait(30)
+
+
+##############################################################################
+# Load
+
+
+async def fetch(connection, path, cookie):
+    """GET `path` on an open (reader, writer); returns (status, keep-alive)."""
+
+    reader, writer = connection
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n'
+                 f'Cookie: session={cookie}\r\n\r\n'.encode())
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    keep_alive = True
+
+    while True:
+        line = (await reader.readline()).strip().lower()
+
+        if not line:
+            break
+        if line.startswith(b'content-length:'):
+            length = int(line.split(b':')[1])
+        if line == b'connection: close':
+            keep_alive = False
+
+    await reader.readexactly(length)
+    return status, keep_alive
+
+
+async def drive(port, ids, cookies, concurrency, duration):
+    """Requests made, latencies (ms) and errors over `duration` seconds."""
+
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def connection_loop(n):
+        nonlocal errors
+        connection = None
+        i = n
+
+        while time.perf_counter() < deadline:
+            if connection is None:
+                connection = await asyncio.open_connection('127.0.0.1', port)
+
+            start = time.perf_counter()
+            try:
+                status, keep_alive = await fetch(
+                    connection, read_paths(ids, i % len(ids['users'])),
+                    cookies[i % len(cookies)])
+            except (ConnectionError, asyncio.IncompleteReadError):
+                status, keep_alive = 599, False
+
+            latencies.append((time.perf_counter() - start) * 1000)
+            errors += status >= 500
+            i += concurrency
+
+            if not keep_alive:
+                connection[1].close()
+                connection = None
+
+        if connection is not None:
+            connection[1].close()
+
+    await asyncio.gather(*(connection_loop(n) for n in range(concurrency)))
+    return latencies, errors
+
+
+def measure(mode, workers, ids, cookies, args):
+    server = Server(mode, workers)
+
+    try:
+        server.wait_until_ready()
+        asyncio.run(drive(server.port, ids, cookies, args.concurrency,
+                          args.warmup))
+        latencies, errors = asyncio.run(
+            drive(server.port, ids, cookies, args.concurrency,
+                  args.duration))
+
+        return {
+            'workers': workers,
+            'rps': round(len(latencies) / args.duration, 1),
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p95_ms': round(percentile(latencies, 95), 1),
+            'rss_mb': round(server.rss_mb()),
+            'errors': errors,
+        }
+    finally:
+        server.stop()
+
+
+def workers_for(mode, budget_mb, ids, cookies, args):
+    """How many workers of `mode` fit in `budget_mb`."""
+
+    server = Server(mode, 1)
+
+    try:
+        server.wait_until_ready()
+        asyncio.run(drive(server.port, ids, cookies, args.concurrency,
+                          args.warmup))
+
+        master = rss_mb(server.process.pid) - sum(
+            rss_mb(pid) for pid in worker_pids(server.process.pid))
+        per_worker = (server.rss_mb() - master)
+    finally:
+        server.stop()
+
+    return max(1, int((budget_mb - master) // per_worker))
+
+
+def worker_pids(pid):
+    return [int(child) for child in open(
+        f'/proc/{pid}/task/{pid}/children').read().split()]
+
+
+##############################################################################
+# Reporting
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=20000)
+    parser.add_argument('--likes', type=int, default=10000)
+    parser.add_argument('--data-dir', help='load these CSVs instead')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='benchmark the data already in the database')
+    parser.add_argument('--memory-mb', type=int, default=600,
+                        help='memory budget for each server')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10,
+                        help='timed seconds per server')
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--sample', type=int, default=100,
+                        help='how many users and messages to rotate through')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if not args.no_seed:
+        routes_bench.seed(args)
+
+    rng = random.Random(args.seed)
+
+    with app.app_context():
+        ids = {'users': routes_bench.sample_ids(User, args.sample, rng),
+               'messages': routes_bench.sample_ids(Message, args.sample, rng)}
+        readers = routes_bench.sample_ids(User, args.sample, rng)
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookies = [serializer.dumps({CURR_USER_KEY: reader})
+               for reader in readers]
+
+    print(f'{"mode":<6} {"workers":>7} {"req/s":>8} {"p50 ms":>8} '
+          f'{"p95 ms":>8} {"RSS MB":>7} {"errors":>7}')
+
+    for mode in SERVERS:
+        workers = workers_for(mode, args.memory_mb, ids, cookies, args)
+        r = measure(mode, workers, ids, cookies, args)
+
+        print(f'{mode:<6} {r["workers"]:>7} {r["rps"]:>8} {r["p50_ms"]:>8} '
+              f'{r["p95_ms"]:>8} {r["rss_mb"]:>7} {r["errors"]:>7}',
+              flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Microbenchmark password checks (logins) per second, per core.
+
+Run from the project root:
+
+    python benchmarks/bcrypt_bench.py --rounds 12 --workers 4 --logins 200
+
+Compares checking inline on the calling thread with the bounded process
+pool from passwords.py, driven by several concurrent request threads.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bcrypt  # noqa: E402
+
+import passwords  # noqa: E402
+
+
+def run_logins(pool, hashed, logins, threads):
+    """Check `logins` passwords through `pool` from `threads` threads;
+    returns (seconds, rejected count).
+    """
+
+    def login(_):
+        try:
+            return pool.run(passwords._check, b'password', hashed)
+        except passwords.PasswordHasherBusy:
+            return None
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(threads) as request_threads:
+        results = list(request_threads.map(login, range(logins)))
+
+    return time.perf_counter() - start, results.count(None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--logins', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=16,
+                        help='concurrent request threads')
+    args = parser.parse_args()
+
+    hashed = bcrypt.hashpw(b'password', bcrypt.gensalt(args.rounds))
+
+    print(f'bcrypt cost {args.rounds}, {args.logins} logins, '
+          f'{args.threads} request threads')
+    print(f'{"mode":<22} {"logins/s":>10} {"per core":>10} {"rejected":>9}')
+
+    inline = passwords.PasswordPool(workers=0, max_pending=args.threads)
+    secs, rejected = run_logins(inline, hashed, args.logins, 1)
+    rate = (args.logins - rejected) / secs
+    print(f'{"inline (1 thread)":<22} {rate:>10.1f} {rate:>10.1f} '
+          f'{rejected:>9}')
+
+    pool = passwords.PasswordPool(args.workers, max_pending=args.logins)
+    pool.run(passwords._check, b'warm', hashed)
+
+    secs, rejected = run_logins(pool, hashed, args.logins, args.threads)
+    rate = (args.logins - rejected) / secs
+    print(f'{"pool (" + str(args.workers) + " workers)":<22} {rate:>10.1f} '
+          f'{rate / args.workers:>10.1f} {rejected:>9}')
+
+    bounded = passwords.PasswordPool(args.workers,
+                                     max_pending=args.workers * 2)
+    bounded.run(passwords._check, b'warm', hashed)
+
+    secs, rejected = run_logins(bounded, hashed, args.logins, args.threads)
+    rate = (args.logins - rejected) / secs
+    print(f'{"pool, max_pending=" + str(args.workers * 2):<22} {rate:>10.1f} '
+          f'{rate / args.workers:>10.1f} {rejected:>9}')
+
+    pool.shutdown()
+    bounded.shutdown()
+
+
+if __name__ == '__main__':
+    main()
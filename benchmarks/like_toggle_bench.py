@@ -0,0 +1,173 @@
+"""Compare the ways of toggling a like: one statement (Postgres), the same
+steps as a few statements (other databases), and the ORM toggle they
+replaced.
+
+Run from the project root, e.g.:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/like_toggle_bench.py \
+        --users 1000 --messages 10000 --toggles 2000
+
+Each toggle runs in its own transaction, as a request would. Every pair is
+liked and then unliked straight away, so each path starts from the same
+(empty) likes table, and the counters must end where they started.
+
+With no DATABASE_URL set, a throwaway SQLite file is used; the single
+statement needs Postgres, so it is skipped there. The database is dropped
+and recreated, so never point this at real data.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from statistics import median, quantiles
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/warbler_like_bench.db')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+from sqlalchemy import event, func, insert, select  # noqa: E402
+
+from app import app  # noqa: E402
+from models import db, User, Message, Likes  # noqa: E402
+import actions  # noqa: E402
+import counters  # noqa: E402
+
+
+def build_data(num_users, num_messages, seed):
+    """Create users and messages, with no likes yet."""
+
+    rng = random.Random(seed)
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(insert(User), [
+        dict(id=i, email=f'user{i}@bench.test', username=f'user{i}',
+             password='x')
+        for i in range(1, num_users + 1)
+    ])
+
+    db.session.execute(insert(Message), [
+        dict(id=i, text='benchmark message',
+             user_id=rng.randint(1, num_users))
+        for i in range(1, num_messages + 1)
+    ])
+
+    db.session.commit()
+
+
+def orm_toggle(user_id, message_id):
+    """The toggle as it was before the single statement: a lookup, then
+    an ORM add or delete and two counter UPDATEs.
+    """
+
+    author_id = db.session.execute(
+        select(Message.user_id).where(Message.id == message_id)).scalar()
+
+    like = Likes.query.filter(Likes.message_id == message_id,
+                              Likes.user_id == user_id).one_or_none()
+
+    if like is None:
+        db.session.add(Likes(message_id=message_id, user_id=user_id))
+        counters.record_like(user_id, message_id)
+
+    else:
+        db.session.delete(like)
+        counters.record_like(user_id, message_id, -1)
+
+    db.session.flush()
+
+    likes_count = db.session.execute(
+        select(Message.likes_count).where(Message.id == message_id)).scalar()
+
+    return author_id, like is None, likes_count
+
+
+def time_toggles(toggle, pairs):
+    """Like then unlike each of `pairs` with `toggle`, a transaction each;
+    returns per-toggle wall times (ms) and SQL statements per toggle.
+    """
+
+    statements = 0
+
+    def count(*args):
+        nonlocal statements
+        statements += 1
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    samples = []
+
+    try:
+        for user_id, message_id in pairs:
+            for _ in range(2):
+                start = time.perf_counter()
+                toggle(user_id, message_id)
+                db.session.commit()
+                samples.append((time.perf_counter() - start) * 1000)
+
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+    return samples, statements / len(samples)
+
+
+def check_counters():
+    """Every like was undone, so no counter may have moved."""
+
+    assert not db.session.execute(select(func.count()).select_from(Likes)).scalar()
+    assert not db.session.execute(
+        select(func.count()).where(User.likes_count != 0)).scalar()
+    assert not db.session.execute(
+        select(func.count()).where(Message.likes_count != 0)).scalar()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--toggles', type=int, default=1000,
+                        help='like/unlike pairs per path')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    paths = [('orm', orm_toggle), ('steps', actions._toggle_like_steps)]
+
+    with app.app_context():
+        build_data(args.users, args.messages, args.seed)
+
+        if db.engine.dialect.name == 'postgresql':
+            paths.append(('statement', actions._toggle_like_statement))
+
+        authors = dict(db.session.execute(
+            select(Message.id, Message.user_id)).all())
+        rng = random.Random(args.seed)
+        pairs = []
+
+        while len(pairs) < args.toggles:
+            user_id = rng.randint(1, args.users)
+            message_id = rng.randint(1, args.messages)
+
+            if authors[message_id] != user_id:
+                pairs.append((user_id, message_id))
+
+        results = []
+
+        for name, toggle in paths:
+            samples, statements = time_toggles(toggle, pairs)
+            check_counters()
+            results.append((name, median(samples),
+                            quantiles(samples, n=20)[18], statements))
+
+    print(f'{db.engine.dialect.name}: {args.users} users, '
+          f'{args.messages} messages, {2 * args.toggles} toggles per path')
+    print(f'{"path":<10} {"p50 ms":>8} {"p95 ms":>8} {"SQL/toggle":>11}')
+
+    for name, p50, p95, statements in results:
+        print(f'{name:<10} {p50:>8.2f} {p95:>8.2f} {statements:>11.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Benchmark full-text message search against a naive ILIKE scan.
+
+Run from the project root, e.g. for the 10M-message target on Postgres:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/message_search_bench.py \
+        --messages 10000000
+
+With no DATABASE_URL set, a throwaway SQLite file (FTS5) is used. The
+database is dropped and recreated, so never point this at real data.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from statistics import median
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/warbler_search_bench.db')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+from sqlalchemy import insert  # noqa: E402
+
+from app import app  # noqa: E402
+from models import db, User, Message  # noqa: E402
+import search  # noqa: E402
+
+WORDS = ('warbler song dawn nest feather branch river morning evening '
+         'migration flock wing sky forest meadow rain sun cloud wind tree '
+         'seed berry insect chirp whistle call mate egg hatch fledge').split()
+
+QUERIES = ['dawn', 'river morning', 'fledge', 'chirp whistle', 'nest egg']
+
+CHUNK_SIZE = 50000
+
+
+def load_messages(num_users, num_messages, seed):
+    """Create users and `num_messages` random messages in chunks."""
+
+    rng = random.Random(seed)
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(insert(User), [
+        dict(id=i, email=f'user{i}@bench.test', username=f'user{i}',
+             password='x')
+        for i in range(1, num_users + 1)
+    ])
+
+    start = datetime.utcnow() - timedelta(days=365)
+
+    for offset in range(0, num_messages, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, num_messages - offset)
+        db.session.execute(insert(Message), [
+            dict(text=' '.join(rng.choices(WORDS, k=rng.randint(4, 20))),
+                 user_id=rng.randint(1, num_users),
+                 timestamp=start + timedelta(
+                     seconds=rng.randint(0, 365 * 86400)))
+            for _ in range(size)
+        ])
+        db.session.commit()
+
+    search.rebuild_message_index()
+    db.session.commit()
+
+
+def timed(fn, repeat):
+    """Median wall time of `fn()` in ms."""
+
+    samples = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+
+    return median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--skip-load', action='store_true',
+                        help='reuse the data from a previous run')
+    args = parser.parse_args()
+
+    with app.app_context():
+        if not args.skip_load:
+            start = time.perf_counter()
+            load_messages(args.users, args.messages, args.seed)
+            print(f'loaded {args.messages} messages in '
+                  f'{time.perf_counter() - start:.1f}s')
+
+        print(f'{"query":<16} {"fts first ms":>13} {"fts page 5 ms":>14} '
+              f'{"ilike ms":>10}')
+
+        for term in QUERIES:
+            def deep_page():
+                cursor = None
+                for _ in range(5):
+                    page = search.search_messages(term, cursor)
+                    cursor = search.decode_score_cursor(page.next_cursor)
+                    if not cursor:
+                        break
+
+            first = timed(lambda: search.search_messages(term), args.repeat)
+            deep = timed(deep_page, args.repeat)
+            naive = timed(
+                lambda: (Message.query
+                         .filter(Message.text.ilike(f'%{term}%'))
+                         .order_by(Message.timestamp.desc())
+                         .limit(search.MESSAGES_PER_PAGE)
+                         .all()),
+                args.repeat)
+
+            print(f'{term:<16} {first:>13.2f} {deep:>14.2f} {naive:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
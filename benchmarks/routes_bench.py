@@ -0,0 +1,342 @@
+"""Drive Warbler's real routes and record throughput, latency and SQL
+statements per request.
+
+Run from the project root, e.g.:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/routes_bench.py \
+        --users 10000 --messages 100000 --follows 500000 --likes 200000 \
+        --out benchmarks/results/$(git rev-parse --short HEAD).json \
+        --compare benchmarks/results/main.json
+
+The dataset is made with generator/create_csvs.py (or taken from
+--data-dir) and loaded with bulk_load.py; --no-seed reuses whatever is
+already in the database. Requests go through the Flask test client, one
+at a time, as a rotating sample of logged-in users, so the numbers are
+for the app and database without any web server in front.
+
+Results are written as JSON. With --compare, each route's p50/p95 and
+SQL count are printed next to an earlier run's.
+
+With no DATABASE_URL set, a throwaway SQLite file is used. The database
+is dropped and recreated, so never point this at real data.
+"""
+
+import argparse
+from datetime import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/warbler_routes_bench.db')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+from sqlalchemy import event, func, select  # noqa: E402
+
+from app import app, CURR_USER_KEY  # noqa: E402
+from models import db, User, Message, Follows  # noqa: E402
+import bulk_load  # noqa: E402
+import follow_graph  # noqa: E402
+import timeline  # noqa: E402
+
+SEARCH_WORDS = ['morning', 'river', 'song', 'nest', 'winter', 'wind']
+
+
+##############################################################################
+# Dataset
+
+
+def seed(args):
+    """Generate (unless --data-dir is given) and bulk-load a dataset."""
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = args.data_dir
+
+        if data_dir is None:
+            data_dir = tmp
+            subprocess.run([
+                sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+                '--users', str(args.users), '--messages', str(args.messages),
+                '--follows', str(args.follows), '--likes', str(args.likes),
+                '--seed', str(args.seed), '--out', data_dir,
+            ], check=True)
+
+        with app.app_context():
+            bulk_load.load_all(data_dir)
+
+            if timeline.is_enabled():
+                for user in User.query.all():
+                    timeline.rebuild_timeline(user)
+                db.session.commit()
+
+
+def sample_ids(model, count, rng):
+    """`count` random ids of `model`, assuming ids have no gaps."""
+
+    top = db.session.execute(select(func.max(model.id))).scalar() or 0
+    return [rng.randint(1, top) for _ in range(count)]
+
+
+def unfollowed_pairs(readers, user_ids, rng):
+    """(reader, target) pairs where reader does not yet follow target."""
+
+    pairs = []
+
+    for reader in readers:
+        following = set(db.session.execute(
+            select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == reader)).scalars())
+
+        target = rng.choice(user_ids)
+        if target != reader and target not in following:
+            pairs.append((reader, target))
+
+    return pairs
+
+
+##############################################################################
+# Routes
+#
+# Each scenario turns (ids, request number) into (reader, method, path,
+# form data). Paired scenarios alternate, so follow/unfollow and
+# like/unlike leave the data roughly as they found it.
+
+
+def get(path):
+    return lambda ids, i: (ids.reader(i), 'GET', path(ids, i), None)
+
+
+SCENARIOS = {
+    'home': get(lambda ids, i: '/'),
+    'users_index': get(lambda ids, i: '/users'),
+    'users_search': get(lambda ids, i: f'/users?q={ids.usernames[i % len(ids.usernames)][:4]}'),
+    'users_show': get(lambda ids, i: f'/users/{ids.user(i)}'),
+    'users_following': get(lambda ids, i: f'/users/{ids.user(i)}/following'),
+    'users_followers': get(lambda ids, i: f'/users/{ids.user(i)}/followers'),
+    'users_liked_messages': get(lambda ids, i: f'/users/{ids.user(i)}/liked_messages'),
+    'messages_show': get(lambda ids, i: f'/messages/{ids.message(i)}'),
+    'messages_search': get(lambda ids, i: f'/messages/search?q={SEARCH_WORDS[i % len(SEARCH_WORDS)]}'),
+    'messages_new_form': get(lambda ids, i: '/messages/new'),
+    'messages_new': lambda ids, i: (
+        ids.reader(i), 'POST', '/messages/new',
+        {'text': f'benchmark message {i}'}),
+    'messages_togglelike': lambda ids, i: (
+        ids.reader(i // 2), 'POST',
+        f'/messages/{ids.message(i // 2)}/togglelike', {}),
+    'users_follow_unfollow': lambda ids, i: (
+        ids.follow_pairs[i // 2 % len(ids.follow_pairs)][0], 'POST',
+        f'/users/{"follow" if i % 2 == 0 else "stop-following"}/'
+        f'{ids.follow_pairs[i // 2 % len(ids.follow_pairs)][1]}', {}),
+}
+
+
+class Ids:
+    """Ids the scenarios pick from, sampled once up front."""
+
+    def __init__(self, sample, rng):
+        with app.app_context():
+            self.readers = sample_ids(User, sample, rng)
+            self.users = sample_ids(User, sample, rng)
+            self.messages = sample_ids(Message, sample, rng)
+            self.usernames = [
+                u.username for u in User.query.filter(User.id.in_(self.users))
+            ] or ['user']
+            self.follow_pairs = unfollowed_pairs(
+                self.readers, self.users, rng) or [(1, 2)]
+
+    def reader(self, i):
+        return self.readers[i % len(self.readers)]
+
+    def user(self, i):
+        return self.users[i % len(self.users)]
+
+    def message(self, i):
+        return self.messages[i % len(self.messages)]
+
+
+##############################################################################
+# Measuring
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of `samples`."""
+
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_scenario(client, scenario, ids, requests, statements):
+    """Make `requests` requests; returns the route's result dict."""
+
+    latencies = []
+    sql_counts = []
+    errors = 0
+
+    for i in range(requests):
+        reader, method, path, data = scenario(ids, i)
+
+        with client.session_transaction() as session:
+            session[CURR_USER_KEY] = reader
+            session['LAST_URL'] = '/'
+
+        statements[0] = 0
+        start = time.perf_counter()
+        response = client.open(path, method=method, data=data)
+        latencies.append((time.perf_counter() - start) * 1000)
+        sql_counts.append(statements[0])
+
+        if response.status_code >= 500:
+            errors += 1
+
+    # Session setup between requests is harness overhead, not app time.
+    elapsed = sum(latencies) / 1000
+
+    return {
+        'requests': requests,
+        'errors': errors,
+        'throughput_rps': round(requests / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'sql_per_request': round(sum(sql_counts) / requests, 1),
+        'sql_max': max(sql_counts),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+            capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['DEBUG_TB_ENABLED'] = False
+    app.config['TESTING'] = False
+
+    ids = Ids(args.sample, random.Random(args.seed))
+    statements = [0]
+
+    def count_statement(*_):
+        statements[0] += 1
+
+    with app.app_context():
+        engine = db.engine
+        dialect = engine.dialect.name
+        counts = {
+            'users': User.query.count(),
+            'messages': Message.query.count(),
+            'follows': Follows.query.count(),
+        }
+
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    follow_graph.graph.invalidate()
+
+    routes = {}
+    client = app.test_client()
+
+    try:
+        for name, scenario in SCENARIOS.items():
+            if args.routes and name not in args.routes:
+                continue
+
+            # Warm caches and connections before timing.
+            run_scenario(client, scenario, ids, min(args.warmup, args.requests),
+                         statements)
+            routes[name] = run_scenario(client, scenario, ids, args.requests,
+                                        statements)
+            print(format_row(name, routes[name]), flush=True)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_statement)
+
+    return {
+        'commit': git_commit(),
+        'run_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'database': dialect,
+        'timeline_materialized': app.config['TIMELINE_MATERIALIZED'],
+        'dataset': counts,
+        'routes': routes,
+    }
+
+
+##############################################################################
+# Reporting
+
+
+HEADER = (f'{"route":<24} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} '
+          f'{"p99 ms":>8} {"sql/req":>8} {"errors":>7}')
+
+
+def format_row(name, r):
+    return (f'{name:<24} {r["throughput_rps"]:>8} {r["p50_ms"]:>8} '
+            f'{r["p95_ms"]:>8} {r["p99_ms"]:>8} {r["sql_per_request"]:>8} '
+            f'{r["errors"]:>7}')
+
+
+def compare(results, baseline):
+    """Print each route's p50, p95 and SQL count against `baseline`."""
+
+    print(f'\ncompared with {baseline.get("commit")} '
+          f'({baseline.get("run_at")}):')
+    print(f'{"route":<24} {"p50 ms":>16} {"p95 ms":>16} {"sql/req":>14}')
+
+    for name, now in results['routes'].items():
+        before = baseline['routes'].get(name)
+        if before is None:
+            continue
+
+        print(f'{name:<24} '
+              f'{before["p50_ms"]:>7} -> {now["p50_ms"]:<6} '
+              f'{before["p95_ms"]:>7} -> {now["p95_ms"]:<6} '
+              f'{before["sql_per_request"]:>5} -> {now["sql_per_request"]:<6}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=20000)
+    parser.add_argument('--likes', type=int, default=10000)
+    parser.add_argument('--data-dir', help='load these CSVs instead')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='benchmark the data already in the database')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--sample', type=int, default=100,
+                        help='how many users and messages to rotate through')
+    parser.add_argument('--routes', nargs='*', choices=sorted(SCENARIOS),
+                        help='only these routes')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='write JSON results here')
+    parser.add_argument('--compare', help='earlier JSON results to compare')
+    args = parser.parse_args()
+
+    if not args.no_seed:
+        seed(args)
+
+    print(HEADER)
+    results = run(args)
+
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Compare the hybrid push/pull home timeline with the original homepage
+query on a synthetic follow graph.
+
+Run from the project root, e.g.:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/timeline_bench.py \
+        --users 5000 --follows-per-user 200 --messages 50000
+
+With no DATABASE_URL set, a throwaway SQLite file is used. The database is
+dropped and recreated, so never point this at real data.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from statistics import median
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/warbler_timeline_bench.db')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+from sqlalchemy import insert, or_  # noqa: E402
+
+from app import app  # noqa: E402
+from models import db, User, Message, Follows  # noqa: E402
+import counters  # noqa: E402
+import timeline  # noqa: E402
+
+
+def build_graph(num_users, follows_per_user, num_messages, seed):
+    """Create users, a power-law follow graph and messages."""
+
+    rng = random.Random(seed)
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(insert(User), [
+        dict(id=i, email=f'user{i}@bench.test', username=f'user{i}',
+             password='x')
+        for i in range(1, num_users + 1)
+    ])
+
+    # Low ids are "celebrities": weight ~ 1 / rank.
+    weights = [1 / rank for rank in range(1, num_users + 1)]
+    follows = set()
+
+    for follower in range(1, num_users + 1):
+        targets = rng.choices(range(1, num_users + 1), weights=weights,
+                              k=follows_per_user)
+        follows.update((followed, follower) for followed in targets
+                       if followed != follower)
+
+    db.session.execute(insert(Follows), [
+        dict(user_being_followed_id=followed, user_following_id=follower)
+        for followed, follower in follows
+    ])
+
+    start = datetime.utcnow() - timedelta(days=365)
+    db.session.execute(insert(Message), [
+        dict(text='benchmark message',
+             user_id=rng.randint(1, num_users),
+             timestamp=start + timedelta(seconds=rng.randint(0, 365 * 86400)))
+        for _ in range(num_messages)
+    ])
+
+    # The bulk inserts bypass the counters, and `followers_count` is what
+    # decides which authors are pulled rather than pushed.
+    counters.recompute_all()
+    db.session.commit()
+
+
+def legacy_timeline(user, limit=100):
+    """The homepage query as it was before materialized timelines."""
+
+    following_ids = [u.id for u in user.following]
+
+    return (Message
+            .query
+            .filter(or_(Message.user_id.in_(following_ids),
+                        Message.user_id == user.id))
+            .order_by(Message.timestamp.desc())
+            .limit(limit)
+            .all())
+
+
+def time_reads(read, users, repeat):
+    """Median and worst wall time (ms) of `read(user)` over `users`."""
+
+    samples = []
+
+    for user in users:
+        for _ in range(repeat):
+            db.session.expire_all()
+            start = time.perf_counter()
+            read(user)
+            samples.append((time.perf_counter() - start) * 1000)
+
+    return median(samples), max(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--follows-per-user', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--threshold', type=int, default=200,
+                        help='follower count above which authors are pulled')
+    parser.add_argument('--sample', type=int, default=50,
+                        help='number of readers to time')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    app.config['TIMELINE_MATERIALIZED'] = True
+    app.config['FANOUT_FOLLOWER_THRESHOLD'] = args.threshold
+
+    with app.app_context():
+        build_graph(args.users, args.follows_per_user, args.messages,
+                    args.seed)
+
+        pulled = User.query.filter(
+            User.followers_count > args.threshold).count()
+        assert pulled, (f'no author has over {args.threshold} followers, '
+                        'so the pull path would not be measured')
+
+        start = time.perf_counter()
+        for user in User.query.all():
+            timeline.rebuild_timeline(user)
+        db.session.commit()
+        build_secs = time.perf_counter() - start
+
+        readers = random.Random(args.seed).sample(
+            User.query.all(), min(args.sample, args.users))
+
+        legacy = time_reads(legacy_timeline, readers, args.repeat)
+        hybrid = time_reads(timeline.home_timeline, readers, args.repeat)
+
+    print(f'graph: {args.users} users, {args.messages} messages, '
+          f'threshold {args.threshold} followers ({pulled} authors pulled)')
+    print(f'materialize all timelines: {build_secs:.2f}s')
+    print(f'{"read path":<10} {"median ms":>10} {"max ms":>10}')
+    print(f'{"legacy":<10} {legacy[0]:>10.2f} {legacy[1]:>10.2f}')
+    print(f'{"hybrid":<10} {hybrid[0]:>10.2f} {hybrid[1]:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
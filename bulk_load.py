@@ -0,0 +1,269 @@
+"""Bulk-load Warbler CSVs into the database.
+
+    python bulk_load.py                      # fresh load of generator/*.csv
+    python bulk_load.py --data-dir big/      # another dataset
+    python bulk_load.py --resume             # carry on after a crash
+
+CSVs are streamed in chunks rather than read whole. On Postgres each
+chunk goes in with `COPY ... FROM STDIN`; other databases (SQLite) get a
+batched executemany INSERT. Secondary indexes and foreign keys are
+dropped before the load and rebuilt once at the end, which is far
+cheaper than maintaining them row by row.
+
+Each chunk is committed together with a row in `bulk_load_progress`, so
+`--resume` skips exactly the rows that made it in. Rows/sec is reported
+per table.
+"""
+
+import argparse
+import csv
+from datetime import datetime
+import io
+from itertools import islice
+import os
+import time
+
+from sqlalchemy import (Column, DDL, Integer, MetaData, Table, Text, inspect,
+                        insert, select, text)
+from sqlalchemy.schema import AddConstraint
+
+from app import app
+from models import db, User, Message, Follows, Likes, POSTGRES_SEARCH_INDEXES
+import counters
+import search
+
+DEFAULT_DATA_DIR = 'generator'
+DEFAULT_CHUNK_SIZE = 50000
+
+# Load order matters for the foreign keys we put back at the end.
+LOAD_ORDER = [
+    ('users.csv', User.__table__),
+    ('messages.csv', Message.__table__),
+    ('follows.csv', Follows.__table__),
+    ('likes.csv', Likes.__table__),
+]
+
+progress_metadata = MetaData()
+
+progress = Table(
+    'bulk_load_progress',
+    progress_metadata,
+    Column('table_name', Text, primary_key=True),
+    Column('rows', Integer, nullable=False),
+)
+
+
+def is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+##############################################################################
+# Deferring indexes and foreign keys
+
+
+def drop_indexes_and_foreign_keys():
+    """Drop secondary indexes and foreign keys on the loaded tables."""
+
+    tables = [table for _, table in LOAD_ORDER]
+    inspector = inspect(db.engine)
+
+    with db.engine.begin() as conn:
+        for table in tables:
+            for index in table.indexes:
+                conn.execute(DDL(f"DROP INDEX IF EXISTS {index.name}"))
+
+        if is_postgres():
+            for name in POSTGRES_SEARCH_INDEXES:
+                conn.execute(DDL(f"DROP INDEX IF EXISTS {name}"))
+
+            for table in tables:
+                for fk in inspector.get_foreign_keys(table.name):
+                    conn.execute(DDL(
+                        f'ALTER TABLE {table.name} '
+                        f'DROP CONSTRAINT IF EXISTS "{fk["name"]}"'))
+
+
+def create_indexes_and_foreign_keys():
+    """Put back everything `drop_indexes_and_foreign_keys` removed."""
+
+    tables = [table for _, table in LOAD_ORDER]
+
+    with db.engine.begin() as conn:
+        for table in tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+        if is_postgres():
+            for _, statement in POSTGRES_SEARCH_INDEXES.values():
+                conn.execute(DDL(statement))
+
+            existing = {
+                (table.name, tuple(fk['constrained_columns']))
+                for table in tables
+                for fk in inspect(conn).get_foreign_keys(table.name)
+            }
+
+            for table in tables:
+                for fk in table.foreign_key_constraints:
+                    if (table.name, tuple(fk.column_keys)) not in existing:
+                        conn.execute(AddConstraint(fk))
+
+
+##############################################################################
+# Streaming CSVs in
+
+
+def read_chunks(path, skip, chunk_size):
+    """Yield lists of CSV rows (dicts) from `path`, after skipping the
+    first `skip` data rows.
+    """
+
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+
+        for _ in islice(reader, skip):
+            pass
+
+        while True:
+            chunk = list(islice(reader, chunk_size))
+            if not chunk:
+                return
+
+            yield reader.fieldnames, chunk
+
+
+def copy_chunk(conn, table, fieldnames, rows):
+    """COPY one chunk into a Postgres table."""
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+    writer.writerows(rows)
+    buffer.seek(0)
+
+    columns = ', '.join(fieldnames)
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def insert_chunk(conn, table, fieldnames, rows):
+    """executemany one chunk into a non-Postgres table."""
+
+    datetime_columns = [name for name in fieldnames
+                        if isinstance(table.c[name].type, db.DateTime)]
+
+    for row in rows:
+        for name in datetime_columns:
+            row[name] = datetime.fromisoformat(row[name])
+
+    conn.execute(insert(table), rows)
+
+
+def rows_done(table):
+    with db.engine.connect() as conn:
+        return conn.execute(
+            select(progress.c.rows)
+            .where(progress.c.table_name == table.name)).scalar() or 0
+
+
+def load_table(path, table, chunk_size):
+    """Stream one CSV into `table`, committing progress with each chunk.
+
+    Returns (rows loaded this run, seconds).
+    """
+
+    skip = rows_done(table)
+    write_chunk = copy_chunk if is_postgres() else insert_chunk
+
+    loaded = 0
+    start = time.perf_counter()
+
+    for fieldnames, rows in read_chunks(path, skip, chunk_size):
+        with db.engine.begin() as conn:
+            write_chunk(conn, table, fieldnames, rows)
+
+            loaded += len(rows)
+            conn.execute(progress.delete()
+                         .where(progress.c.table_name == table.name))
+            conn.execute(progress.insert()
+                         .values(table_name=table.name, rows=skip + loaded))
+
+        print(f"  {table.name}: {skip + loaded} rows", end='\r', flush=True)
+
+    return loaded, time.perf_counter() - start
+
+
+def reset_sequences():
+    """Move Postgres id sequences past the highest loaded id."""
+
+    if not is_postgres():
+        return
+
+    with db.engine.begin() as conn:
+        for _, table in LOAD_ORDER:
+            if 'id' in table.c:
+                conn.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                    f"COALESCE((SELECT MAX(id) FROM {table.name}), 1))"))
+
+
+##############################################################################
+# Putting it together
+
+
+def load_all(data_dir=DEFAULT_DATA_DIR, chunk_size=DEFAULT_CHUNK_SIZE,
+             resume=False):
+    """Load every CSV in `data_dir` that we know about."""
+
+    if not resume:
+        db.drop_all()
+        db.create_all()
+        progress_metadata.drop_all(db.engine)
+
+    progress_metadata.create_all(db.engine)
+    drop_indexes_and_foreign_keys()
+
+    total_start = time.perf_counter()
+
+    for filename, table in LOAD_ORDER:
+        path = os.path.join(data_dir, filename)
+
+        if not os.path.exists(path):
+            continue
+
+        loaded, secs = load_table(path, table, chunk_size)
+        rate = loaded / secs if secs else 0
+        print(f"{table.name}: {loaded} rows in {secs:.1f}s "
+              f"({rate:,.0f} rows/sec)")
+
+    start = time.perf_counter()
+    create_indexes_and_foreign_keys()
+    reset_sequences()
+    print(f"indexes and foreign keys: {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    counters.recompute_all()
+    search.rebuild_message_index()
+    db.session.commit()
+    print(f"counters and search index: {time.perf_counter() - start:.1f}s")
+
+    progress_metadata.drop_all(db.engine)
+
+    print(f"total: {time.perf_counter() - total_start:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bulk-load Warbler CSVs into the database.")
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted load')
+    args = parser.parse_args()
+
+    with app.app_context():
+        load_all(args.data_dir, args.chunk_size, args.resume)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Small in-process caches for Warbler.
+
+`LRUCache` is a thread-safe, size-bounded LRU with an optional TTL. Each
+gunicorn worker has its own copy of every cache, so anything cached here
+can be up to `ttl` seconds stale with respect to writes made by another
+worker; writes made by this worker invalidate explicitly.
+
+The current-user cache keeps the column values of recently seen users so
+that `g.user` does not cost a query on every request.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import time
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, User
+
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 30
+
+
+class LRUCache:
+    """Least-recently-used cache with an optional time-to-live."""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Return the cached value for `key`, or `default` if it is
+        missing or expired.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return default
+
+            value, expires_at = entry
+
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Cache `value` under `key`, evicting the least recently used
+        entry if the cache is full.
+        """
+
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Drop `key` from the cache, if present."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Per-worker cache of user column values, keyed by user id.
+user_rows = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+def cached_user(user_id):
+    """The cached row for `user_id` as a detached User, or None."""
+
+    values = user_rows.get(user_id)
+
+    if values is None:
+        return None
+
+    user = User(**values)
+    make_transient_to_detached(user)
+
+    return user
+
+
+def remember_user(user):
+    """Cache the column values of a freshly loaded `user`."""
+
+    user_rows.set(user.id, {
+        attr.key: getattr(user, attr.key)
+        for attr in inspect(User).column_attrs
+    })
+
+
+def load_user(user_id):
+    """Return the User with `user_id` attached to the current session,
+    served from the cache when possible. Returns None if there is no
+    such user, or if they have deleted their account.
+    """
+
+    user = cached_user(user_id)
+
+    if user is None:
+        user = User.query.get(user_id)
+
+        if user is not None:
+            remember_user(user)
+
+    else:
+        # Attach the cached row to this session without a SELECT;
+        # relationships still lazy-load as usual.
+        user = db.session.merge(user, load=False)
+
+    if user is None or user.deleted_at is not None:
+        return None
+
+    return user
+
+
+def invalidate_user(user_id):
+    """Forget the cached row for `user_id` after it changes."""
+
+    user_rows.delete(user_id)
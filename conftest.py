@@ -0,0 +1,6 @@
+"""Test setup shared by every test module; pytest loads it first."""
+
+import os
+
+# Hash passwords inline rather than in a process pool.
+os.environ.setdefault('PASSWORD_POOL_WORKERS', "0")
@@ -0,0 +1,156 @@
+"""Denormalized counters for Warbler.
+
+`User` carries messages/following/followers/likes counts and `Message`
+carries a likes count, so profile headers are a single row read instead
+of a COUNT or a relationship load per number. Every change to a user's
+counters also bumps `User.version`.
+
+Write routes adjust the counters with `col = col + n` UPDATEs in the same
+transaction as the change they count. `recompute_all` rebuilds every
+counter from the source tables if they ever drift.
+"""
+
+from sqlalchemy import bindparam, func, select, update
+
+import cache
+from models import db, Follows, Likes, Message, User
+
+
+def bump_user(user_id, **deltas):
+    """Add `deltas` (e.g. `likes_count=1`) to one user's counters."""
+
+    values = {getattr(User, name): getattr(User, name) + delta
+              for name, delta in deltas.items()}
+
+    db.session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values({**values, User.version: User.version + 1}))
+
+    cache.invalidate_user(user_id)
+
+
+def bump_message(message_id, likes_count):
+    """Add `likes_count` to one message's like counter."""
+
+    db.session.execute(
+        update(Message)
+        .where(Message.id == message_id)
+        .values({Message.likes_count: Message.likes_count + likes_count}))
+
+
+def bump_many(model, name, deltas):
+    """Add {id: delta} to the `name` counter of many users or messages in
+    one executemany UPDATE (used to flush batched writes).
+    """
+
+    deltas = {id: delta for id, delta in deltas.items() if delta}
+
+    if not deltas:
+        return
+
+    table = model.__table__
+    values = {name: table.c[name] + bindparam('delta')}
+
+    if model is User:
+        values['version'] = table.c.version + 1
+
+    db.session.execute(
+        update(table).where(table.c.id == bindparam('row_id')).values(values),
+        [{'row_id': id, 'delta': delta} for id, delta in deltas.items()])
+
+    if model is User:
+        for user_id in deltas:
+            cache.invalidate_user(user_id)
+
+
+def record_follow(follower_id, followed_id, delta=1):
+    """Count a follow (`delta=1`) or an unfollow (`delta=-1`)."""
+
+    bump_user(follower_id, following_count=delta)
+    bump_user(followed_id, followers_count=delta)
+
+
+def record_like(user_id, message_id, delta=1):
+    """Count a like (`delta=1`) or an unlike (`delta=-1`)."""
+
+    bump_user(user_id, likes_count=delta)
+    bump_message(message_id, likes_count=delta)
+
+
+def forget_message(message):
+    """Take a message that is about to be deleted out of every counter:
+    its author's message count and the like counts of its likers.
+    """
+
+    bump_user(message.user_id, messages_count=-1)
+
+    likers = select(Likes.user_id).where(Likes.message_id == message.id)
+
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(likers))
+        .values({User.likes_count: User.likes_count - 1,
+                 User.version: User.version + 1})
+        .execution_options(synchronize_session=False))
+
+
+def _count(column, *criteria):
+    return (select(func.count(column))
+            .where(*criteria)
+            .scalar_subquery())
+
+
+def _in_range(column, first_id, last_id):
+    criteria = []
+
+    if first_id is not None:
+        criteria.append(column >= first_id)
+    if last_id is not None:
+        criteria.append(column <= last_id)
+
+    return criteria
+
+
+def recompute_users(first_id=None, last_id=None):
+    """Recompute the counters of users with ids in [first_id, last_id]
+    (all users by default) from the source tables.
+    """
+
+    db.session.execute(
+        update(User)
+        .where(*_in_range(User.id, first_id, last_id))
+        .values({
+            User.messages_count: _count(
+                Message.id, Message.user_id == User.id),
+            User.following_count: _count(
+                Follows.user_being_followed_id,
+                Follows.user_following_id == User.id),
+            User.followers_count: _count(
+                Follows.user_following_id,
+                Follows.user_being_followed_id == User.id),
+            User.likes_count: _count(
+                Likes.message_id, Likes.user_id == User.id),
+            User.version: User.version + 1,
+        })
+        .execution_options(synchronize_session=False))
+
+
+def recompute_messages(first_id=None, last_id=None):
+    """Recompute the like counters of messages with ids in
+    [first_id, last_id] (all messages by default).
+    """
+
+    db.session.execute(
+        update(Message)
+        .where(*_in_range(Message.id, first_id, last_id))
+        .values({Message.likes_count: _count(
+            Likes.user_id, Likes.message_id == Message.id)})
+        .execution_options(synchronize_session=False))
+
+
+def recompute_all():
+    """Recompute every counter from the source tables in bulk."""
+
+    recompute_users()
+    recompute_messages()
@@ -0,0 +1,280 @@
+"""In-memory follow-graph index for Warbler.
+
+Answers "does A follow B?" style questions without loading `User`
+relationships. Each user's following and follower ids are kept in sorted
+`array('i')`s, so membership is a binary search and the whole graph costs
+a few bytes per edge.
+
+The index lives in each worker process. It is loaded from the `follows`
+table on first use, kept current by the follow/unfollow routes of this
+worker, and reloaded every `FOLLOW_GRAPH_TTL` seconds to pick up writes
+made by other workers. Only the first load holds up a request; later
+reloads run in a background thread, one at a time, while requests keep
+reading the graph they replace. Edges that are queued but not yet
+written (see write_behind.py) are held as overrides that survive reloads.
+"""
+
+from array import array
+from bisect import bisect_left, insort
+import logging
+from threading import Lock, Thread
+import time
+
+from flask import current_app
+from sqlalchemy import select
+
+from models import db, Follows
+
+DEFAULT_TTL = 30
+
+logger = logging.getLogger(__name__)
+
+
+def _contains(ids, id):
+    """Binary search for `id` in the sorted array `ids`."""
+
+    i = bisect_left(ids, id)
+    return i < len(ids) and ids[i] == id
+
+
+def _add(following, followers, follower_id, followed_id):
+    ids = following.setdefault(follower_id, array('i'))
+    if not _contains(ids, followed_id):
+        insort(ids, followed_id)
+
+    ids = followers.setdefault(followed_id, array('i'))
+    if not _contains(ids, follower_id):
+        insort(ids, follower_id)
+
+
+def _remove(following, followers, follower_id, followed_id):
+    ids = following.get(follower_id, array('i'))
+    if _contains(ids, followed_id):
+        ids.remove(followed_id)
+
+    ids = followers.get(followed_id, array('i'))
+    if _contains(ids, follower_id):
+        ids.remove(follower_id)
+
+
+class FollowGraph:
+    """Sorted-array adjacency lists for following and followers.
+
+    `_lock` guards the adjacency lists, for readers as well as writers;
+    `_load_lock` is held for the whole of a load, so only one runs at a
+    time.
+    """
+
+    def __init__(self):
+        self._following = {}
+        self._followers = {}
+        self._loaded_at = None
+        self._overrides = {}
+        # Edge changes made while a load was reading the table, which
+        # it may have missed.
+        self._changes = None
+        self._lock = Lock()
+        self._load_lock = Lock()
+
+    def load(self, pairs):
+        """Replace the graph with `pairs` of (follower_id, followed_id).
+
+        The new graph is built aside and swapped in, so readers see
+        either the old graph or the new one, never half of it.
+        """
+
+        following = {}
+        followers = {}
+
+        for follower_id, followed_id in pairs:
+            following.setdefault(follower_id, []).append(followed_id)
+            followers.setdefault(followed_id, []).append(follower_id)
+
+        following = {id: array('i', sorted(ids))
+                     for id, ids in following.items()}
+        followers = {id: array('i', sorted(ids))
+                     for id, ids in followers.items()}
+
+        with self._lock:
+            for (follower_id, followed_id), is_following in [
+                    *(self._changes or {}).items(),
+                    *self._overrides.items()]:
+                (_add if is_following else _remove)(
+                    following, followers, follower_id, followed_id)
+
+            self._following = following
+            self._followers = followers
+            self._changes = None
+            self._loaded_at = time.monotonic()
+
+    def refresh(self, reload, ttl):
+        """Make sure the graph is loaded and at most `ttl` seconds old.
+
+        `reload()` must `load()` the graph. If it was never loaded (or
+        was invalidated), this waits for a load; if it is only stale, a
+        background thread reloads it and the current graph is served
+        meanwhile.
+        """
+
+        if not self.is_stale(ttl):
+            return
+
+        if self._loaded_at is None:
+            with self._load_lock:
+                if self._loaded_at is None:
+                    self._track_changes()
+                    reload()
+            return
+
+        if not self._load_lock.acquire(blocking=False):
+            return
+
+        if not self.is_stale(ttl):
+            self._load_lock.release()
+            return
+
+        self._track_changes()
+        Thread(target=self._reload_in_background, args=(reload,),
+               name='follow-graph-reload', daemon=True).start()
+
+    def _track_changes(self):
+        """Start noting edge changes, for a load about to read the table."""
+
+        with self._lock:
+            self._changes = {}
+
+    def _reload_in_background(self, reload):
+        try:
+            reload()
+        except Exception:
+            logger.exception("follow graph reload failed")
+            with self._lock:
+                self._changes = None
+        finally:
+            self._load_lock.release()
+
+    def is_stale(self, ttl):
+        """Has it been more than `ttl` seconds since the last load?"""
+
+        return (self._loaded_at is None
+                or time.monotonic() - self._loaded_at > ttl)
+
+    def invalidate(self):
+        """Force a reload on next use."""
+
+        self._loaded_at = None
+
+    def _apply(self, follower_id, followed_id, following):
+        with self._lock:
+            (_add if following else _remove)(
+                self._following, self._followers, follower_id, followed_id)
+
+            if self._changes is not None:
+                self._changes[(follower_id, followed_id)] = following
+
+    def add(self, follower_id, followed_id):
+        """Record that `follower_id` now follows `followed_id`."""
+
+        self._apply(follower_id, followed_id, True)
+
+    def remove(self, follower_id, followed_id):
+        """Record that `follower_id` no longer follows `followed_id`."""
+
+        self._apply(follower_id, followed_id, False)
+
+    def override(self, follower_id, followed_id, following):
+        """Show an edge change that isn't in the database yet, even
+        across reloads, until it is `release`d.
+        """
+
+        with self._lock:
+            self._overrides[(follower_id, followed_id)] = following
+
+        self._apply(follower_id, followed_id, following)
+
+    def release(self, pairs):
+        """Drop the overrides for (follower_id, followed_id) `pairs`."""
+
+        with self._lock:
+            for pair in pairs:
+                self._overrides.pop(pair, None)
+
+    def is_following(self, user_id, other_id):
+        """Does `user_id` follow `other_id`?"""
+
+        with self._lock:
+            return _contains(self._following.get(user_id, ()), other_id)
+
+    def is_followed_by(self, user_id, other_id):
+        """Is `user_id` followed by `other_id`?"""
+
+        with self._lock:
+            return _contains(self._followers.get(user_id, ()), other_id)
+
+    def is_mutual(self, user_id, other_id):
+        """Do `user_id` and `other_id` follow each other?"""
+
+        return (self.is_following(user_id, other_id)
+                and self.is_following(other_id, user_id))
+
+    def following_among(self, user_id, ids):
+        """The subset of `ids` that `user_id` follows."""
+
+        with self._lock:
+            following = self._following.get(user_id, ())
+            return {id for id in ids if _contains(following, id)}
+
+    def following_ids(self, user_id):
+        """Sorted ids of everyone `user_id` follows (a copy)."""
+
+        with self._lock:
+            return array('i', self._following.get(user_id, ()))
+
+    def follower_ids(self, user_id):
+        """Sorted ids of everyone following `user_id` (a copy)."""
+
+        with self._lock:
+            return array('i', self._followers.get(user_id, ()))
+
+
+graph = FollowGraph()
+
+ALL_FOLLOWS = select(Follows.user_following_id, Follows.user_being_followed_id)
+
+
+def needs_load():
+    """Is the graph missing or older than `FOLLOW_GRAPH_TTL` seconds?"""
+
+    return graph.is_stale(
+        current_app.config.get('FOLLOW_GRAPH_TTL', DEFAULT_TTL))
+
+
+def reload_graph(app):
+    """Load the graph from `app`'s primary database, streaming the rows.
+
+    Uses its own connection, not the request's session, so it can run
+    in any thread.
+    """
+
+    with db.get_engine(app).connect() as conn:
+        graph.load(conn.execution_options(stream_results=True)
+                   .execute(ALL_FOLLOWS))
+
+
+def refresh_graph(app):
+    """Load the graph for `app` if it is missing, or start reloading it
+    in the background if it is stale.
+    """
+
+    graph.refresh(
+        lambda: reload_graph(app),
+        app.config.get('FOLLOW_GRAPH_TTL', DEFAULT_TTL))
+
+
+def get_graph():
+    """The process-wide follow graph, loaded from the database if it is
+    missing and reloaded in the background if it is stale.
+    """
+
+    refresh_graph(current_app._get_current_object())
+    return graph
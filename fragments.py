@@ -0,0 +1,148 @@
+"""Cache of rendered message and user cards.
+
+Lists of messages and users render the same card markup over and over.
+The parts that look the same to everyone are rendered once and cached
+here, keyed by message or user id and stored with a stamp built from the
+author's (or user's) `version`, so a profile edit or a counter change
+makes the old markup stale without any explicit invalidation. Stamps
+also carry something that tells reused ids apart (SQLite reuses them),
+and the asset manifest's version, since cards link to fingerprinted
+assets that a rebuild deletes.
+
+Viewer-specific parts (like stars, follow buttons) stay in the page
+templates, or are passed in and spliced into the cached markup.
+
+Each worker keeps an LRU of cards. A shared backend with `get`, `set`
+and `delete` (see `RedisBackend`) can be put behind it with
+`FRAGMENT_CACHE_REDIS_URL`, so workers warm each other's caches.
+"""
+
+import json
+import os
+
+from flask import render_template
+from markupsafe import Markup
+
+import assets
+from cache import LRUCache
+
+FRAGMENT_CACHE_SIZE = 10000
+
+# Where viewer-specific markup goes in a cached card.
+PLACEHOLDER = '<!--viewer-->'
+
+cards = LRUCache(FRAGMENT_CACHE_SIZE)
+shared = None
+
+
+class RedisBackend:
+    """Shared fragment store in Redis; needs the `redis` package."""
+
+    def __init__(self, url, ttl=24 * 3600):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(key)
+        return value.decode('UTF-8') if value is not None else None
+
+    def set(self, key, value):
+        self.client.set(key, value, ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+def _shared_key(key):
+    kind, item_id = key
+    return f'warbler:fragment:{kind}:{item_id}'
+
+
+def _get(key, stamp):
+    entry = cards.get(key)
+
+    if entry is None and shared is not None:
+        value = shared.get(_shared_key(key))
+
+        if value is not None:
+            entry = tuple(json.loads(value))
+            cards.set(key, entry)
+
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+
+    return None
+
+
+def _set(key, stamp, html):
+    cards.set(key, (stamp, html))
+
+    if shared is not None:
+        shared.set(_shared_key(key), json.dumps([stamp, html]))
+
+
+def render_card(kind, item_id, stamp, template, **context):
+    """Render `template` once per (kind, item_id, stamp)."""
+
+    key = (kind, item_id)
+    html = _get(key, stamp)
+
+    if html is None:
+        html = render_template(template, **context)
+        _set(key, stamp, html)
+
+    return html
+
+
+def message_card(msg):
+    """The shared markup of a message in a list."""
+
+    stamp = (f'{assets.manifest_version()}.{msg.user_id}.{msg.user.version}.'
+             f'{msg.timestamp.isoformat()}')
+
+    return Markup(render_card('message', msg.id, stamp,
+                              'messages/_card.html', msg=msg))
+
+
+def user_card(user, viewer_markup=''):
+    """The markup of a user in a list, with `viewer_markup` (the follow
+    button) in its place.
+    """
+
+    stamp = f'{assets.manifest_version()}.{user.version}.{user.username}'
+    html = render_card('user', user.id, stamp, 'users/_card.html',
+                       user=user, viewer_markup=Markup(PLACEHOLDER))
+
+    return Markup(html.replace(PLACEHOLDER, str(viewer_markup), 1))
+
+
+def invalidate_message(message_id):
+    _delete(('message', message_id))
+
+
+def invalidate_user(user_id):
+    _delete(('user', user_id))
+
+
+def _delete(key):
+    cards.delete(key)
+
+    if shared is not None:
+        shared.delete(_shared_key(key))
+
+
+def init_app(app):
+    """Make the card helpers available to templates."""
+
+    global shared
+
+    url = app.config.get('FRAGMENT_CACHE_REDIS_URL',
+                         os.getenv('FRAGMENT_CACHE_REDIS_URL'))
+
+    if url:
+        shared = RedisBackend(url)
+
+    app.jinja_env.globals.update(message_card=message_card,
+                                 user_card=user_card)
@@ -2,76 +2,245 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows:
+
+    python generator/create_csvs.py                          # the classic 300 users
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 20000000 --likes 20000000 --out big/ --workers 8
+
+Everything is generated offline and streamed to disk, so memory stays flat
+however many rows are asked for. Work is split into chunks written in
+parallel and then concatenated in order; each chunk has its own seed
+derived from `--seed`, so the same arguments always produce byte-identical
+files whatever `--workers` is.
+
+The data is shaped like a real social network rather than uniform noise:
+
+- who gets followed is power-law distributed (a few accounts have huge
+  followings) and how many accounts each user follows is heavy-tailed;
+- authorship is power-law distributed too, and posting volume rises
+  toward `--end`, with message ids in timestamp order;
+- likes favour recent messages.
+
+Follow and like counts are targets; the actual totals land close to them.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+from datetime import date, datetime, time, timedelta
+from multiprocessing import Pool
+import os
+import random
+import shutil
 
-MAX_WARBLER_LENGTH = 140
+from helpers import (CITIES, FIRST_NAMES, HEADER_IMAGE_URL, IMAGE_URLS,
+                     LAST_NAMES, PASSWORD_HASH, heavy_tailed_count,
+                     power_law_rank, sentence)
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['message_id', 'user_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWS = 5000
+NUM_LIKES = 3000
+
+CHUNK_ROWS = 100000
+YEARS_OF_MESSAGES = 2
+
+# A fixed default for `--end` (about where the shipped CSVs end), so that
+# runs on different days still produce the same files.
+END_DATE = date(2018, 7, 1)
+
+# How strongly messages bunch up near the end date, and likes near the
+# newest messages. 1 is uniform; bigger is more skewed.
+RECENCY_SKEW = 3.0
+
+
+##############################################################################
+# One chunk of each table
+
+
+def distinct(rng, count, population, pick):
+    """`count` distinct ids from 1..population, drawn with `pick(rng)`.
+
+    Rejection sampling is fine while `count` is a small share of the
+    population; past that, fall back to a plain uniform sample.
+    """
+
+    if count * 4 > population:
+        return rng.sample(range(1, population + 1), count)
+
+    chosen = set()
+    while len(chosen) < count:
+        chosen.add(pick(rng))
+
+    return chosen
+
+
+def user_rows(rng, args, first_id, last_id):
+    for user_id in range(first_id, last_id + 1):
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+
+        yield [
+            f"{first}.{last}{user_id}@example.com",
+            f"{first}{last}{user_id}",
+            rng.choice(IMAGE_URLS),
+            PASSWORD_HASH,
+            sentence(rng, 80),
+            HEADER_IMAGE_URL,
+            rng.choice(CITIES),
+        ]
+
+
+def message_rows(rng, args, first_id, last_id):
+    end = datetime.combine(args.end, time())
+    span = timedelta(days=365 * YEARS_OF_MESSAGES).total_seconds()
+
+    for message_id in range(first_id, last_id + 1):
+        # Position in time rises with the id, fastest near the end.
+        position = (message_id - 1) / args.messages
+        age = span * (1 - position ** (1 / RECENCY_SKEW))
+
+        yield [
+            sentence(rng),
+            end - timedelta(seconds=age),
+            power_law_rank(rng, args.users),
+        ]
+
+
+def follow_rows(rng, args, first_id, last_id):
+    mean = args.follows / args.users
+
+    def followed(rng):
+        return power_law_rank(rng, args.users)
+
+    for follower_id in range(first_id, last_id + 1):
+        count = heavy_tailed_count(rng, mean, args.users // 2)
+
+        for followed_id in sorted(distinct(rng, count, args.users, followed)):
+            if followed_id != follower_id:
+                yield [followed_id, follower_id]
+
+
+def like_rows(rng, args, first_id, last_id):
+    mean = args.likes / args.users
+
+    def liked(rng):
+        newest_first = int(args.messages * rng.random() ** RECENCY_SKEW)
+        return args.messages - newest_first
+
+    for user_id in range(first_id, last_id + 1):
+        count = heavy_tailed_count(rng, mean, args.messages // 2)
+
+        for message_id in sorted(distinct(rng, count, args.messages, liked)):
+            yield [message_id, user_id]
+
+
+##############################################################################
+# Chunking, in parallel
+
+
+def chunks(name, rows_per_id, total_ids):
+    """Split ids 1..total_ids into chunks of about CHUNK_ROWS rows."""
+
+    ids_per_chunk = max(1, int(CHUNK_ROWS / max(rows_per_id, 1)))
+
+    for index, first_id in enumerate(range(1, total_ids + 1, ids_per_chunk)):
+        last_id = min(first_id + ids_per_chunk - 1, total_ids)
+        yield name, index, first_id, last_id
+
+
+TABLES = {
+    'users': (USERS_CSV_HEADERS, user_rows),
+    'messages': (MESSAGES_CSV_HEADERS, message_rows),
+    'follows': (FOLLOWS_CSV_HEADERS, follow_rows),
+    'likes': (LIKES_CSV_HEADERS, like_rows),
+}
+
+
+def part_path(args, name, index):
+    return os.path.join(args.out, '.parts', f"{name}-{index:06}.csv")
+
+
+def write_part(job):
+    """Write one chunk to its own part file; returns (name, rows)."""
+
+    args, name, index, first_id, last_id = job
+    _, make_rows = TABLES[name]
+
+    rng = random.Random(f"{args.seed}:{name}:{index}")
+    rows = 0
+
+    with open(part_path(args, name, index), 'w', newline='') as f:
+        writer = csv.writer(f)
+
+        for row in make_rows(rng, args, first_id, last_id):
+            writer.writerow(row)
+            rows += 1
+
+    return name, rows
+
+
+def concatenate(args, name, parts):
+    """Join part files, in order, into `<name>.csv` under a header."""
+
+    headers, _ = TABLES[name]
+
+    with open(os.path.join(args.out, f"{name}.csv"), 'w', newline='') as out:
+        csv.writer(out).writerow(headers)
 
-fake = Faker()
+        for index in range(parts):
+            with open(part_path(args, name, index), newline='') as part:
+                shutil.copyfileobj(part, out)
 
-# Generate random profile image URLs to use for users
 
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
+def generate(args):
+    os.makedirs(os.path.join(args.out, '.parts'), exist_ok=True)
 
-# Generate random header image URLs to use for users
+    jobs = [
+        *chunks('users', 1, args.users),
+        *chunks('messages', 1, args.messages),
+        *chunks('follows', args.follows / args.users, args.users),
+        *chunks('likes', args.likes / args.users, args.users if args.likes else 0),
+    ]
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+    counts = dict.fromkeys(TABLES, 0)
+    parts = dict.fromkeys(TABLES, 0)
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
+    with Pool(args.workers) as pool:
+        for name, rows in pool.imap_unordered(
+                write_part, [(args, *job) for job in jobs]):
+            counts[name] += rows
+            parts[name] += 1
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
+    for name in TABLES:
+        concatenate(args, name, parts[name])
+        print(f"{name}.csv: {counts[name]} rows")
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
+    shutil.rmtree(os.path.join(args.out, '.parts'))
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
 
-# Generate follows.csv from random pairings of users
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate CSVs of random data for Warbler.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS)
+    parser.add_argument('--likes', type=int, default=NUM_LIKES)
+    parser.add_argument('--end', type=date.fromisoformat, default=END_DATE,
+                        help='newest message date, YYYY-MM-DD '
+                             f'(default {END_DATE})')
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--out', default=os.path.dirname(os.path.abspath(__file__)))
+    args = parser.parse_args()
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+    generate(args)
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
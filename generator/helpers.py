@@ -1,14 +1,75 @@
-"""Support functions for CSV generation."""
+"""Support functions for CSV generation.
 
-from datetime import datetime
-from random import uniform
+Everything here is offline and driven by the `random.Random` it is
+given, so the same seed always produces the same data.
+"""
 
+import math
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+FIRST_NAMES = """
+    alex amy ana ben carla chris dana dev eli emma finn gina hana ian iris
+    jack jade kai kim leo lia max mia nia noah omar pam quinn raj rosa sam
+    sara tess theo uma val wes xena yara zane
+""".split()
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+LAST_NAMES = """
+    adams baker chen cruz diaz evans fox garcia hill ito jones khan lee
+    lopez martin nguyen ortiz patel quinn reyes smith tanaka usman vega
+    walsh xu young zhang
+""".split()
 
-    return datetime.fromtimestamp(random_timestamp)
+CITIES = """
+    Oakland Portland Austin Denver Boston Chicago Seattle Atlanta Miami
+    Phoenix Detroit Omaha Tulsa Reno Boise Fresno Tucson Madison Raleigh
+""".split()
+
+WORDS = """
+    about after again air all also animal answer any around back bird
+    branch bright call city cloud cold come country day dawn early earth
+    evening every feather field find first flock fly follow food forest
+    friend good great green grow hatch here high home just keep land last
+    late light little live long look make many meadow might morning move
+    much nest never new night north note now old only open other over
+    place plant rain read river road round same say sea season seed
+    should show side sing sky small song sound south spring start still
+    stone story sun summer take tell think tree turn under until up walk
+    warm warble water way weather west while whistle wind wing winter
+    wood word work world year young
+""".split()
+
+IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
+
+HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
+
+# bcrypt hash of "password", shared by every generated user.
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+MAX_WARBLER_LENGTH = 140
+
+
+def power_law_rank(rng, n):
+    """Pick a rank in 1..n with probability roughly proportional to 1/rank,
+    so rank 1 is the most popular. O(1), no tables.
+    """
+
+    return min(int(math.exp(rng.random() * math.log(n + 1))), n)
+
+
+def heavy_tailed_count(rng, mean, cap):
+    """A Pareto-distributed count with the given mean, at most `cap`."""
+
+    alpha = 2.0
+    scale = mean * (alpha - 1) / alpha
+
+    return min(int(scale * rng.paretovariate(alpha)), cap)
+
+
+def sentence(rng, max_length=MAX_WARBLER_LENGTH):
+    """A random sentence of words, trimmed to `max_length` characters."""
+
+    words = rng.choices(WORDS, k=rng.randint(4, 24))
+    return ' '.join(words).capitalize()[:max_length]
@@ -0,0 +1,28 @@
+"""Gunicorn settings for Warbler.
+
+Workers share one metrics directory so that /metrics on any of them
+reports the whole server (see metrics.py), and one password slots
+directory so that the limit on queued bcrypt work is server-wide (see
+passwords.py).
+"""
+
+import os
+import tempfile
+
+os.environ.setdefault('METRICS_DIR',
+                      os.path.join(tempfile.gettempdir(), 'warbler-metrics'))
+os.environ.setdefault('PASSWORD_SLOTS_DIR',
+                      os.path.join(tempfile.gettempdir(),
+                                   'warbler-password-slots'))
+
+
+def on_starting(server):
+    import metrics
+
+    metrics.reset()
+
+
+def child_exit(server, worker):
+    import metrics
+
+    metrics.mark_process_dead(worker.pid)
@@ -0,0 +1,131 @@
+"""HTTP caching policy for Warbler.
+
+Most pages are built for one logged-in user and change all the time, so
+by default responses are `Cache-Control: no-store`. Two kinds are
+cached:
+
+- Message and user pages get an ETag built from what they show: the
+  message, the user's `version` (bumped on every change to them), and
+  who is looking. Browsers and the CDN revalidate on every request
+  (`no-cache`), and the view answers `304 Not Modified` before doing any
+  rendering when nothing has changed.
+
+- Static files are cacheable for `STATIC_MAX_AGE` seconds, or for a
+  year and marked immutable when requested through `static_url()`,
+  whose URLs change whenever the file does. Built assets (assets.py)
+  have the hash in their name and are always immutable.
+"""
+
+from functools import lru_cache
+import hashlib
+import os
+import time
+
+from flask import current_app, g, request, session, url_for
+from sqlalchemy import select
+
+import write_behind
+from models import db, User
+
+DEFAULT_STATIC_MAX_AGE = 3600
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def _viewer():
+    """The parts of a validator that depend on who is looking.
+
+    Pages for logged-in users embed a CSRF token, which expires; the
+    time window makes sure a page is never revalidated past the point
+    where its token would be rejected. Likes and follows still queued in
+    this worker (write_behind.py) haven't bumped `version` yet, so they
+    are counted too.
+
+    The viewer's `version` is read from the database (or from
+    `g.viewer_version`, if the view already has it), not from `g.user`,
+    which may be a cached row that misses other workers' writes.
+    """
+
+    if not g.user:
+        return ('anonymous',)
+
+    version = g.get('viewer_version')
+
+    if version is None:
+        version = g.viewer_version = db.session.execute(
+            select(User.version).where(User.id == g.user.id)).scalar()
+
+    window = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+    return (g.user.id, version, int(time.time() // (window / 2)),
+            write_behind.queue.user_writes(g.user.id))
+
+
+def is_fresh(*parts):
+    """Set this response's ETag from `parts` and the viewer; True if the
+    client already has exactly this page, so the view can return
+    `not_modified()` without rendering.
+    """
+
+    key = repr((parts, _viewer())).encode('UTF-8')
+    g.etag = hashlib.sha1(key).hexdigest()[:20]
+
+    # A pending flash message would change the page.
+    if session.get('_flashes'):
+        return False
+
+    return g.etag in request.if_none_match
+
+
+def not_modified():
+    return '', 304
+
+
+@lru_cache(maxsize=256)
+def _file_version(path, mtime):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+
+def static_url(filename):
+    """URL of a static file that changes whenever the file does."""
+
+    path = os.path.join(current_app.static_folder, filename)
+
+    try:
+        version = _file_version(path, os.stat(path).st_mtime)
+    except OSError:
+        return url_for('static', filename=filename)
+
+    return url_for('static', filename=filename, v=version)
+
+
+def apply_policy(response):
+    """Set the Cache-Control (and ETag) for `response`."""
+
+    etag = g.pop('etag', None)
+
+    if etag is not None:
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+
+        if g.user:
+            response.cache_control.private = True
+        else:
+            response.cache_control.public = True
+
+        response.vary.add('Cookie')
+
+    elif request.endpoint in ('static', 'assets'):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+
+        if 'v' in request.args or request.endpoint == 'assets':
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.max_age = current_app.config.get(
+                'STATIC_MAX_AGE', DEFAULT_STATIC_MAX_AGE)
+
+    else:
+        response.cache_control.no_store = True
+
+    return response
@@ -0,0 +1,385 @@
+"""Background jobs for Warbler.
+
+Heavy maintenance work (reclaiming a deleted account's rows, rebuilding
+timelines, repairing counters) is queued as a row in the `jobs` table
+with `enqueue()`, in the same transaction as whatever asked for it, and
+run by `flask worker` processes (the Procfile's `worker`).
+
+Job functions do one bounded chunk of work per call, so no transaction
+holds its locks for long. A function returns None when it is finished,
+or the keyword arguments to call it with again; the worker commits the
+chunk and the job's new arguments together, so a job resumes from the
+last committed chunk after a crash. Chunks must be safe to redo.
+
+A worker claims a job with a conditional UPDATE, so any number of
+workers can share the queue. A job that raises is retried after
+`JOB_RETRY_DELAY * 2 ** (attempts - 1)` seconds, up to `max_attempts`
+times, then left in the 'failed' state with its traceback. A job whose
+worker died is claimed again once it has been running for
+`JOB_TIMEOUT` seconds.
+"""
+
+from collections import Counter
+from datetime import datetime, timedelta
+import json
+import logging
+import time
+import traceback
+
+from flask import current_app
+from sqlalchemy import and_, delete, or_, select, tuple_, update
+
+import counters
+import fragments
+import metrics
+import search
+import timeline
+from models import db, Follows, Job, Likes, Message, TimelineEntry, User
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_RETRY_DELAY = 10
+DEFAULT_TIMEOUT = 600
+DEFAULT_POLL_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+# job name -> function
+JOBS = {}
+
+
+def job(fn):
+    """Register `fn` as a job, under its name."""
+
+    JOBS[fn.__name__] = fn
+    return fn
+
+
+def enqueue(name, **args):
+    """Queue the job `name` to run with `args`; the caller commits."""
+
+    if name not in JOBS:
+        raise KeyError(f"no such job: {name}")
+
+    job = Job(name=name, args=json.dumps(args))
+    db.session.add(job)
+    return job
+
+
+def chunk_size():
+    return current_app.config.get('JOB_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+
+##############################################################################
+# Running jobs
+
+
+def _claimable(now):
+    stale = now - timedelta(seconds=current_app.config.get(
+        'JOB_TIMEOUT', DEFAULT_TIMEOUT))
+
+    return or_(and_(Job.state == 'queued', Job.run_at <= now),
+               and_(Job.state == 'running', Job.locked_at < stale))
+
+
+def claim():
+    """Claim the next due job for this worker, or return None.
+
+    Candidates are re-checked by the UPDATE that claims them, so two
+    workers never both get the same job.
+    """
+
+    now = datetime.utcnow()
+
+    candidates = db.session.execute(
+        select(Job.id)
+        .where(_claimable(now))
+        .order_by(Job.run_at, Job.id)
+        .limit(10)).scalars().all()
+
+    for job_id in candidates:
+        claimed = db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, _claimable(now))
+            .values(state='running', locked_at=now,
+                    attempts=Job.attempts + 1)
+            .execution_options(synchronize_session=False)).rowcount
+        db.session.commit()
+
+        if claimed:
+            return db.session.get(Job, job_id)
+
+    return None
+
+
+def _failed(job_id, error):
+    """Schedule a retry of a job that raised `error`, or give up on it."""
+
+    job = db.session.get(Job, job_id)
+    job.last_error = error
+    job.locked_at = None
+
+    if job.attempts < job.max_attempts:
+        delay = current_app.config.get('JOB_RETRY_DELAY', DEFAULT_RETRY_DELAY)
+        job.state = 'queued'
+        job.run_at = datetime.utcnow() + timedelta(
+            seconds=delay * 2 ** (job.attempts - 1))
+        outcome = 'retried'
+    else:
+        job.state = 'failed'
+        outcome = 'failed'
+
+    db.session.commit()
+    return outcome
+
+
+def run_one():
+    """Claim and run one chunk of the next due job; returns the job's name,
+    or None if nothing was due.
+    """
+
+    job = claim()
+
+    if job is None:
+        return None
+
+    job_id, name = job.id, job.name
+
+    try:
+        if job.attempts > job.max_attempts:
+            raise RuntimeError(
+                f"gave up after {job.max_attempts} attempts (timed out)")
+
+        again = JOBS[name](**json.loads(job.args))
+
+        if again is None:
+            db.session.delete(job)
+            outcome = 'done'
+        else:
+            job.args = json.dumps(again)
+            job.state = 'queued'
+            job.attempts = 0
+            job.run_at = datetime.utcnow()
+            job.locked_at = None
+            outcome = 'continued'
+
+        db.session.commit()
+
+    except Exception:
+        db.session.rollback()
+        logger.exception("job %s (%s) failed", job_id, name)
+        outcome = _failed(job_id, traceback.format_exc())
+
+    metrics.jobs_total.inc(name=name, outcome=outcome)
+    return name
+
+
+def work(burst=False):
+    """Run jobs until the queue is empty (`burst`) or forever, polling
+    every `JOB_POLL_INTERVAL` seconds when there's nothing due.
+    """
+
+    interval = current_app.config.get('JOB_POLL_INTERVAL',
+                                      DEFAULT_POLL_INTERVAL)
+
+    while True:
+        while run_one() is not None:
+            pass
+
+        if burst:
+            return
+
+        time.sleep(interval)
+
+
+##############################################################################
+# Jobs
+
+
+def _take(query, *columns):
+    """Up to a chunk of rows of `columns` matched by `query`, and a
+    statement deleting them from its table.
+    """
+
+    rows = db.session.execute(query.limit(chunk_size())).all()
+
+    if len(columns) == 1:
+        keys = columns[0].in_([row[0] for row in rows])
+    else:
+        keys = tuple_(*columns).in_([tuple(row) for row in rows])
+
+    return rows, delete(columns[0].table).where(keys)
+
+
+def _delete_likes_by(user_id):
+    """Take away a chunk of `user_id`'s likes, with their messages' counts."""
+
+    rows, statement = _take(
+        select(Likes.message_id, Likes.user_id)
+        .where(Likes.user_id == user_id),
+        Likes.message_id, Likes.user_id)
+
+    if rows:
+        db.session.execute(statement)
+        counters.bump_many(Message, 'likes_count',
+                           {message_id: -1 for message_id, _ in rows})
+
+    return rows
+
+
+def _delete_likes_on_messages_of(user_id):
+    """Take away a chunk of likes on `user_id`'s messages, with their
+    likers' counts.
+    """
+
+    rows, statement = _take(
+        select(Likes.message_id, Likes.user_id)
+        .join(Message, Message.id == Likes.message_id)
+        .where(Message.user_id == user_id),
+        Likes.message_id, Likes.user_id)
+
+    if rows:
+        db.session.execute(statement)
+        counters.bump_many(User, 'likes_count', {
+            liker_id: -count
+            for liker_id, count in Counter(liker for _, liker in rows).items()
+        })
+
+    return rows
+
+
+def _delete_follows_by(user_id):
+    """Take away a chunk of whom `user_id` follows."""
+
+    rows, statement = _take(
+        select(Follows.user_being_followed_id, Follows.user_following_id)
+        .where(Follows.user_following_id == user_id),
+        Follows.user_being_followed_id, Follows.user_following_id)
+
+    if rows:
+        db.session.execute(statement)
+        counters.bump_many(User, 'followers_count',
+                           {followed_id: -1 for followed_id, _ in rows})
+
+    return rows
+
+
+def _delete_followers_of(user_id):
+    """Take away a chunk of `user_id`'s followers."""
+
+    rows, statement = _take(
+        select(Follows.user_following_id, Follows.user_being_followed_id)
+        .where(Follows.user_being_followed_id == user_id),
+        Follows.user_following_id, Follows.user_being_followed_id)
+
+    if rows:
+        db.session.execute(statement)
+        counters.bump_many(User, 'following_count',
+                           {follower_id: -1 for follower_id, _ in rows})
+
+    return rows
+
+
+def _delete_timeline_entries_of(user_id):
+    """Take away a chunk of `user_id`'s timeline, and of their messages
+    in other timelines.
+    """
+
+    rows, statement = _take(
+        select(TimelineEntry.owner_id, TimelineEntry.message_id)
+        .where(or_(TimelineEntry.owner_id == user_id,
+                   TimelineEntry.author_id == user_id)),
+        TimelineEntry.owner_id, TimelineEntry.message_id)
+
+    if rows:
+        db.session.execute(statement)
+
+    return rows
+
+
+def _delete_messages_of(user_id):
+    """Take away a chunk of `user_id`'s messages (the likes on them are
+    already gone).
+    """
+
+    rows, statement = _take(
+        select(Message.id, Message.text).where(Message.user_id == user_id),
+        Message.id)
+
+    for msg in rows:
+        search.unindex_message(msg)
+
+    if rows:
+        db.session.execute(statement)
+
+        for msg in rows:
+            fragments.invalidate_message(msg.id)
+
+    return rows
+
+
+DELETE_USER_STEPS = [
+    _delete_likes_by,
+    _delete_likes_on_messages_of,
+    _delete_follows_by,
+    _delete_followers_of,
+    _delete_timeline_entries_of,
+    _delete_messages_of,
+]
+
+
+@job
+def delete_user(user_id):
+    """Reclaim the rows of a soft-deleted user (see `User.mark_deleted`),
+    a chunk at a time, keeping everyone else's counters right along the
+    way.
+    """
+
+    for step in DELETE_USER_STEPS:
+        if step(user_id):
+            return {'user_id': user_id}
+
+    db.session.execute(delete(User).where(User.id == user_id))
+
+
+def _next_ids(model, after_id, size):
+    return db.session.execute(
+        select(model.id)
+        .where(model.id > after_id)
+        .order_by(model.id)
+        .limit(size)).scalars().all()
+
+
+@job
+def repair_counters(table='users', after_id=0):
+    """Recompute the counters of a chunk of users, then of messages."""
+
+    model, recompute = {
+        'users': (User, counters.recompute_users),
+        'messages': (Message, counters.recompute_messages),
+    }[table]
+
+    ids = _next_ids(model, after_id, chunk_size())
+
+    if ids:
+        recompute(ids[0], ids[-1])
+        return {'table': table, 'after_id': ids[-1]}
+
+    if table == 'users':
+        return {'table': 'messages', 'after_id': 0}
+
+
+@job
+def rebuild_timelines(after_id=0):
+    """Rebuild the materialized timelines of a chunk of users.
+
+    Each rebuild copies up to `TIMELINE_BACKFILL_LIMIT` messages per
+    followed account, so chunks are a twentieth of the usual size.
+    """
+
+    ids = _next_ids(User, after_id, max(1, chunk_size() // 20))
+
+    for user in User.query.filter(User.id.in_(ids)):
+        timeline.rebuild_timeline(user)
+
+    if ids:
+        return {'after_id': ids[-1]}
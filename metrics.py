@@ -0,0 +1,421 @@
+"""Prometheus-style metrics for Warbler, served as text from /metrics.
+
+Gunicorn runs several worker processes and a scrape only reaches one of
+them, so every process writes its samples into its own small mmap'd file
+under `METRICS_DIR`, and /metrics adds up all the files. Counters and
+histograms keep the files of exited workers, so totals never go
+backwards. Gauges (connection pool usage) are dropped when their worker
+exits; gunicorn.conf.py wires that up and clears the directory when
+gunicorn starts.
+
+Without `METRICS_DIR` a private temporary directory is used, which is
+fine for one process (the dev server, tests).
+"""
+
+import json
+import mmap
+import os
+import struct
+import tempfile
+from threading import Lock
+import time
+
+from flask import Response, g, request
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+_INITIAL_FILE_SIZE = 1 << 16
+
+
+##############################################################################
+# Per-process value files
+
+
+class ValueFile:
+    """A file of (key, float) slots, written through mmap.
+
+    Layout: a 4-byte "bytes used" header, then entries of a 4-byte key
+    length, the UTF-8 key padded so the value is 8-byte aligned, and the
+    value as a double.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._positions = {}
+        self._lock = Lock()
+
+        with open(path, 'ab') as f:
+            if f.tell() < _INITIAL_FILE_SIZE:
+                f.truncate(_INITIAL_FILE_SIZE)
+
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._used = struct.unpack_from('<i', self._map, 0)[0] or 8
+
+        for key, _, position in self._entries(self._map, self._used):
+            self._positions[key] = position
+
+    @staticmethod
+    def _entries(data, used):
+        offset = 8
+
+        while offset < used:
+            length = struct.unpack_from('<i', data, offset)[0]
+            key = bytes(data[offset + 4:offset + 4 + length]).decode('UTF-8')
+            offset += 4 + length + (-(4 + length) % 8)
+
+            yield key, struct.unpack_from('<d', data, offset)[0], offset
+            offset += 8
+
+    @classmethod
+    def read(cls, path):
+        """Every (key, value) in the file at `path`."""
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        used = struct.unpack_from('<i', data, 0)[0] if data else 0
+        return [(key, value) for key, value, _ in cls._entries(data, used)]
+
+    def _position(self, key):
+        position = self._positions.get(key)
+
+        if position is None:
+            encoded = key.encode('UTF-8')
+            padding = -(4 + len(encoded)) % 8
+            needed = self._used + 4 + len(encoded) + padding + 8
+
+            if needed > len(self._map):
+                size = len(self._map)
+                while size < needed:
+                    size *= 2
+
+                self._map.close()
+                self._file.truncate(size)
+                self._map = mmap.mmap(self._file.fileno(), 0)
+
+            struct.pack_into(f'<i{len(encoded)}s{padding}x', self._map,
+                             self._used, len(encoded), encoded)
+            position = self._used + 4 + len(encoded) + padding
+
+            self._used = needed
+            struct.pack_into('<i', self._map, 0, self._used)
+            self._positions[key] = position
+
+        return position
+
+    def add(self, key, amount):
+        with self._lock:
+            position = self._position(key)
+            value = struct.unpack_from('<d', self._map, position)[0]
+            struct.pack_into('<d', self._map, position, value + amount)
+
+    def set(self, key, value):
+        with self._lock:
+            struct.pack_into('<d', self._map, self._position(key), value)
+
+
+def metrics_dir():
+    path = os.getenv('METRICS_DIR')
+
+    if path is None:
+        path = os.environ['METRICS_DIR'] = tempfile.mkdtemp(
+            prefix='warbler-metrics-')
+
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+_files = {}
+_files_lock = Lock()
+
+
+def _file(kind):
+    """This process's value file for `kind` ('total' or 'live')."""
+
+    pid = os.getpid()
+
+    with _files_lock:
+        value_file = _files.get((kind, pid))
+
+        if value_file is None:
+            value_file = ValueFile(
+                os.path.join(metrics_dir(), f'{kind}_{pid}.db'))
+            _files[(kind, pid)] = value_file
+
+        return value_file
+
+
+def mark_process_dead(pid):
+    """Forget the gauges of an exited worker."""
+
+    try:
+        os.remove(os.path.join(metrics_dir(), f'live_{pid}.db'))
+    except FileNotFoundError:
+        pass
+
+
+def reset():
+    """Delete every sample; gunicorn calls this on start."""
+
+    path = metrics_dir()
+
+    for name in os.listdir(path):
+        if name.endswith('.db'):
+            os.remove(os.path.join(path, name))
+
+    with _files_lock:
+        _files.clear()
+
+
+##############################################################################
+# Metric types
+
+
+REGISTRY = []
+
+
+def _key(name, labels):
+    return json.dumps([name, labels], sort_keys=True)
+
+
+class Metric:
+    kind = None
+    file_kind = 'total'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def _labels(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}")
+
+        return {name: str(value) for name, value in labels.items()}
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        _file(self.file_kind).add(
+            _key(self.name + '_total', self._labels(labels)), amount)
+
+
+class Gauge(Metric):
+    """A per-process value; /metrics shows the sum over live workers."""
+
+    kind = 'gauge'
+    file_kind = 'live'
+
+    def set(self, value, **labels):
+        _file(self.file_kind).set(_key(self.name, self._labels(labels)), value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        labels = self._labels(labels)
+        values = _file(self.file_kind)
+
+        # Stored per bucket; /metrics makes them cumulative.
+        bucket = next(b for b in self.buckets if value <= b)
+        values.add(_key(self.name + '_bucket',
+                        {**labels, 'le': _format_le(bucket)}), 1)
+        values.add(_key(self.name + '_sum', labels), value)
+        values.add(_key(self.name + '_count', labels), 1)
+
+
+def _format_le(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+##############################################################################
+# Collecting and rendering
+
+
+def collect():
+    """{(sample name, sorted label items): value} summed over every
+    process's files.
+    """
+
+    totals = {}
+    path = metrics_dir()
+
+    for filename in sorted(os.listdir(path)):
+        if not filename.endswith('.db'):
+            continue
+
+        try:
+            entries = ValueFile.read(os.path.join(path, filename))
+        except FileNotFoundError:
+            continue
+
+        for key, value in entries:
+            name, labels = json.loads(key)
+            sample = (name, tuple(sorted(labels.items())))
+            totals[sample] = totals.get(sample, 0) + value
+
+    return totals
+
+
+def _escape(value):
+    return (value.replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        pairs = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+        name = f'{name}{{{pairs}}}'
+
+    return f'{name} {value:g}' if value == int(value) else f'{name} {value!r}'
+
+
+def _cumulative_buckets(metric, samples):
+    """Turn per-bucket counts into Prometheus's cumulative ones."""
+
+    bucket_name = metric.name + '_bucket'
+    series = {}
+
+    for (name, labels), value in samples.items():
+        if name == bucket_name:
+            rest = tuple(item for item in labels if item[0] != 'le')
+            series.setdefault(rest, {})[dict(labels)['le']] = value
+
+    for rest, counts in series.items():
+        running = 0
+
+        for bound in metric.buckets:
+            le = _format_le(bound)
+            running += counts.get(le, 0)
+            samples[(bucket_name, tuple(sorted(rest + (('le', le),))))] = running
+
+
+def _sort_key(sample):
+    """Group a series' samples together, with buckets in `le` order."""
+
+    name, labels = sample
+    rest = tuple(item for item in labels if item[0] != 'le')
+    le = dict(labels).get('le')
+
+    return rest, name, float(le) if le else 0
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+
+    samples = collect()
+    lines = []
+
+    for metric in REGISTRY:
+        if isinstance(metric, Histogram):
+            _cumulative_buckets(metric, samples)
+            names = [metric.name + suffix
+                     for suffix in ('_bucket', '_sum', '_count')]
+        elif isinstance(metric, Counter):
+            names = [metric.name + '_total']
+        else:
+            names = [metric.name]
+
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+
+        for sample in sorted(samples, key=_sort_key):
+            name, labels = sample
+            if name in names:
+                lines.append(_format_sample(name, labels, samples[sample]))
+
+    return '\n'.join(lines) + '\n'
+
+
+##############################################################################
+# Warbler's metrics
+
+
+request_latency = Histogram(
+    'warbler_request_duration_seconds', 'Time spent handling requests.',
+    ['endpoint', 'method'])
+
+requests_total = Counter(
+    'warbler_requests', 'Requests handled, by response status.',
+    ['endpoint', 'method', 'status'])
+
+likes_total = Counter(
+    'warbler_likes', 'Messages liked and unliked.', ['action'])
+
+messages_total = Counter(
+    'warbler_messages_posted', 'Messages posted.')
+
+follows_total = Counter(
+    'warbler_follows', 'Users followed and unfollowed.', ['action'])
+
+write_behind_rows = Counter(
+    'warbler_write_behind_rows',
+    'Likes and follows written by write-behind flushes.', ['kind'])
+
+jobs_total = Counter(
+    'warbler_jobs',
+    'Background job chunks run, by outcome.', ['name', 'outcome'])
+
+password_seconds = Histogram(
+    'warbler_password_hash_seconds',
+    'Time spent on bcrypt, including waiting for the password pool.',
+    ['operation'], buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+
+db_pool_size = Gauge(
+    'warbler_db_pool_size', 'Connections the SQLAlchemy pool keeps open.')
+
+db_pool_checked_out = Gauge(
+    'warbler_db_pool_checked_out', 'Connections currently in use.')
+
+db_pool_overflow = Gauge(
+    'warbler_db_pool_overflow', 'Connections open beyond the pool size.')
+
+
+def record_pool(pool):
+    """Update the pool gauges from `pool`, where it can tell us."""
+
+    for gauge, method in [(db_pool_size, 'size'),
+                          (db_pool_checked_out, 'checkedout'),
+                          (db_pool_overflow, 'overflow')]:
+        if hasattr(pool, method):
+            gauge.set(max(getattr(pool, method)(), 0))
+
+
+def init_app(app, db):
+    """Time every request `app` handles and serve /metrics."""
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_started', None)
+
+        if started is not None:
+            endpoint = request.endpoint or 'none'
+
+            request_latency.observe(time.perf_counter() - started,
+                                    endpoint=endpoint, method=request.method)
+            requests_total.inc(endpoint=endpoint, method=request.method,
+                               status=response.status_code)
+            record_pool(db.engine.pool)
+
+        return response
+
+    @app.get('/metrics')
+    def metrics():
+        """Metrics for every worker, in Prometheus text format."""
+
+        return Response(render(), mimetype='text/plain; version=0.0.4')
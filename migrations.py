@@ -0,0 +1,181 @@
+"""Schema migrations for existing Warbler databases.
+
+`db.create_all()` builds a new database from models.py but leaves tables
+that already exist alone, so columns and indexes added to the models
+later never reach an older database. `flask migrate` applies, in order,
+each migration in `MIGRATIONS` that isn't yet recorded in the
+`schema_migrations` table. Migrations check what is already there, so
+they are also safe on a database made by `create_all()`.
+
+On Postgres, indexes are built with CREATE INDEX CONCURRENTLY, so the
+tables stay writable while they build.
+
+Data migrations (filling in new counters) run through the app's session,
+a chunk per transaction, so `flask migrate` needs the app's own database.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import (Column, DateTime, MetaData, String, Table, inspect,
+                        insert, select)
+from sqlalchemy.schema import CreateColumn
+
+import jobs
+from models import db, Job, POSTGRES_SEARCH_INDEXES, SQLITE_MESSAGES_FTS
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('name', String(100), primary_key=True),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+# Indexes for the hot read paths: a user's messages by time, a user's
+# likes, and whom a user follows.
+HOT_PATH_INDEXES = [
+    'ix_messages_user_id_timestamp',
+    'ix_likes_user_id',
+    'ix_follows_user_following_id',
+]
+
+
+def add_missing_columns(engine):
+    """Create missing tables and add missing columns (every column added
+    after the first release has a server default).
+    """
+
+    db.metadata.create_all(engine)
+    inspector = inspect(engine)
+
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name']
+                        for column in inspector.get_columns(table.name)}
+
+            for column in table.columns:
+                if column.name not in existing:
+                    spec = CreateColumn(column).compile(dialect=engine.dialect)
+                    conn.exec_driver_sql(
+                        f"ALTER TABLE {table.name} ADD COLUMN {spec}")
+
+
+def _index(name):
+    for table in db.metadata.tables.values():
+        for index in table.indexes:
+            if index.name == name:
+                return index
+
+    raise KeyError(name)
+
+
+def create_indexes(engine, names):
+    """Create the models' indexes called `names`, if they don't exist."""
+
+    concurrently = ' CONCURRENTLY' if engine.dialect.name == 'postgresql' else ''
+
+    with engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as conn:
+        for name in names:
+            index = _index(name)
+            columns = ', '.join(column.name for column in index.columns)
+
+            conn.exec_driver_sql(
+                f"CREATE INDEX{concurrently} IF NOT EXISTS {name} "
+                f"ON {index.table.name} ({columns})")
+
+
+def create_hot_path_indexes(engine):
+    create_indexes(engine, HOT_PATH_INDEXES)
+
+
+def create_jobs_table(engine):
+    Job.__table__.create(engine, checkfirst=True)
+
+
+def extend_timeline_index(engine):
+    """Replace the (owner_id, timestamp) timeline index with one that
+    also covers message_id, the keyset tiebreaker.
+    """
+
+    create_indexes(engine, ['ix_timeline_entries_owner_id_timestamp'])
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            "DROP INDEX IF EXISTS ix_timeline_entries_owner_timestamp")
+
+
+def create_search_indexes(engine):
+    """The search indexes that models.py only makes with a new table:
+    trigram and full-text indexes on Postgres, and on SQLite the
+    `messages_fts` table, filled from the messages already there.
+    """
+
+    dialect = engine.dialect.name
+
+    with engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as conn:
+        if dialect == 'postgresql':
+            conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+            for _, statement in POSTGRES_SEARCH_INDEXES.values():
+                conn.exec_driver_sql(statement.replace(
+                    "CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1))
+
+        elif dialect == 'sqlite':
+            if not inspect(conn).has_table('messages_fts'):
+                conn.exec_driver_sql(SQLITE_MESSAGES_FTS)
+                conn.exec_driver_sql(
+                    "INSERT INTO messages_fts (messages_fts) "
+                    "VALUES ('rebuild')")
+
+
+def recompute_counters(engine):
+    """Fill in the counters added by 0001 (as zeroes), a chunk of rows
+    per transaction, as the `repair_counters` job does.
+    """
+
+    args = {}
+
+    while args is not None:
+        args = jobs.repair_counters(**args)
+        db.session.commit()
+
+
+MIGRATIONS = [
+    ('0001_missing_columns', add_missing_columns),
+    ('0002_hot_path_indexes', create_hot_path_indexes),
+    ('0003_timeline_index_message_id', extend_timeline_index),
+    ('0004_search_indexes', create_search_indexes),
+    ('0005_recompute_counters', recompute_counters),
+    ('0006_jobs_table', create_jobs_table),
+    ('0007_users_deleted_at', add_missing_columns),
+]
+
+
+def applied(engine):
+    """Names of the migrations already applied to `engine`'s database."""
+
+    schema_migrations.create(engine, checkfirst=True)
+
+    with engine.connect() as conn:
+        return set(conn.execute(select(schema_migrations.c.name)).scalars())
+
+
+def migrate(engine):
+    """Apply every pending migration; returns their names."""
+
+    done = applied(engine)
+    ran = []
+
+    for name, migration in MIGRATIONS:
+        if name in done:
+            continue
+
+        migration(engine)
+
+        with engine.begin() as conn:
+            conn.execute(insert(schema_migrations).values(
+                name=name, applied_at=datetime.utcnow()))
+
+        ran.append(name)
+
+    return ran
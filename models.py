@@ -2,11 +2,13 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects import postgresql, sqlite
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+import passwords
+import replicas
+
+db = replicas.RoutingSQLAlchemy()
 
 DEFAULT_PROFILE_IMAGE = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE = "/static/images/warbler-hero.jpg"
@@ -29,6 +31,13 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key serves "who follows X"; this serves "whom does X
+    # follow" (home timeline, following pages) without a table scan.
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -75,6 +84,51 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counters, maintained by counters.py.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever anything shown on the user's pages changes; HTTP
+    # validators are built from it (see http_cache.py).
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # Set when the account is deleted. The account is hidden from then
+    # on; its rows are reclaimed later by the `delete_user` job.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message', order_by='Message.timestamp.desc()')
 
     followers = db.relationship(
@@ -104,32 +158,44 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.query.get((self.id, other_user.id)) is not None
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.query.get((other_user.id, self.id)) is not None
 
-    def is_liked(self, message_id):
-        """Checks if message is liked or not liked by user"""
+    def liked_message_ids(self, message_ids):
+        """Which of `message_ids` has this user liked?
 
-        is_liked = Likes.query.filter(
-            Likes.message_id == message_id and 
-            Likes.user_id == self.id).one_or_none()
+        One query for a whole page of messages; returns a set so templates
+        can check each message in O(1).
+        """
 
-        if is_liked is None:
-            return False
-        else:
-            return True
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(Likes.message_id)
+                .filter(Likes.user_id == self.id,
+                        Likes.message_id.in_(message_ids)))
+
+        return {message_id for (message_id,) in rows}
 
     def is_author(self, message_id):
         """Checks if user is the author of the post"""
 
         return Message.query.filter_by(id=message_id).one().user_id == self.id
 
+    def mark_deleted(self):
+        """Soft-delete this account, freeing its username and email for
+        new signups. The caller commits and queues the `delete_user` job.
+        """
+
+        self.deleted_at = datetime.utcnow()
+        self.username = f"deleted:{self.id}"
+        self.email = f"deleted:{self.id}"
+
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
@@ -137,7 +203,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash_password(password)
 
         user = User(
             username=username,
@@ -158,13 +224,19 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A hash made with an outdated work factor is replaced on success;
+        the caller commits.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check_password(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash_password(password)
+
                 return user
 
         return False
@@ -197,8 +269,22 @@ class Message(db.Model):
         nullable=False,
     )
 
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    # A user's messages newest first (profiles, home timeline), matching
+    # the (timestamp, id) order of keyset pagination.
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp',
+                 'user_id', 'timestamp', 'id'),
+    )
+
 
 class Likes(db.Model):
     """Liked messsages."""
@@ -217,6 +303,179 @@ class Likes(db.Model):
         primary_key=True,
     )
 
+    # The primary key serves a message's likers; this serves a user's
+    # likes (liked pages, like stars).
+    __table_args__ = (
+        db.Index('ix_likes_user_id', 'user_id', 'message_id'),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into one user's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    owner_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    # An owner's timeline newest first, with the message ids it reads.
+    __table_args__ = (
+        db.Index('ix_timeline_entries_owner_id_timestamp',
+                 'owner_id', 'timestamp', 'message_id'),
+    )
+
+
+class Job(db.Model):
+    """A queued unit of background work (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # Keyword arguments for the job's function, as JSON.
+    args = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    # 'queued', 'running' or 'failed'; finished jobs are deleted.
+    state = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    # Workers look for the next due job by state and time.
+    __table_args__ = (
+        db.Index('ix_jobs_state_run_at', 'state', 'run_at'),
+    )
+
+
+# Search indexes (search.py). On Postgres, trigram indexes let user search
+# use LIKE '%term%' without a table scan (they need the pg_trgm extension),
+# and a GIN index over to_tsvector serves message full-text search. SQLite
+# gets an FTS5 table for messages instead, kept in step by hand.
+
+POSTGRES_SEARCH_INDEXES = {
+    'ix_users_username_trgm': (
+        User.__table__,
+        "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+        "ON users USING gin (lower(username) gin_trgm_ops)",
+    ),
+    'ix_users_location_trgm': (
+        User.__table__,
+        "CREATE INDEX IF NOT EXISTS ix_users_location_trgm "
+        "ON users USING gin (lower(location) gin_trgm_ops)",
+    ),
+    'ix_messages_text_fts': (
+        Message.__table__,
+        "CREATE INDEX IF NOT EXISTS ix_messages_text_fts "
+        "ON messages USING gin (to_tsvector('english', text))",
+    ),
+}
+
+event.listen(
+    db.metadata,
+    'before_create',
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    .execute_if(dialect='postgresql'),
+)
+
+for table, statement in POSTGRES_SEARCH_INDEXES.values():
+    event.listen(
+        table,
+        'after_create',
+        DDL(statement).execute_if(dialect='postgresql'),
+    )
+
+SQLITE_MESSAGES_FTS = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+    "USING fts5(text, content='messages', content_rowid='id')")
+
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL(SQLITE_MESSAGES_FTS).execute_if(dialect='sqlite'),
+)
+
+event.listen(
+    Message.__table__,
+    'before_drop',
+    DDL("DROP TABLE IF EXISTS messages_fts")
+    .execute_if(dialect='sqlite'),
+)
+
+
+def insert_ignoring_duplicates(model):
+    """An INSERT into `model` that skips rows whose key is already there
+    (ON CONFLICT DO NOTHING); its rowcount is the rows really added.
+    """
+
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        return postgresql.insert(model).on_conflict_do_nothing()
+
+    if dialect == 'sqlite':
+        return sqlite.insert(model).on_conflict_do_nothing()
+
+    raise NotImplementedError(f"no INSERT ... ON CONFLICT for {dialect}")
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
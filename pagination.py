@@ -0,0 +1,74 @@
+"""Keyset (cursor) pagination for message lists.
+
+Lists are ordered newest first by `(timestamp, id)`. A page asks for
+rows strictly before the last row of the previous page, so the database
+seeks straight to the right spot in the index and deep pages cost the
+same as the first one (no OFFSET).
+"""
+
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import tuple_
+from werkzeug.exceptions import BadRequest
+
+from models import Message
+
+MESSAGES_PER_PAGE = 50
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def encode_cursor(timestamp, id):
+    """Opaque-ish cursor string for the row at (timestamp, id)."""
+
+    return f"{timestamp.isoformat()}_{id}"
+
+
+def decode_cursor(cursor):
+    """Turn a `?before=` cursor back into a (timestamp, id) pair.
+
+    Returns None for a missing cursor; raises BadRequest for garbage.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        timestamp, id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(timestamp), int(id)
+
+    except ValueError:
+        raise BadRequest("Invalid cursor")
+
+
+def before(query, timestamp_col, id_col, cursor):
+    """Restrict `query` to rows older than `cursor` and order it newest
+    first. `cursor` is a decoded (timestamp, id) pair or None.
+    """
+
+    if cursor:
+        query = query.where(tuple_(timestamp_col, id_col) < tuple_(*cursor))
+
+    return query.order_by(timestamp_col.desc(), id_col.desc())
+
+
+def paginate(items, per_page):
+    """Split `per_page + 1` fetched messages into a Page.
+
+    The extra row only tells us whether there is another page.
+    """
+
+    if len(items) <= per_page:
+        return Page(items, None)
+
+    last = items[per_page - 1]
+    return Page(items[:per_page], encode_cursor(last.timestamp, last.id))
+
+
+def keyset_page(query, cursor, per_page=MESSAGES_PER_PAGE):
+    """Fetch one page of a Message query, newest first."""
+
+    query = before(query, Message.timestamp, Message.id, cursor)
+
+    return paginate(query.limit(per_page + 1).all(), per_page)
@@ -0,0 +1,226 @@
+"""Password hashing for Warbler, off the request thread.
+
+bcrypt is deliberately slow, so a burst of logins or signups used to pin
+every web worker's CPU. Hashing and checking now run in a small process
+pool (per web worker, started on first use) of `PASSWORD_POOL_WORKERS`
+processes, by default the CPUs divided among the `WEB_CONCURRENCY` web
+workers, so the whole server runs about one bcrypt per core.
+
+At most `PASSWORD_POOL_MAX_PENDING` jobs may be queued or running at
+once across the whole server; past that, requests are turned away
+straight away with a 503 instead of piling up behind each other. The
+limit is kept with one lock file per slot under `PASSWORD_SLOTS_DIR`,
+which gunicorn.conf.py shares between workers (without it, each process
+gets a private directory and its own limit). A worker that dies
+mid-hash gives its slot back with its file locks.
+
+The bcrypt work factor comes from `BCRYPT_LOG_ROUNDS`. Hashes made with
+a different cost are upgraded on the next successful login.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import fcntl
+import multiprocessing
+import os
+import tempfile
+from threading import Lock
+import time
+
+import bcrypt
+from flask import current_app, has_app_context
+from werkzeug.exceptions import ServiceUnavailable
+
+import metrics
+
+DEFAULT_LOG_ROUNDS = 12
+
+
+class PasswordHasherBusy(ServiceUnavailable):
+    """Too many password hashes are already queued."""
+
+    description = "Too many logins right now, please try again shortly."
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+def slots_dir():
+    path = os.getenv('PASSWORD_SLOTS_DIR')
+
+    if path is None:
+        path = os.environ['PASSWORD_SLOTS_DIR'] = tempfile.mkdtemp(
+            prefix='warbler-password-slots-')
+
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class Slots:
+    """At most `count` holders at once, across every process (and thread)
+    using the directory `path`.
+
+    Each slot is a file; holding a slot is holding an exclusive `flock`
+    on it, which the kernel drops if the holder dies.
+    """
+
+    def __init__(self, path, count):
+        self.paths = [os.path.join(path, f'slot-{i}.lock')
+                      for i in range(count)]
+
+    def acquire(self):
+        """Take a free slot; returns its file descriptor, or None."""
+
+        for path in self.paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+
+        return None
+
+    def release(self, fd):
+        os.close(fd)
+
+
+class PasswordPool:
+    """A bounded process pool for bcrypt work.
+
+    With `workers=0` the work runs inline, which is what tests use.
+    """
+
+    def __init__(self, workers, max_pending, path=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._slots = Slots(path or tempfile.mkdtemp(
+            prefix='warbler-password-slots-'), max_pending)
+        self._lock = Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Spawn, not fork: a forked child would inherit the web
+                # worker's database sockets.
+                self._executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+
+            return self._executor
+
+    def run(self, fn, *args):
+        """Run `fn(*args)` in the pool and wait for the result.
+
+        Raises PasswordHasherBusy if the pool is already full.
+        """
+
+        slot = self._slots.acquire()
+
+        if slot is None:
+            raise PasswordHasherBusy()
+
+        try:
+            if not self.workers:
+                return fn(*args)
+
+            return self._get_executor().submit(fn, *args).result()
+
+        finally:
+            self._slots.release(slot)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+def _config(key, default):
+    """App config value, or `default` outside an app context."""
+
+    if has_app_context():
+        return current_app.config.get(key, default)
+
+    return default
+
+
+def default_workers():
+    """This web worker's share of the CPUs, at least one."""
+
+    return max(1, (os.cpu_count() or 1)
+               // int(os.getenv('WEB_CONCURRENCY', 1)))
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_pool():
+    """This worker's password pool, created from app config on first use."""
+
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            workers = _config('PASSWORD_POOL_WORKERS', default_workers())
+            max_pending = _config('PASSWORD_POOL_MAX_PENDING',
+                                  (os.cpu_count() or 1) * 4)
+
+            _pool = PasswordPool(workers, max_pending, slots_dir())
+
+        return _pool
+
+
+def log_rounds():
+    """The configured bcrypt work factor."""
+
+    return _config('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+
+
+def hash_password(password):
+    """Hash `password` at the configured cost; returns a str."""
+
+    started = time.perf_counter()
+    hashed = get_pool().run(_hash, password.encode('UTF-8'), log_rounds())
+    metrics.password_seconds.observe(time.perf_counter() - started,
+                                     operation='hash')
+
+    return hashed.decode('UTF-8')
+
+
+def check_password(hashed, password):
+    """Does `password` match the bcrypt `hashed`?"""
+
+    try:
+        hashed = hashed.encode('UTF-8')
+    except AttributeError:
+        pass
+
+    started = time.perf_counter()
+
+    try:
+        return get_pool().run(_check, password.encode('UTF-8'), hashed)
+    except ValueError:
+        # Not a bcrypt hash at all.
+        return False
+    finally:
+        metrics.password_seconds.observe(time.perf_counter() - started,
+                                         operation='check')
+
+
+def needs_rehash(hashed):
+    """Was `hashed` made with a different cost than the configured one?"""
+
+    try:
+        cost = int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+
+    return cost != log_rounds()
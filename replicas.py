@@ -0,0 +1,167 @@
+"""Read-replica routing for Warbler.
+
+Replicas are listed in `REPLICA_DATABASE_URLS` (comma-separated) and
+become the `replica_0`, `replica_1`, ... binds. During GET and HEAD
+requests, SELECTs go to one healthy replica, picked per request; all
+writes, anything run while flushing and everything outside of GET
+requests (POSTs, CLI commands, background threads) use the primary.
+
+Replicas lag behind, so a user who has just written is pinned to the
+primary for `REPLICA_PIN_SECONDS`, through a timestamp in their session
+cookie; a request that writes anything reads from the primary for the
+rest of the request too.
+
+A replica that raises a connection error is skipped for
+`REPLICA_RETRY_SECONDS`, and the read that hit the error is retried once
+on another healthy replica or the primary; with no healthy replica left,
+reads go to the primary.
+"""
+
+import random
+import time
+from weakref import WeakSet
+
+from flask import g, has_request_context, request, session as flask_session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.exc import OperationalError
+
+PREFIX = 'replica_'
+PIN_KEY = 'primary_until'
+
+DEFAULT_PIN_SECONDS = 5
+DEFAULT_RETRY_SECONDS = 30
+
+READ_METHODS = ('GET', 'HEAD')
+
+# bind key -> time.monotonic() until which it is skipped
+_unhealthy = {}
+
+
+def binds(urls):
+    """SQLALCHEMY_BINDS entries for replica `urls`."""
+
+    return {f'{PREFIX}{i}': url for i, url in enumerate(urls)}
+
+
+def replica_keys(app):
+    return sorted(key for key in app.config.get('SQLALCHEMY_BINDS') or {}
+                  if key.startswith(PREFIX))
+
+
+def is_healthy(key):
+    return _unhealthy.get(key, 0) <= time.monotonic()
+
+
+def mark_unhealthy(key, app):
+    _unhealthy[key] = time.monotonic() + app.config.get(
+        'REPLICA_RETRY_SECONDS', DEFAULT_RETRY_SECONDS)
+
+
+_watched = WeakSet()
+
+
+def _watch(engine, key, app):
+    """Mark `key` unhealthy when its engine can't reach the database."""
+
+    if engine in _watched:
+        return
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception,
+                                               OperationalError):
+            mark_unhealthy(key, app)
+
+    _watched.add(engine)
+
+
+def _reads_from_replica():
+    """May this request's SELECTs go to a replica?"""
+
+    return (has_request_context()
+            and request.method in READ_METHODS
+            and not g.get('wrote_to_primary')
+            and flask_session.get(PIN_KEY, 0) < time.time())
+
+
+class RoutingSession(SignallingSession):
+    """A session that sends GET requests' SELECTs to a replica."""
+
+    def execute(self, statement, *args, **kwargs):
+        """Execute `statement`; a read that fails on a replica with a
+        connection error is retried once, with the replica skipped.
+        """
+
+        if not has_request_context():
+            return super().execute(statement, *args, **kwargs)
+
+        g.pop('read_from', None)
+
+        try:
+            return super().execute(statement, *args, **kwargs)
+
+        except OperationalError:
+            key = g.pop('read_from', None)
+
+            if key is None:
+                raise
+
+            mark_unhealthy(key, self.app)
+            g.pop('replica_key', None)
+
+            return super().execute(statement, *args, **kwargs)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        reading = not self._flushing and getattr(clause, 'is_select', False)
+
+        if reading and _reads_from_replica():
+            engine = self._replica()
+            if engine is not None:
+                g.read_from = g.replica_key
+                return engine
+
+        if (not reading and has_request_context()
+                and replica_keys(self.app)):
+            g.wrote_to_primary = True
+
+        return super().get_bind(mapper, clause)
+
+    def _replica(self):
+        """This request's replica engine, or None for the primary."""
+
+        key = g.get('replica_key')
+
+        if key is None or not is_healthy(key):
+            healthy = [key for key in replica_keys(self.app)
+                       if is_healthy(key)]
+
+            if not healthy:
+                return None
+
+            key = g.replica_key = random.choice(healthy)
+
+        db = get_state(self.app).db
+        engine = db.get_engine(self.app, bind=key)
+        _watch(engine, key, self.app)
+
+        return engine
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with `RoutingSession` sessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def init_app(app):
+    """Pin users who wrote to the primary for a few seconds."""
+
+    @app.after_request
+    def pin_writers_to_primary(response):
+        if g.pop('wrote_to_primary', False):
+            flask_session[PIN_KEY] = time.time() + app.config.get(
+                'REPLICA_PIN_SECONDS', DEFAULT_PIN_SECONDS)
+
+        return response
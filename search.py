@@ -0,0 +1,242 @@
+"""User and message search for Warbler.
+
+Users
+-----
+
+On Postgres, usernames and locations are covered by `pg_trgm` GIN
+indexes (see models.py), which serve `LIKE '%term%'` without a table
+scan and let us rank by trigram similarity. Other databases fall back to
+a plain LIKE with the same ranking minus similarity.
+
+Results are ranked exact username match first, then username prefix,
+then any other username match, then location matches, and capped at
+`MAX_RESULTS` so no search can page through the whole table.
+
+Messages
+--------
+
+Message text is full-text indexed. Postgres uses a GIN index on
+`to_tsvector('english', text)`, which the database keeps current by
+itself. SQLite (tests, local runs) uses an external-content FTS5 table,
+`messages_fts`, that `index_message` / `unindex_message` keep in step
+from the message write routes. Results are ranked (ts_rank / bm25) and
+paginated with a `(score, id)` cursor.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import (Float, case, cast, func, literal_column, or_, select,
+                        text, tuple_)
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import BadRequest
+
+from models import db, Message, User
+from pagination import Page
+
+USERS_PER_PAGE = 24
+MESSAGES_PER_PAGE = 20
+MAX_RESULTS = 240
+MAX_TERM_LENGTH = 50
+
+SearchPage = namedtuple('SearchPage', ['users', 'page', 'has_next'])
+
+
+def escape_like(term):
+    """Escape LIKE wildcards in user input."""
+
+    return (term
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def search_users(term, page=1, per_page=USERS_PER_PAGE):
+    """Return one page of users matching `term`, best matches first."""
+
+    term = term.strip().lower()[:MAX_TERM_LENGTH]
+    page = max(page, 1)
+
+    offset = (page - 1) * per_page
+    limit = min(per_page, MAX_RESULTS - offset)
+
+    if limit <= 0:
+        return SearchPage([], page, False)
+
+    username = func.lower(User.username)
+    location = func.lower(User.location)
+
+    escaped = escape_like(term)
+    contains = f"%{escaped}%"
+    prefix = f"{escaped}%"
+
+    rank = case(
+        (username == term, 3),
+        (username.like(prefix, escape='\\'), 2),
+        (username.like(contains, escape='\\'), 1),
+        else_=0,
+    )
+
+    ordering = [rank.desc()]
+
+    if db.engine.dialect.name == 'postgresql':
+        ordering.append(func.similarity(username, term).desc())
+
+    ordering.append(User.username)
+
+    users = (User.query
+             .filter(User.deleted_at.is_(None),
+                     or_(username.like(contains, escape='\\'),
+                         location.like(contains, escape='\\')))
+             .order_by(*ordering)
+             .offset(offset)
+             .limit(limit + 1)
+             .all())
+
+    has_next = len(users) > limit and offset + limit < MAX_RESULTS
+
+    return SearchPage(users[:limit], page, has_next)
+
+
+def list_users_query(after=None, per_page=USERS_PER_PAGE):
+    """SELECT for one page of all users ordered by username, starting
+    after the username `after` (keyset pagination over the username
+    index), plus one row to tell whether there is a next page.
+    """
+
+    query = select(User).where(User.deleted_at.is_(None))
+
+    if after:
+        query = query.where(User.username > after)
+
+    return query.order_by(User.username).limit(per_page + 1)
+
+
+def list_users(after=None, per_page=USERS_PER_PAGE):
+    """Return one page of all users by username, and whether there is
+    another page.
+    """
+
+    users = db.session.execute(
+        list_users_query(after, per_page)).scalars().all()
+
+    return users[:per_page], len(users) > per_page
+
+
+def _dialect():
+    return db.engine.dialect.name
+
+
+def index_message(msg):
+    """Add a new (flushed) message to the full-text index."""
+
+    if _dialect() == 'sqlite':
+        db.session.execute(
+            text("INSERT INTO messages_fts (rowid, text) VALUES (:id, :text)"),
+            {'id': msg.id, 'text': msg.text})
+
+
+def unindex_message(msg):
+    """Remove a message that is about to be deleted from the index."""
+
+    if _dialect() == 'sqlite':
+        db.session.execute(
+            text("INSERT INTO messages_fts (messages_fts, rowid, text) "
+                 "VALUES ('delete', :id, :text)"),
+            {'id': msg.id, 'text': msg.text})
+
+
+def rebuild_message_index():
+    """Re-index every message, e.g. after a bulk load."""
+
+    if _dialect() == 'sqlite':
+        db.session.execute(
+            text("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"))
+
+
+def encode_score_cursor(score, id):
+    """Cursor for the search hit at (score, id)."""
+
+    return f"{score!r}_{id}"
+
+
+def decode_score_cursor(cursor):
+    """Turn a search `?before=` cursor back into a (score, id) pair."""
+
+    if not cursor:
+        return None
+
+    try:
+        score, id = cursor.rsplit('_', 1)
+        return float(score), int(id)
+
+    except ValueError:
+        raise BadRequest("Invalid cursor")
+
+
+def _fts5_query(term):
+    """Quote each word so user input can't trip FTS5 query syntax."""
+
+    return ' '.join('"' + word.replace('"', '""') + '"'
+                    for word in term.split())
+
+
+def _message_hits(term):
+    """Subquery of (id, score) for messages matching `term`; higher score
+    is a better match.
+    """
+
+    if _dialect() == 'postgresql':
+        vector = func.to_tsvector('english', Message.text)
+        query = func.websearch_to_tsquery('english', term)
+
+        # ts_rank is a float4; as a double, the score in the cursor and
+        # the score it is compared with are the same value.
+        return (select(Message.id.label('id'),
+                       cast(func.ts_rank(vector, query), Float(53))
+                       .label('score'))
+                .where(vector.op('@@')(query))
+                .subquery())
+
+    return (select(literal_column('rowid').label('id'),
+                   (-func.bm25(literal_column('messages_fts'))).label('score'))
+            .select_from(text('messages_fts'))
+            .where(text('messages_fts MATCH :match')
+                   .bindparams(match=_fts5_query(term)))
+            .subquery())
+
+
+def search_messages(term, cursor=None, per_page=MESSAGES_PER_PAGE):
+    """Return a Page of messages matching `term`, best matches first,
+    after the decoded (score, id) `cursor`.
+    """
+
+    term = term.strip()[:MAX_TERM_LENGTH]
+
+    if not term.split():
+        return Page([], None)
+
+    hits = _message_hits(term)
+    query = select(hits.c.id, hits.c.score)
+
+    if cursor:
+        query = query.where(tuple_(hits.c.score, hits.c.id) < tuple_(*cursor))
+
+    rows = db.session.execute(
+        query
+        .order_by(hits.c.score.desc(), hits.c.id.desc())
+        .limit(per_page + 1)).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_score_cursor(rows[-1].score, rows[-1].id)
+
+    messages = (Message.query
+                .filter(Message.id.in_([row.id for row in rows]),
+                        Message.user.has(User.deleted_at.is_(None)))
+                .options(joinedload(Message.user))
+                .all())
+    by_id = {msg.id: msg for msg in messages}
+
+    return Page([by_id[row.id] for row in rows if row.id in by_id],
+                next_cursor)
@@ -0,0 +1,184 @@
+"""Per-request SQL instrumentation.
+
+Every statement run while handling a request is counted and timed from
+SQLAlchemy engine events. Each response gets the totals as headers:
+
+    X-SQL-Queries: 12
+    Server-Timing: db;dur=4.1;desc="12 queries"
+
+(turn these off with `SQL_STATS_HEADERS = False`), and a log line with
+the same numbers as fields.
+
+Statements are also fingerprinted, with literals and IN-lists collapsed,
+so that one query repeated per row (the classic N+1 from a lazy
+relationship in a template loop) shows up as a warning naming the
+statement.
+
+Routes have a query budget: `SQL_QUERY_BUDGET` for all of them, or
+`@query_budget(n)` for one view. Going over logs a warning, or raises
+QueryBudgetExceeded when `SQL_QUERY_BUDGET_STRICT` is set, as the tests
+do.
+"""
+
+from collections import Counter
+import re
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_QUERY_BUDGET = 50
+DEFAULT_REPEAT_THRESHOLD = 10
+
+_IN_LIST = re.compile(r"\(\s*(?:\?|%s|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%s|%\(\w+\)s|:\w+))*\s*\)")
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAM_NAME = re.compile(r"%\((\w+?)(?:_\d+)*\)s")
+_SPACE = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A request ran more SQL statements than its budget allows."""
+
+
+def fingerprint(statement):
+    """`statement` with literals, parameter lists and whitespace
+    normalised, so the same query with different values compares equal.
+    """
+
+    statement = _PARAM_NAME.sub(r"%(\1)s", statement)
+    statement = _IN_LIST.sub("(?)", statement)
+    statement = _LITERAL.sub("?", statement)
+
+    return _SPACE.sub(" ", statement).strip()
+
+
+class RequestStats:
+    """SQL statements run during one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.fingerprints = Counter()
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.fingerprints[fingerprint(statement)] += 1
+
+    def repeated(self, threshold):
+        """(fingerprint, times) for statements run at least `threshold`
+        times, most repeated first.
+        """
+
+        return [(statement, times)
+                for statement, times in self.fingerprints.most_common()
+                if times >= threshold]
+
+
+def current_stats():
+    """The stats for the request being handled, if any."""
+
+    if has_request_context():
+        return g.get('sql_stats')
+
+    return None
+
+
+def query_budget(limit):
+    """Give one view its own query budget."""
+
+    def decorate(view):
+        view.query_budget = limit
+        return view
+
+    return decorate
+
+
+##############################################################################
+# Engine events
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('sql_stats_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['sql_stats_started'].pop()
+    stats = current_stats()
+
+    if stats is not None:
+        stats.record(statement, time.perf_counter() - started)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _drop_timer(context):
+    if context.connection is not None:
+        started = context.connection.info.get('sql_stats_started')
+
+        if started:
+            started.pop()
+
+
+##############################################################################
+# Flask hooks
+
+
+def _budget_for(app):
+    view = app.view_functions.get(request.endpoint)
+    budget = getattr(view, 'query_budget', None)
+
+    if budget is None:
+        budget = app.config.get('SQL_QUERY_BUDGET', DEFAULT_QUERY_BUDGET)
+
+    return budget
+
+
+def init_app(app):
+    """Instrument every request `app` handles."""
+
+    @app.before_request
+    def start_sql_stats():
+        g.sql_stats = RequestStats()
+
+    @app.after_request
+    def report_sql_stats(response):
+        stats = g.pop('sql_stats', None)
+
+        if stats is None:
+            return response
+
+        ms = stats.seconds * 1000
+
+        if app.config.get('SQL_STATS_HEADERS', True):
+            response.headers['X-SQL-Queries'] = str(stats.count)
+            response.headers.add(
+                'Server-Timing', f'db;dur={ms:.1f};desc="{stats.count} queries"')
+
+        route = f"{request.method} {request.path}"
+        app.logger.debug(
+            "%s: %d queries in %.1fms", route, stats.count, ms,
+            extra={'sql_queries': stats.count, 'sql_ms': round(ms, 1),
+                   'endpoint': request.endpoint})
+
+        threshold = app.config.get('SQL_REPEAT_THRESHOLD',
+                                   DEFAULT_REPEAT_THRESHOLD)
+
+        for statement, times in stats.repeated(threshold):
+            app.logger.warning("%s: possible N+1, ran %d times: %s",
+                               route, times, statement)
+
+        budget = _budget_for(app)
+
+        if budget is not None and stats.count > budget:
+            message = (f"{route} ran {stats.count} queries, "
+                       f"over its budget of {budget}")
+
+            if app.config.get('SQL_QUERY_BUDGET_STRICT'):
+                raise QueryBudgetExceeded(message)
+
+            app.logger.warning(message)
+
+        return response
@@ -0,0 +1,203 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Follows, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import counters
+import follow_graph
+import search
+import timeline
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['SQL_QUERY_BUDGET_STRICT'] = True
+
+
+class APITestCase(TestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        self.u1 = User.signup("u1", "u1@test.com", "password", None)
+        self.u2 = User.signup("u2", "u2@test.com", "password", None)
+        self.u3 = User.signup("u3", "u3@test.com", "password", None)
+        db.session.flush()
+
+        self.u1.following.append(self.u2)
+
+        for i, user in enumerate([self.u1, self.u2, self.u3] * 3):
+            msg = Message(text=f"message {i}", user_id=user.id)
+            db.session.add(msg)
+            db.session.flush()
+            search.index_message(msg)
+
+        counters.recompute_all()
+        db.session.commit()
+        follow_graph.graph.invalidate()
+
+        self.u1_id = self.u1.id
+        self.u2_id = self.u2.id
+        self.u3_id = self.u3.id
+
+    def tearDown(self):
+        db.session.rollback()
+        follow_graph.graph.invalidate()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_timeline_requires_login(self):
+        resp = self.client.get('/api/v1/timeline')
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.json['error']['status'], 401)
+
+    def test_timeline_pages(self):
+        self.login(self.u1_id)
+
+        resp = self.client.get('/api/v1/timeline?limit=4')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.json['messages']), 4)
+        self.assertIsNotNone(resp.json['next_cursor'])
+
+        rest = self.client.get(
+            f"/api/v1/timeline?limit=4&before={resp.json['next_cursor']}")
+        self.assertEqual(len(rest.json['messages']), 2)
+        self.assertIsNone(rest.json['next_cursor'])
+
+        messages = resp.json['messages'] + rest.json['messages']
+        self.assertEqual({m['user']['username'] for m in messages},
+                         {'u1', 'u2'})
+        self.assertEqual(len({m['id'] for m in messages}), 6)
+
+    def test_materialized_timeline_matches(self):
+        self.login(self.u1_id)
+        expected = self.client.get('/api/v1/timeline').json
+
+        with app.app_context():
+            timeline.rebuild_timeline(db.session.get(User, self.u1_id))
+            db.session.commit()
+        app.config['TIMELINE_MATERIALIZED'] = True
+
+        try:
+            self.assertEqual(self.client.get('/api/v1/timeline').json,
+                             expected)
+        finally:
+            app.config['TIMELINE_MATERIALIZED'] = False
+
+    def test_sparse_fields(self):
+        self.login(self.u1_id)
+
+        resp = self.client.get('/api/v1/timeline?fields=id,user.id')
+        self.assertEqual(set(resp.json['messages'][0]), {'id', 'user'})
+        self.assertEqual(set(resp.json['messages'][0]['user']), {'id'})
+
+        resp = self.client.get('/api/v1/timeline?fields=id,nope')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('nope', resp.json['error']['message'])
+
+    def test_profile(self):
+        self.login(self.u1_id)
+
+        resp = self.client.get(f'/api/v1/users/{self.u2_id}')
+        self.assertEqual(resp.json['username'], 'u2')
+        self.assertEqual(resp.json['messages_count'], 3)
+        self.assertTrue(resp.json['following'])
+
+        resp = self.client.get(
+            f'/api/v1/users/{self.u3_id}?fields=username,following')
+        self.assertEqual(resp.json, {'username': 'u3', 'following': False})
+
+        self.assertEqual(self.client.get('/api/v1/users/0').status_code, 404)
+
+    def test_user_messages(self):
+        resp = self.client.get(
+            f'/api/v1/users/{self.u3_id}/messages?fields=text,liked')
+
+        self.assertEqual(len(resp.json['messages']), 3)
+        self.assertEqual(resp.json['messages'][0],
+                         {'text': 'message 8', 'liked': False})
+
+    def test_create_and_delete(self):
+        self.login(self.u1_id)
+
+        resp = self.client.post('/api/v1/messages', json={'text': 'Hello'})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json['text'], 'Hello')
+        self.assertEqual(resp.json['user']['username'], 'u1')
+
+        message_id = resp.json['id']
+        self.assertEqual(db.session.get(User, self.u1_id).messages_count, 4)
+
+        resp = self.client.delete(f'/api/v1/messages/{message_id}', json={})
+        self.assertEqual(resp.status_code, 204)
+        self.assertIsNone(db.session.get(Message, message_id))
+
+    def test_create_validates(self):
+        self.login(self.u1_id)
+
+        self.assertEqual(self.client.post(
+            '/api/v1/messages', json={'text': ' '}).status_code, 400)
+        self.assertEqual(self.client.post(
+            '/api/v1/messages', json={'text': 'x' * 141}).status_code, 400)
+
+        for body in (['text'], 'text', 1):
+            resp = self.client.post('/api/v1/messages', json=body)
+            self.assertEqual(resp.status_code, 400, body)
+            self.assertEqual(resp.json['error']['message'],
+                             "expected a JSON object")
+
+        # Form posts (which a cross-site page could send) are refused.
+        self.assertEqual(self.client.post(
+            '/api/v1/messages', data={'text': 'Hi'}).status_code, 415)
+
+    def test_cannot_delete_others_messages(self):
+        self.login(self.u1_id)
+        msg = Message.query.filter_by(user_id=self.u2_id).first()
+
+        resp = self.client.delete(f'/api/v1/messages/{msg.id}', json={})
+        self.assertEqual(resp.status_code, 403)
+
+    def test_toggle_like(self):
+        self.login(self.u1_id)
+        msg_id = Message.query.filter_by(user_id=self.u2_id).first().id
+        other_id = Message.query.filter_by(user_id=self.u3_id).first().id
+        own_id = Message.query.filter_by(user_id=self.u1_id).first().id
+
+        # Someone else's like on another message must not count as ours.
+        db.session.add(Likes(user_id=self.u2_id, message_id=other_id))
+        db.session.commit()
+
+        resp = self.client.post(f'/api/v1/messages/{msg_id}/like', json={})
+        self.assertEqual(resp.json, {'liked': True, 'likes_count': 1})
+
+        resp = self.client.post(f'/api/v1/messages/{msg_id}/like', json={})
+        self.assertEqual(resp.json, {'liked': False, 'likes_count': 0})
+
+        resp = self.client.post(f'/api/v1/messages/{own_id}/like', json={})
+        self.assertEqual(resp.status_code, 403)
@@ -0,0 +1,216 @@
+"""ASGI serving tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+
+import asyncio
+import os
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+from urllib.parse import urlsplit
+
+from sqlalchemy import update
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import asgi
+import cache
+import follow_graph
+import fragments
+import search
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ASGITestCase(TestCase):
+    """Test that the async views serve what the Flask views do."""
+
+    @classmethod
+    def setUpClass(cls):
+        # The async engine's connections belong to one event loop.
+        cls.loop = asyncio.new_event_loop()
+
+    @classmethod
+    def tearDownClass(cls):
+        if asgi._engine is not None:
+            cls.loop.run_until_complete(asgi._engine.dispose())
+            asgi._engine = None
+
+        cls.loop.close()
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        u2 = User(email="test2@test.com", username="testuser2",
+                  password="HASHED_PASSWORD")
+        db.session.add_all([u, u2])
+        db.session.commit()
+
+        db.session.add(Follows(user_following_id=u.id,
+                               user_being_followed_id=u2.id))
+        msgs = [Message(text=f"Message {i}", user_id=u2.id) for i in range(3)]
+        db.session.add_all(msgs)
+        db.session.flush()
+        for msg in msgs:
+            search.index_message(msg)
+        db.session.add(Likes(user_id=u.id, message_id=msgs[0].id))
+        db.session.commit()
+
+        self.u_id = u.id
+        self.u2_id = u2.id
+        self.msg_id = msgs[0].id
+
+        follow_graph.graph.invalidate()
+        cache.user_rows.clear()
+        fragments.cards.clear()
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u_id
+
+        serializer = app.session_interface.get_signing_serializer(app)
+        self.cookie = serializer.dumps({CURR_USER_KEY: self.u_id})
+
+    def tearDown(self):
+        follow_graph.graph.invalidate()
+        db.session.rollback()
+
+    def asgi_request(self, url, method='GET', logged_in=True):
+        """(status, headers, body) of `url` served through the ASGI app."""
+
+        url = urlsplit(url)
+        headers = [(b'host', b'localhost')]
+
+        if logged_in:
+            headers.append(
+                (b'cookie', f'{app.session_cookie_name}={self.cookie}'.encode()))
+
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': url.path,
+            'query_string': url.query.encode(),
+            'headers': headers,
+            'http_version': '1.1',
+            'scheme': 'http',
+            'server': ('localhost', 80),
+        }
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        self.loop.run_until_complete(asgi.app(scope, receive, send))
+
+        start, body = sent
+        return (start['status'],
+                {name.decode(): value.decode()
+                 for name, value in start['headers']},
+                body['body'])
+
+    def assert_same_as_flask(self, url):
+        status, _, body = self.asgi_request(url)
+        resp = self.client.get(url)
+
+        self.assertEqual(status, resp.status_code, url)
+        self.assertEqual(body.decode(), resp.get_data(as_text=True), url)
+
+    def test_async_views_match_flask(self):
+        for url in ['/',
+                    '/users',
+                    f'/users/{self.u2_id}',
+                    f'/messages/{self.msg_id}',
+                    '/users/999999',
+                    '/?before=garbage']:
+            self.assert_same_as_flask(url)
+
+    def test_async_views_are_async(self):
+        for url, endpoint in [('/', 'homepage'),
+                              ('/users', 'list_users'),
+                              (f'/users/{self.u2_id}', 'users_show'),
+                              (f'/messages/{self.msg_id}', 'messages_show')]:
+            environ = asgi.wsgi_environ(
+                {'method': 'GET', 'path': url, 'query_string': b'',
+                 'headers': [], 'http_version': '1.1'}, b'')
+            view, _ = asgi.async_view_for(environ)
+
+            self.assertIs(view, asgi.ASYNC_VIEWS[endpoint])
+
+    def test_anonymous_homepage(self):
+        status, _, body = self.asgi_request('/', logged_in=False)
+
+        self.assertEqual(status, 200)
+        self.assertIn(b'Sign up', body)
+
+    def test_like_stars_and_caching_headers(self):
+        status, headers, body = self.asgi_request(f'/users/{self.u2_id}')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body.count(b'fas fa-star'), 1)
+        self.assertIn('etag', headers)
+        self.assertIn('set-cookie', headers)
+
+    def test_other_requests_go_to_flask(self):
+        status, _, body = self.asgi_request('/users?q=testuser2')
+        self.assertEqual(status, 200)
+        self.assertIn(b'@testuser2', body)
+
+        status, _, _ = self.asgi_request('/messages/new', method='POST')
+        self.assertEqual(status, 200)
+
+    def test_follow_graph_loads_off_the_event_loop(self):
+        threads = []
+        reload_graph = follow_graph.reload_graph
+
+        def recording_reload(app):
+            threads.append(threading.current_thread())
+            reload_graph(app)
+
+        with patch('follow_graph.reload_graph', recording_reload):
+            status, _, body = self.asgi_request(f'/users/{self.u2_id}')
+
+        self.assertEqual(status, 200)
+        self.assertIn(b'Unfollow', body)
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+
+    def test_viewer_version_is_not_cached(self):
+        """A cached viewer's version is read from the database, through
+        the async session."""
+
+        _, headers, _ = self.asgi_request(f'/users/{self.u2_id}')
+
+        db.session.execute(
+            update(User).where(User.id == self.u_id)
+            .values(version=User.version + 1))
+        db.session.commit()
+
+        with patch('http_cache.db') as sync_db:
+            _, new_headers, _ = self.asgi_request(f'/users/{self.u2_id}')
+
+        self.assertFalse(sync_db.session.execute.called)
+        self.assertNotEqual(new_headers['etag'], headers['etag'])
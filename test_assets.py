@@ -0,0 +1,142 @@
+"""Asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import assets
+import fragments
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class AssetPipelineTestCase(TestCase):
+    """Test building and serving fingerprinted assets."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        app.config['ASSETS_DIR'] = self.tmp.name
+
+        with app.app_context():
+            self.manifest = assets.build(app.static_folder, self.tmp.name)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        del app.config['ASSETS_DIR']
+        self.tmp.cleanup()
+
+    def test_build(self):
+        hashed = self.manifest['stylesheets/style.css']
+        path = os.path.join(self.tmp.name, hashed)
+
+        self.assertRegex(hashed, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+        self.assertTrue(os.path.isfile(path + '.gz'))
+
+        # Images are already compressed; no variants for them.
+        logo = self.manifest['images/warbler-logo.png']
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmp.name, logo + '.gz')))
+
+        with open(path + '.gz', 'rb') as f, open(path, 'rb') as built:
+            self.assertEqual(gzip.decompress(f.read()), built.read())
+
+    def test_css_urls_are_rewritten(self):
+        with open(os.path.join(self.tmp.name,
+                               self.manifest['stylesheets/style.css'])) as f:
+            css = f.read()
+
+        self.assertNotIn('/static/', css)
+        self.assertIn(
+            f'url("../{self.manifest["images/nav-bg.png"]}")', css)
+
+        self.assertEqual(
+            assets.rewrite_css_urls(
+                'stylesheets/a.css',
+                b'a { background: url(../images/nav-bg.png?x#y) }\n'
+                b'b { background: url(data:image/png;base64,AA) }\n'
+                b"c { background: url('/static/missing.png') }",
+                self.manifest).decode(),
+            f'a {{ background: url(../{self.manifest["images/nav-bg.png"]}) }}\n'
+            'b { background: url(data:image/png;base64,AA) }\n'
+            "c { background: url('/static/missing.png') }")
+
+    def test_pages_link_built_assets(self):
+        html = self.client.get('/login').get_data(as_text=True)
+        self.assertIn(f"/assets/{self.manifest['stylesheets/style.css']}", html)
+
+    def test_default_images_link_built_assets(self):
+        with app.test_request_context():
+            self.assertEqual(
+                assets.stored_url(User.header_image_url.default.arg),
+                f"/assets/{self.manifest['images/warbler-hero.jpg']}")
+            self.assertEqual(assets.stored_url('https://example.com/a.png'),
+                             'https://example.com/a.png')
+            self.assertIsNone(assets.stored_url(None))
+
+    def test_rebuild_makes_cached_cards_stale(self):
+        user = User(id=1, username="testuser", version=1,
+                    image_url=User.image_url.default.arg,
+                    header_image_url=User.header_image_url.default.arg)
+        fragments.cards.clear()
+
+        with app.test_request_context():
+            before = fragments.user_card(user)
+
+        # Rebuild from a copy of static/ with a changed default image.
+        with tempfile.TemporaryDirectory() as static_dir:
+            shutil.copytree(app.static_folder, static_dir, dirs_exist_ok=True)
+            with open(os.path.join(static_dir, 'images/default-pic.png'),
+                      'ab') as f:
+                f.write(b'changed')
+
+            with app.app_context():
+                manifest = assets.build(static_dir, self.tmp.name)
+
+        with app.test_request_context():
+            after = fragments.user_card(user)
+
+        self.assertIn(self.manifest['images/default-pic.png'], before)
+        self.assertIn(manifest['images/default-pic.png'], after)
+        self.assertNotEqual(manifest['images/default-pic.png'],
+                            self.manifest['images/default-pic.png'])
+
+    def test_serves_precompressed(self):
+        url = f"/assets/{self.manifest['stylesheets/style.css']}"
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertIn(b'General', gzip.decompress(resp.get_data()))
+        resp.close()
+
+        resp = self.client.get(url)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b'General', resp.get_data())
+        resp.close()
+
+        resp = self.client.get(url + '.gz')
+        self.assertEqual(resp.status_code, 404)
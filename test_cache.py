@@ -0,0 +1,188 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from cache import LRUCache
+import cache
+import fragments
+import search
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the LRU/TTL cache on its own."""
+
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('c'), 3)
+
+    def test_expires_after_ttl(self):
+        lru = LRUCache(2, ttl=10)
+
+        with patch('cache.time.monotonic', return_value=100):
+            lru.set('a', 1)
+
+        with patch('cache.time.monotonic', return_value=105):
+            self.assertEqual(lru.get('a'), 1)
+
+        with patch('cache.time.monotonic', return_value=111):
+            self.assertIsNone(lru.get('a'))
+
+
+class CurrentUserCacheTestCase(TestCase):
+    """Test the lazily loaded, cached g.user."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        db.session.add(u)
+        db.session.commit()
+
+        self.u_id = u.id
+        cache.user_rows.clear()
+
+        self.client = app.test_client()
+
+    def test_user_served_from_cache(self):
+        """The second request builds g.user without querying for it."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+
+            c.get('/messages/new')
+            self.assertIn(self.u_id, cache.user_rows._entries)
+
+            with patch.object(User, 'query') as query:
+                resp = c.get('/messages/new')
+                query.get.assert_not_called()
+
+            self.assertIn('alt="testuser"', resp.get_data(as_text=True))
+
+    def test_invalidate_user(self):
+        """Invalidating drops the cached row."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+
+            c.get('/messages/new')
+            cache.invalidate_user(self.u_id)
+
+            self.assertIsNone(cache.user_rows.get(self.u_id))
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test the rendered message and user card cache."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        u2 = User(email="test2@test.com", username="testuser2",
+                  password="HASHED_PASSWORD")
+        db.session.add_all([u, u2])
+        db.session.commit()
+
+        msg = Message(text="Cached hello", user_id=u2.id)
+        db.session.add(msg)
+        db.session.flush()
+        search.index_message(msg)
+        db.session.commit()
+
+        self.u_id = u.id
+        self.u2_id = u2.id
+        self.msg_id = msg.id
+
+        fragments.cards.clear()
+        self.client = app.test_client()
+
+    def rendered_cards(self, path):
+        """Card templates rendered while fetching `path`."""
+
+        with patch('fragments.render_template',
+                   wraps=fragments.render_template) as render:
+            resp = self.client.get(path)
+
+        self.assertEqual(resp.status_code, 200)
+        return [call.args[0] for call in render.call_args_list]
+
+    def test_message_cards_cached(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u_id
+
+        path = f'/users/{self.u2_id}'
+        self.assertEqual(self.rendered_cards(path), ['messages/_card.html'])
+        self.assertEqual(self.rendered_cards(path), [])
+
+        # The like star is still drawn per request.
+        self.client.post(f'/messages/{self.msg_id}/togglelike')
+        html = self.client.get(path).get_data(as_text=True)
+        self.assertIn('fas fa-star', html)
+        self.assertIn('Cached hello', html)
+
+    def test_user_cards_follow_profile_edits(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u_id
+
+        self.rendered_cards('/users')
+        self.assertEqual(self.rendered_cards('/users'), [])
+
+        user = User.query.get(self.u2_id)
+        user.username = 'renamed'
+        user.version += 1
+        db.session.commit()
+
+        self.assertEqual(self.rendered_cards('/users'), ['users/_card.html'])
+
+        html = self.client.get('/users').get_data(as_text=True)
+        self.assertIn('@renamed', html)
+        self.assertIn(f'action="/users/follow/{self.u2_id}"', html)
+
+    def test_delete_invalidates(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2_id
+
+        self.client.get(f'/users/{self.u2_id}')
+        self.assertIsNotNone(fragments.cards.get(('message', self.msg_id)))
+
+        self.client.post(f'/messages/{self.msg_id}/delete')
+        self.assertIsNone(fragments.cards.get(('message', self.msg_id)))
@@ -0,0 +1,159 @@
+"""Denormalized counter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_counters.py
+
+
+import os
+from threading import Barrier, Thread
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import actions
+import counters
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class CountersTestCase(TestCase):
+    """Test that write routes keep the counters in step."""
+
+    def setUp(self):
+        """Create two users, one message by the second."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        u2 = User(email="test2@test.com", username="testuser2",
+                  password="HASHED_PASSWORD")
+
+        db.session.add_all([u, u2])
+        db.session.commit()
+
+        self.u_id = u.id
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_follow_counters(self):
+        """Following and unfollowing adjust both users."""
+
+        with self.client as c:
+            self.login(c, self.u_id)
+            c.post(f'/users/follow/{self.u2_id}')
+
+            u = User.query.get(self.u_id)
+            u2 = User.query.get(self.u2_id)
+            self.assertEqual((u.following_count, u2.followers_count), (1, 1))
+
+            c.post(f'/users/stop-following/{self.u2_id}')
+
+            u = User.query.get(self.u_id)
+            u2 = User.query.get(self.u2_id)
+            self.assertEqual((u.following_count, u2.followers_count), (0, 0))
+
+    def test_message_and_like_counters(self):
+        """Posting, liking and deleting adjust every affected counter."""
+
+        with self.client as c:
+            self.login(c, self.u2_id)
+            c.post('/messages/new', data={'text': 'count me'})
+            msg_id = Message.query.one().id
+
+            self.assertEqual(User.query.get(self.u2_id).messages_count, 1)
+
+            self.login(c, self.u_id)
+            c.get('/')
+            c.post(f'/messages/{msg_id}/togglelike')
+
+            self.assertEqual(User.query.get(self.u_id).likes_count, 1)
+            self.assertEqual(Message.query.get(msg_id).likes_count, 1)
+
+            self.login(c, self.u2_id)
+            c.post(f'/messages/{msg_id}/delete')
+
+            self.assertEqual(User.query.get(self.u2_id).messages_count, 0)
+            self.assertEqual(User.query.get(self.u_id).likes_count, 0)
+
+    def test_concurrent_like_toggles(self):
+        """Racing toggles (double-clicks) never duplicate a like or let
+        the counters drift from the likes table.
+        """
+
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest("SQLite serializes writes; nothing can race")
+
+        msg = Message(text='click me', user_id=self.u2_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        def toggle(barrier):
+            with app.app_context():
+                user = User.query.get(self.u_id)
+                barrier.wait()
+                actions.toggle_like(user, msg_id)
+
+        for _ in range(20):
+            barrier = Barrier(2)
+            threads = [Thread(target=toggle, args=(barrier,))
+                       for _ in range(2)]
+
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            db.session.expire_all()
+            likes = Likes.query.filter_by(message_id=msg_id).count()
+
+            self.assertIn(likes, (0, 1))
+            self.assertEqual(Message.query.get(msg_id).likes_count, likes)
+            self.assertEqual(User.query.get(self.u_id).likes_count, likes)
+
+    def test_recompute_all(self):
+        """The repair job rebuilds drifted counters from the source rows."""
+
+        msg = Message(text='hello', user_id=self.u2_id)
+        db.session.add(msg)
+        db.session.add(Follows(user_being_followed_id=self.u2_id,
+                               user_following_id=self.u_id))
+        db.session.commit()
+        db.session.add(Likes(message_id=msg.id, user_id=self.u_id))
+        db.session.commit()
+
+        counters.recompute_all()
+        db.session.commit()
+        db.session.expire_all()
+
+        u = User.query.get(self.u_id)
+        u2 = User.query.get(self.u2_id)
+
+        self.assertEqual((u.following_count, u.likes_count), (1, 1))
+        self.assertEqual((u2.messages_count, u2.followers_count), (1, 1))
+        self.assertEqual(Message.query.get(msg.id).likes_count, 1)
@@ -0,0 +1,93 @@
+"""Follow graph index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+
+from threading import Event
+from unittest import TestCase
+
+from follow_graph import FollowGraph
+
+
+class FollowGraphTestCase(TestCase):
+    """Test the in-memory follow graph."""
+
+    def setUp(self):
+        """Load a small graph: 1 -> 2, 1 -> 3, 2 -> 1, 3 -> 4."""
+
+        self.graph = FollowGraph()
+        self.graph.load([(1, 3), (1, 2), (2, 1), (3, 4)])
+
+    def test_is_following(self):
+        self.assertTrue(self.graph.is_following(1, 2))
+        self.assertTrue(self.graph.is_following(1, 3))
+        self.assertFalse(self.graph.is_following(3, 1))
+        self.assertFalse(self.graph.is_following(99, 1))
+
+    def test_is_followed_by(self):
+        self.assertTrue(self.graph.is_followed_by(4, 3))
+        self.assertFalse(self.graph.is_followed_by(3, 4))
+
+    def test_is_mutual(self):
+        self.assertTrue(self.graph.is_mutual(1, 2))
+        self.assertFalse(self.graph.is_mutual(1, 3))
+
+    def test_following_among(self):
+        self.assertEqual(self.graph.following_among(1, [2, 3, 4, 5]), {2, 3})
+        self.assertEqual(self.graph.following_among(4, [1, 2]), set())
+
+    def test_add_and_remove(self):
+        self.graph.add(4, 1)
+        self.graph.add(4, 1)
+
+        self.assertEqual(list(self.graph.following_ids(4)), [1])
+        self.assertEqual(list(self.graph.follower_ids(1)), [2, 4])
+
+        self.graph.remove(4, 1)
+        self.graph.remove(4, 1)
+
+        self.assertFalse(self.graph.is_following(4, 1))
+        self.assertEqual(list(self.graph.follower_ids(1)), [2])
+
+    def test_stale(self):
+        self.assertFalse(self.graph.is_stale(60))
+
+        self.graph.invalidate()
+        self.assertTrue(self.graph.is_stale(60))
+
+    def test_stale_graph_reloads_in_background(self):
+        started, finish = Event(), Event()
+        calls = []
+
+        def reload():
+            calls.append(1)
+            started.set()
+            finish.wait(5)
+            self.graph.load([(1, 2), (5, 6)])
+
+        self.graph.refresh(reload, ttl=-1)
+        self.assertTrue(started.wait(5))
+
+        # Readers keep the old graph, no second reload starts, and edges
+        # changed meanwhile outlive the load.
+        self.graph.refresh(reload, ttl=-1)
+        self.assertTrue(self.graph.is_following(1, 3))
+        self.graph.add(7, 1)
+
+        finish.set()
+        with self.graph._load_lock:
+            pass
+
+        self.assertEqual(len(calls), 1)
+        self.assertFalse(self.graph.is_following(1, 3))
+        self.assertTrue(self.graph.is_following(5, 6))
+        self.assertTrue(self.graph.is_following(7, 1))
+
+    def test_missing_graph_loads_before_returning(self):
+        self.graph.invalidate()
+        self.graph.refresh(lambda: self.graph.load([(8, 9)]), ttl=60)
+
+        self.assertTrue(self.graph.is_following(8, 9))
+        self.assertFalse(self.graph.is_stale(60))
@@ -0,0 +1,252 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+from datetime import datetime, timedelta
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry, Job
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import cache
+import counters
+import jobs
+import search
+import timeline
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def counter_values():
+    return ([(u.id, u.messages_count, u.following_count, u.followers_count,
+              u.likes_count) for u in User.query.order_by(User.id)],
+            [(m.id, m.likes_count) for m in Message.query.order_by(Message.id)])
+
+
+class JobsTestCase(TestCase):
+    """Test the job queue and the jobs."""
+
+    def setUp(self):
+        """A user about to be deleted, with messages, likes and follows in
+        both directions, and two other users.
+        """
+
+        Job.query.delete()
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        users = [User(email=f"test{i}@test.com", username=f"testuser{i}",
+                      password="HASHED_PASSWORD") for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        doomed, u2, u3 = self.ids = [u.id for u in users]
+        self.doomed_id = doomed
+
+        msgs = [Message(text=f"doomed {i}", user_id=doomed) for i in range(5)]
+        msgs += [Message(text=f"other {i}", user_id=u2) for i in range(3)]
+        db.session.add_all(msgs)
+        db.session.flush()
+        for msg in msgs:
+            search.index_message(msg)
+
+        db.session.add_all(
+            [Likes(user_id=liker, message_id=msg.id)
+             for msg in msgs[:5] for liker in (u2, u3)]
+            + [Likes(user_id=doomed, message_id=msg.id) for msg in msgs[5:]]
+            + [Follows(user_following_id=a, user_being_followed_id=b)
+               for a, b in [(doomed, u2), (doomed, u3), (u2, doomed),
+                            (u3, doomed), (u2, u3)]])
+
+        counters.recompute_all()
+        db.session.commit()
+
+        self.saved_config = {key: app.config.get(key) for key in
+                             ['JOB_CHUNK_SIZE', 'JOB_RETRY_DELAY',
+                              'TIMELINE_MATERIALIZED']}
+        app.config.update(JOB_CHUNK_SIZE=2, JOB_RETRY_DELAY=0)
+
+        with app.app_context():
+            for user in User.query.all():
+                timeline.rebuild_timeline(user)
+            db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config.update(self.saved_config)
+        jobs.JOBS.pop('explode', None)
+        cache.user_rows.clear()
+        db.session.rollback()
+
+    def run_jobs(self):
+        """Run every due job chunk; returns how many ran."""
+
+        runs = 0
+
+        with app.app_context():
+            while jobs.run_one() is not None:
+                runs += 1
+
+        db.session.expire_all()
+        return runs
+
+    def test_delete_user_in_chunks(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.doomed_id
+
+        resp = self.client.post('/users/delete')
+        self.assertEqual(resp.status_code, 302)
+
+        # Hidden at once; the rows are reclaimed later.
+        self.assertIsNotNone(User.query.get(self.doomed_id).deleted_at)
+        self.assertEqual(Job.query.one().name, 'delete_user')
+
+        self.assertGreater(self.run_jobs(), 5)
+
+        doomed = self.doomed_id
+        self.assertIsNone(User.query.get(doomed))
+        self.assertEqual(Message.query.filter_by(user_id=doomed).count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertEqual(TimelineEntry.query.filter(
+            (TimelineEntry.owner_id == doomed)
+            | (TimelineEntry.author_id == doomed)).count(), 0)
+        self.assertEqual(Job.query.count(), 0)
+
+        # Everyone else's counters were kept right along the way.
+        kept = counter_values()
+        counters.recompute_all()
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(counter_values(), kept)
+
+    def test_deleted_user_is_hidden_before_the_job_runs(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.doomed_id
+
+        # Cache the row, as a request before the deletion would have.
+        self.client.get('/')
+        self.client.post('/users/delete')
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.doomed_id
+
+        # A stale session no longer logs anyone in.
+        resp = self.client.get('/messages/new')
+        self.assertEqual(resp.status_code, 302)
+
+        self.assertFalse(User.authenticate("testuser0", "HASHED_PASSWORD"))
+        self.assertEqual(
+            self.client.get(f'/users/{self.doomed_id}').status_code, 404)
+
+        html = self.client.get('/users').get_data(as_text=True)
+        self.assertNotIn('testuser0', html)
+        self.assertIn('testuser1', html)
+
+        html = self.client.get('/users', query_string={'q': 'testuser'}
+                               ).get_data(as_text=True)
+        self.assertNotIn('testuser0', html)
+
+        # Their messages are gone from followers' timelines and can't be
+        # seen or liked.
+        msg_id = Message.query.filter_by(user_id=self.doomed_id).first().id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids[1]
+
+        for materialized in (False, True):
+            app.config['TIMELINE_MATERIALIZED'] = materialized
+            html = self.client.get('/').get_data(as_text=True)
+            self.assertNotIn('doomed', html)
+            self.assertIn('other 0', html)
+
+        self.assertEqual(
+            self.client.get(f'/messages/{msg_id}').status_code, 404)
+        self.assertEqual(
+            self.client.post(f'/messages/{msg_id}/togglelike').status_code,
+            404)
+
+        # The username and email are free for a new account.
+        User.signup("testuser0", "test0@test.com", "password", None)
+        db.session.commit()
+
+        self.run_jobs()
+        self.assertEqual(User.query.filter_by(username="testuser0").count(), 1)
+
+    def test_failing_job_is_retried_then_failed(self):
+        def explode():
+            raise ValueError("boom")
+
+        jobs.JOBS['explode'] = explode
+        job = jobs.enqueue('explode')
+        job.max_attempts = 2
+        db.session.commit()
+        job_id = job.id
+
+        # JOB_RETRY_DELAY is 0, so the retry is due straight away.
+        self.assertEqual(self.run_jobs(), 2)
+
+        job = Job.query.get(job_id)
+        self.assertEqual((job.state, job.attempts), ('failed', 2))
+        self.assertIn("ValueError: boom", job.last_error)
+
+        self.assertEqual(self.run_jobs(), 0)
+
+    def test_retries_back_off(self):
+        app.config['JOB_RETRY_DELAY'] = 60
+        jobs.JOBS['explode'] = lambda: 1 / 0
+        jobs.enqueue('explode')
+        db.session.commit()
+
+        self.assertEqual(self.run_jobs(), 1)
+        self.assertEqual(self.run_jobs(), 0)
+
+        job = Job.query.one()
+        self.assertEqual((job.state, job.attempts), ('queued', 1))
+        self.assertGreater(job.run_at,
+                           datetime.utcnow() + timedelta(seconds=50))
+
+    def test_stale_running_job_is_claimed_again(self):
+        """A job whose worker died is picked up by another worker."""
+
+        u2 = User.query.get(self.ids[1])
+        u2.followers_count = 99
+        db.session.add(Job(name='repair_counters', args='{}', state='running',
+                           attempts=1,
+                           locked_at=datetime.utcnow() - timedelta(days=1)))
+        db.session.commit()
+
+        self.run_jobs()
+
+        self.assertEqual(Job.query.count(), 0)
+        self.assertEqual(User.query.get(self.ids[1]).followers_count, 1)
+
+    def test_rebuild_timelines(self):
+        entries = TimelineEntry.query.count()
+        TimelineEntry.query.delete()
+        jobs.enqueue('rebuild_timelines')
+        db.session.commit()
+
+        self.run_jobs()
+
+        self.assertEqual(TimelineEntry.query.count(), entries)
+        self.assertEqual(Job.query.count(), 0)
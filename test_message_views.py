@@ -20,6 +20,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import search
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -30,6 +31,7 @@ db.create_all()
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['SQL_QUERY_BUDGET_STRICT'] = True
 
 
 class MessageViewTestCase(TestCase):
@@ -70,3 +72,83 @@ class MessageViewTestCase(TestCase):
 
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
+
+    def test_search_messages(self):
+        """Can we find a message by a word in it, and not once deleted?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Warblers sing at dawn"})
+            c.post("/messages/new", data={"text": "Nothing to see here"})
+
+            resp = c.get("/messages/search", query_string={"q": "dawn"})
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Warblers sing at dawn", html)
+            self.assertNotIn("Nothing to see here", html)
+
+            msg = Message.query.filter_by(text="Warblers sing at dawn").one()
+            c.post(f"/messages/{msg.id}/delete")
+
+            resp = c.get("/messages/search", query_string={"q": "dawn"})
+            self.assertIn("Sorry, no messages found",
+                          resp.get_data(as_text=True))
+
+    def test_search_pages_do_not_repeat(self):
+        """Does walking every page of a search, ties and all, see each
+        match exactly once?"""
+
+        texts = ["dawn", "dawn chorus", "dawn dawn", "at dawn we sing"]
+        msgs = [Message(text=texts[i % len(texts)], user_id=self.testuser.id)
+                for i in range(22)]
+        db.session.add_all(msgs)
+        db.session.flush()
+        for msg in msgs:
+            search.index_message(msg)
+        db.session.commit()
+
+        seen = []
+        cursor = None
+
+        while True:
+            page = search.search_messages("dawn", cursor, per_page=4)
+            seen.extend(msg.id for msg in page.items)
+
+            if page.next_cursor is None:
+                break
+
+            cursor = search.decode_score_cursor(page.next_cursor)
+
+        self.assertEqual(sorted(seen), sorted(msg.id for msg in msgs))
+
+    def test_message_conditional_get(self):
+        """Does an unchanged message page answer 304 without rendering?"""
+
+        msg = Message(text="Hello", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        resp = self.client.get(f"/messages/{msg.id}")
+        etag = resp.headers['ETag']
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('public', resp.headers['Cache-Control'])
+
+        resp = self.client.get(f"/messages/{msg.id}",
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        # Logged in, the page (and its validator) is different.
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser.id
+
+        resp = self.client.get(f"/messages/{msg.id}",
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('private', resp.headers['Cache-Control'])
+
+        resp = self.client.get("/messages/0")
+        self.assertEqual(resp.status_code, 404)
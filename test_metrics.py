@@ -0,0 +1,110 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import multiprocessing
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+from metrics import ValueFile
+import metrics
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def sample_value(name, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    return metrics.collect().get(key, 0)
+
+
+def like_in_child():
+    metrics.likes_total.inc(action='like')
+
+
+class ValueFileTestCase(TestCase):
+    """Test the mmap'd per-process value file."""
+
+    def test_round_trip_and_growth(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'total_1.db')
+            values = ValueFile(path)
+
+            for i in range(5000):
+                values.add(f'key-{i}', i)
+            values.add('key-1', 1)
+            values.set('key-2', 0.5)
+
+            entries = dict(ValueFile.read(path))
+            self.assertEqual(len(entries), 5000)
+            self.assertEqual(entries['key-1'], 2)
+            self.assertEqual(entries['key-2'], 0.5)
+            self.assertEqual(entries['key-4999'], 4999)
+
+            # Reopening picks up where we left off.
+            values = ValueFile(path)
+            values.add('key-1', 1)
+            self.assertEqual(dict(ValueFile.read(path))['key-1'], 3)
+
+
+class MetricsTestCase(TestCase):
+    """Test aggregation and the /metrics endpoint."""
+
+    def test_counts_other_processes(self):
+        before = sample_value('warbler_likes_total', action='like')
+
+        metrics.likes_total.inc(action='like')
+
+        child = multiprocessing.get_context('fork').Process(
+            target=like_in_child)
+        child.start()
+        child.join()
+
+        self.assertEqual(
+            sample_value('warbler_likes_total', action='like'), before + 2)
+
+    def test_gauges_of_dead_workers_are_dropped(self):
+        metrics.db_pool_checked_out.set(3)
+        self.assertEqual(sample_value('warbler_db_pool_checked_out'), 3)
+
+        metrics.mark_process_dead(os.getpid())
+        metrics._files.pop(('live', os.getpid()))
+
+        self.assertEqual(sample_value('warbler_db_pool_checked_out'), 0)
+
+    def test_endpoint(self):
+        client = app.test_client()
+        client.get('/login')
+        resp = client.get('/metrics')
+        text = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('# TYPE warbler_request_duration_seconds histogram', text)
+        self.assertIn('warbler_requests_total{endpoint="login",method="GET",'
+                      'status="200"}', text)
+        self.assertIn('warbler_request_duration_seconds_bucket{'
+                      'endpoint="login",le="+Inf",method="GET"}', text)
+
+        count = sample_value('warbler_request_duration_seconds_count',
+                             endpoint='login', method='GET')
+        inf = [line for line in text.splitlines()
+               if line.startswith('warbler_request_duration_seconds_bucket{'
+                                  'endpoint="login",le="+Inf"')]
+        self.assertEqual(float(inf[0].split()[-1]), count)
@@ -0,0 +1,120 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import delete, update
+
+from models import db, User, Message, Follows, Likes, POSTGRES_SEARCH_INDEXES
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import migrations
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class MigrationsTestCase(TestCase):
+    """Test migrating a database made before the search indexes and
+    counters.
+    """
+
+    def setUp(self):
+        """Two users, with a message, a follow and a like that no counter
+        or search index knows about.
+        """
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        u2 = User(email="test2@test.com", username="testuser2",
+                  password="HASHED_PASSWORD")
+        db.session.add_all([u, u2])
+        db.session.commit()
+
+        msg = Message(text="Written before the migration", user_id=u2.id)
+        db.session.add(msg)
+        db.session.flush()
+        db.session.add_all([
+            Follows(user_following_id=u.id, user_being_followed_id=u2.id),
+            Likes(user_id=u.id, message_id=msg.id),
+        ])
+        db.session.commit()
+
+        self.u_id = u.id
+        self.u2_id = u2.id
+
+        with app.app_context():
+            migrations.migrate(db.engine)
+
+        # What 0001-0003 leave behind: counters added as zeroes, and no
+        # search indexes.
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute("DROP TABLE messages_fts")
+        else:
+            for name in POSTGRES_SEARCH_INDEXES:
+                db.session.execute(f"DROP INDEX {name}")
+
+        db.session.execute(update(User).values(
+            messages_count=0, following_count=0, followers_count=0,
+            likes_count=0))
+        db.session.execute(update(Message).values(likes_count=0))
+        db.session.execute(
+            delete(migrations.schema_migrations)
+            .where(migrations.schema_migrations.c.name.in_(
+                ['0004_search_indexes', '0005_recompute_counters'])))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_migrate(self):
+        with app.app_context():
+            ran = migrations.migrate(db.engine)
+
+        self.assertEqual(ran, ['0004_search_indexes',
+                               '0005_recompute_counters'])
+
+        db.session.expire_all()
+        u = User.query.get(self.u_id)
+        u2 = User.query.get(self.u2_id)
+
+        self.assertEqual((u.following_count, u.likes_count), (1, 1))
+        self.assertEqual((u2.followers_count, u2.messages_count), (1, 1))
+        self.assertEqual(Message.query.one().likes_count, 1)
+
+        resp = self.client.get('/messages/search',
+                               query_string={'q': 'migration'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Written before the migration',
+                      resp.get_data(as_text=True))
+
+        resp = self.client.post('/messages/new', data={'text': 'After'})
+        self.assertEqual(resp.status_code, 302)
+
+        with app.app_context():
+            self.assertEqual(migrations.migrate(db.engine), [])
@@ -0,0 +1,208 @@
+"""Query plan regression tests.
+
+Runs the hot routes on a seeded dataset, EXPLAINs every SELECT they
+issue, and fails if any of them reads messages, likes, follows or
+timeline_entries with a full table scan, i.e. if a query stops being
+served by an index.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+
+import json
+import os
+import random
+from unittest import TestCase
+
+from sqlalchemy import event, insert
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import cache
+import counters
+import follow_graph
+import fragments
+import timeline
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+HOT_TABLES = {'messages', 'likes', 'follows', 'timeline_entries'}
+
+USERS = 60
+MESSAGES_PER_USER = 30
+FOLLOWS_PER_USER = 15
+LIKES_PER_USER = 20
+
+
+def full_scans(conn, statement, parameters):
+    """Hot tables that `statement` reads with a full scan."""
+
+    if conn.dialect.name == 'postgresql':
+        # On a small dataset Postgres rightly prefers sequential scans;
+        # turning them off shows whether an index path exists at all.
+        conn.exec_driver_sql("SET enable_seqscan = off")
+        rows = conn.exec_driver_sql(
+            "EXPLAIN (FORMAT JSON) " + statement, parameters)
+        conn.exec_driver_sql("RESET enable_seqscan")
+
+        plan = rows.scalar()
+        plan = json.loads(plan) if isinstance(plan, str) else plan
+
+        def nodes(node):
+            yield node
+            for child in node.get('Plans', []):
+                yield from nodes(child)
+
+        return {node['Relation Name'] for node in nodes(plan[0]['Plan'])
+                if node['Node Type'] == 'Seq Scan'
+                and node.get('Relation Name') in HOT_TABLES}
+
+    rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+
+    return {detail.split()[1] for *_, detail in rows
+            if detail.startswith('SCAN ')
+            and detail.split()[1] in HOT_TABLES}
+
+
+class QueryPlanTestCase(TestCase):
+    """No hot route may fall back to a sequential scan."""
+
+    @classmethod
+    def setUpClass(cls):
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        rng = random.Random(1)
+
+        db.session.execute(insert(User), [
+            {'id': i, 'email': f'user{i}@test.com', 'username': f'user{i}',
+             'password': 'HASHED_PASSWORD'}
+            for i in range(1, USERS + 1)])
+
+        db.session.execute(insert(Message), [
+            {'text': f'message {i} by {user_id}', 'user_id': user_id}
+            for user_id in range(1, USERS + 1)
+            for i in range(MESSAGES_PER_USER)])
+
+        db.session.execute(insert(Follows), [
+            {'user_following_id': user_id, 'user_being_followed_id': other}
+            for user_id in range(1, USERS + 1)
+            for other in rng.sample(
+                [u for u in range(1, USERS + 1) if u != user_id],
+                FOLLOWS_PER_USER)])
+
+        message_ids = [id for (id,) in db.session.query(Message.id)]
+        db.session.execute(insert(Likes), [
+            {'user_id': user_id, 'message_id': message_id}
+            for user_id in range(1, USERS + 1)
+            for message_id in rng.sample(message_ids, LIKES_PER_USER)])
+
+        counters.recompute_all()
+        db.session.commit()
+
+        with app.app_context():
+            for user in User.query.all():
+                timeline.rebuild_timeline(user)
+            db.session.commit()
+
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql("ANALYZE")
+
+        cls.message_id = message_ids[len(message_ids) // 2]
+
+    @classmethod
+    def tearDownClass(cls):
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+        follow_graph.graph.invalidate()
+
+    def setUp(self):
+        # Loading the in-memory follow graph reads all of follows on
+        # purpose, once per process; load it before the routes run.
+        follow_graph.graph.invalidate()
+        with app.app_context():
+            follow_graph.get_graph()
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+        fragments.cards.clear()
+        cache.user_rows.clear()
+
+    def selects_run_by(self, path):
+        """(statement, parameters) of every SELECT run to serve `path`."""
+
+        selects = []
+
+        def capture(conn, cursor, statement, parameters, context,
+                    executemany):
+            if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+                selects.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            resp = self.client.get(path)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+
+        self.assertEqual(resp.status_code, 200, path)
+        return selects
+
+    def assert_no_full_scans(self, *paths):
+        for path in paths:
+            selects = self.selects_run_by(path)
+            self.assertTrue(selects, path)
+
+            with db.engine.connect() as conn:
+                for statement, parameters in selects:
+                    with self.subTest(path=path, statement=statement):
+                        self.assertEqual(
+                            full_scans(conn, statement, parameters), set())
+
+    def test_pages(self):
+        self.assert_no_full_scans(
+            '/',
+            '/users/2',
+            '/users/2/following',
+            '/users/2/followers',
+            '/users/2/liked_messages',
+            f'/messages/{self.message_id}',
+        )
+
+    def test_api(self):
+        self.assert_no_full_scans(
+            '/api/v1/timeline',
+            '/api/v1/users/2',
+            '/api/v1/users/2/messages',
+        )
+
+    def test_materialized_timeline(self):
+        app.config['TIMELINE_MATERIALIZED'] = True
+
+        try:
+            self.assert_no_full_scans('/', '/api/v1/timeline')
+        finally:
+            app.config['TIMELINE_MATERIALIZED'] = False
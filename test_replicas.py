@@ -0,0 +1,108 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import replicas
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test that GET reads go to a replica, and when they don't."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        u = User(email="test@test.com", username="onprimary",
+                 password="HASHED_PASSWORD")
+        db.session.add(u)
+        db.session.commit()
+        self.u_id = u.id
+
+        # A stand-in replica that has drifted: it has a different user.
+        self.tmp = tempfile.mkdtemp()
+        self.saved_binds = app.config['SQLALCHEMY_BINDS']
+        app.config['SQLALCHEMY_BINDS'] = replicas.binds(
+            [f"sqlite:///{self.tmp}/replica.db"])
+
+        engine = db.get_engine(app, bind='replica_0')
+        db.Model.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(User.__table__.insert().values(
+                id=u.id + 1000, email="replica@test.com",
+                username="onreplica", password="HASHED_PASSWORD"))
+
+        replicas._unhealthy.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['SQLALCHEMY_BINDS'] = self.saved_binds
+        replicas._unhealthy.clear()
+        db.session.rollback()
+        shutil.rmtree(self.tmp)
+
+    def users_page(self):
+        resp = self.client.get('/users')
+        return resp.status_code, resp.get_data(as_text=True)
+
+    def test_reads_go_to_replica(self):
+        status, html = self.users_page()
+
+        self.assertEqual(status, 200)
+        self.assertIn('@onreplica', html)
+        self.assertNotIn('@onprimary', html)
+
+    def test_writers_are_pinned_to_primary(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u_id
+
+        self.client.post('/messages/new', data={'text': 'Hello'})
+
+        status, html = self.users_page()
+        self.assertIn('@onprimary', html)
+
+        # Once the pin expires, reads go back to the replica.
+        with self.client.session_transaction() as sess:
+            sess[replicas.PIN_KEY] = 0
+
+        status, html = self.users_page()
+        self.assertIn('@onreplica', html)
+
+    def test_failed_replica_is_skipped(self):
+        app.config['SQLALCHEMY_BINDS'] = replicas.binds(
+            [f"sqlite:///{self.tmp}/missing/replica.db"])
+
+        # The failed read is retried on the primary in the same request.
+        status, html = self.users_page()
+        self.assertEqual(status, 200)
+        self.assertIn('@onprimary', html)
+        self.assertFalse(replicas.is_healthy('replica_0'))
+
+        status, html = self.users_page()
+        self.assertEqual(status, 200)
+        self.assertIn('@onprimary', html)
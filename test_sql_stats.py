@@ -0,0 +1,113 @@
+"""SQL instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sql_stats.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from sql_stats import QueryBudgetExceeded, RequestStats, fingerprint
+import sql_stats
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FingerprintTestCase(TestCase):
+    """Test statement fingerprinting on its own."""
+
+    def test_same_query_different_values(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM users WHERE id = 1 AND name = 'a'"),
+            fingerprint("SELECT *  FROM users\nWHERE id = 22 AND name = 'b'"))
+
+    def test_in_lists_collapse(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM users WHERE id IN (?, ?, ?)"),
+            fingerprint("SELECT * FROM users WHERE id IN (?)"))
+        self.assertEqual(
+            fingerprint("WHERE id IN (%(id_1_1)s, %(id_1_2)s)"),
+            fingerprint("WHERE id IN (%(id_1_1)s)"))
+
+    def test_repeated(self):
+        stats = RequestStats()
+
+        for i in range(3):
+            stats.record(f"SELECT * FROM users WHERE id = {i}", 0.001)
+        stats.record("SELECT * FROM messages", 0.001)
+
+        self.assertEqual(stats.count, 4)
+        self.assertEqual(stats.repeated(3),
+                         [("SELECT * FROM users WHERE id = ?", 3)])
+
+
+class RequestInstrumentationTestCase(TestCase):
+    """Test the per-request counts, headers and query budget."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+
+        self.saved_config = {
+            key: app.config.get(key)
+            for key in ['SQL_QUERY_BUDGET_STRICT', 'PROPAGATE_EXCEPTIONS']
+        }
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config.update(self.saved_config)
+
+    def test_headers(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get(f"/users/{self.testuser.id}")
+
+            self.assertGreater(int(resp.headers['X-SQL-Queries']), 0)
+            self.assertIn('db;dur=', resp.headers['Server-Timing'])
+
+    def test_budget(self):
+        view = app.view_functions['users_show']
+        app.config['SQL_QUERY_BUDGET_STRICT'] = True
+        app.config['PROPAGATE_EXCEPTIONS'] = True
+
+        try:
+            sql_stats.query_budget(0)(view)
+
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get(f"/users/{self.testuser.id}")
+
+            app.config['SQL_QUERY_BUDGET_STRICT'] = False
+
+            with self.assertLogs(app.logger, 'WARNING') as logs:
+                resp = self.client.get(f"/users/{self.testuser.id}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('over its budget of 0', logs.output[0])
+
+        finally:
+            del view.query_budget
@@ -0,0 +1,122 @@
+"""Materialized timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out-on-write home timelines."""
+
+    def setUp(self):
+        """Turn on the timeline store and create two users."""
+
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        app.config['TIMELINE_MATERIALIZED'] = True
+
+        self.client = app.test_client()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        u2 = User(email="test2@test.com", username="testuser2",
+                  password="HASHED_PASSWORD")
+
+        db.session.add_all([u, u2])
+        db.session.commit()
+
+        self.u_id = u.id
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        app.config['TIMELINE_MATERIALIZED'] = False
+        db.session.rollback()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_post_fans_out_to_followers(self):
+        """A new message lands in the author's and followers' timelines."""
+
+        with self.client as c:
+            self.login(c, self.u_id)
+            c.post(f'/users/follow/{self.u2_id}')
+
+            self.login(c, self.u2_id)
+            c.post('/messages/new', data={'text': 'fanned out'})
+
+            owners = {e.owner_id for e in TimelineEntry.query.all()}
+            self.assertEqual(owners, {self.u_id, self.u2_id})
+
+            self.login(c, self.u_id)
+            resp = c.get('/')
+            self.assertIn('fanned out', resp.get_data(as_text=True))
+
+    def test_follow_backfills_and_unfollow_prunes(self):
+        """Following copies old messages in; unfollowing removes them."""
+
+        db.session.add(Message(text='older message', user_id=self.u2_id))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.u_id)
+
+            c.post(f'/users/follow/{self.u2_id}')
+            self.assertEqual(
+                TimelineEntry.query.filter_by(owner_id=self.u_id).count(), 1)
+
+            c.post(f'/users/stop-following/{self.u2_id}')
+            self.assertEqual(
+                TimelineEntry.query.filter_by(owner_id=self.u_id).count(), 0)
+
+    def test_high_fanout_author_is_pulled(self):
+        """Messages from accounts over the threshold are merged in at read
+        time instead of being pushed.
+        """
+
+        app.config['FANOUT_FOLLOWER_THRESHOLD'] = 0
+
+        try:
+            with self.client as c:
+                self.login(c, self.u_id)
+                c.post(f'/users/follow/{self.u2_id}')
+
+                self.login(c, self.u2_id)
+                c.post('/messages/new', data={'text': 'pulled in'})
+
+                self.assertEqual(
+                    TimelineEntry.query.filter_by(owner_id=self.u_id).count(),
+                    0)
+
+                self.login(c, self.u_id)
+                resp = c.get('/')
+                self.assertIn('pulled in', resp.get_data(as_text=True))
+
+        finally:
+            del app.config['FANOUT_FOLLOWER_THRESHOLD']
@@ -6,11 +6,15 @@
 
 
 import os
+import tempfile
 from unittest import TestCase
 from flask import session
 
 
-from models import db, User, Message, Follows, Likes, bcrypt
+import bcrypt as bcrypt_lib
+
+from models import db, User, Message, Follows, Likes
+import passwords
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -92,22 +96,27 @@ class UserModelTestCase(TestCase):
         self.assertEqual(self.u.is_following(self.u2), True)
         self.assertNotEqual(self.u2.is_following(self.u), True)
 
-    def test_is_liked(self):
-        """Can we get a list of liked messages
-        Creating message, liking message, checking
+    def test_liked_message_ids(self):
+        """Do we get back exactly the liked ids out of a page of messages?
+        Creating messages, liking one, checking
         """
 
         message = Message(text="This is a test message", user_id=self.u2.id)
-        db.session.add(message)
+        other = Message(text="Another test message", user_id=self.u2.id)
+        db.session.add_all([message, other])
         db.session.commit()
 
-        self.assertEqual(self.u.is_liked(message.id), False)
+        ids = [message.id, other.id]
+
+        self.assertEqual(self.u.liked_message_ids(ids), set())
 
         liked_message = Likes(message_id=message.id, user_id=self.u.id)
         db.session.add(liked_message)
         db.session.commit()
 
-        self.assertEqual(self.u.is_liked(message.id), True)
+        self.assertEqual(self.u.liked_message_ids(ids), {message.id})
+        self.assertEqual(self.u2.liked_message_ids(ids), set())
+        self.assertEqual(self.u.liked_message_ids([]), set())
 
 
     def test_is_author(self):
@@ -124,7 +133,7 @@ class UserModelTestCase(TestCase):
         """Does our user instance have the same attributes as the instance 
         returned from the signup class method?"""
 
-        hashed_pwd = bcrypt.generate_password_hash("hashed_pwd3").decode('UTF-8')
+        hashed_pwd = passwords.hash_password("hashed_pwd3")
 
         signup_user = User.signup(
             username="test3",
@@ -157,7 +166,50 @@ class UserModelTestCase(TestCase):
         ), User.query.filter_by(username="test3").first())
 
 
-        
+
+    def test_authenticate_rehashes_old_cost(self):
+        """A hash made at an outdated work factor is upgraded on login"""
+
+        old_hash = bcrypt_lib.hashpw(b"password", bcrypt_lib.gensalt(4))
+        user = User(email="test3@test.com", username="test3",
+                    password=old_hash.decode('UTF-8'))
+        db.session.add(user)
+        db.session.commit()
+
+        with app.app_context():
+            app.config['BCRYPT_LOG_ROUNDS'] = 5
+
+            try:
+                self.assertEqual(User.authenticate("test3", "password"), user)
+                self.assertTrue(user.password.startswith("$2b$05$"))
+                self.assertFalse(User.authenticate("test3", "wrong"))
+
+            finally:
+                app.config['BCRYPT_LOG_ROUNDS'] = 12
+
+    def test_password_pool_rejects_when_full(self):
+        """A full password pool turns work away instead of queueing it"""
+
+        pool = passwords.PasswordPool(workers=0, max_pending=1)
+
+        with self.assertRaises(passwords.PasswordHasherBusy):
+            pool.run(pool.run, len, "nested")
+
+        self.assertEqual(pool.run(len, "free again"), 10)
+
+    def test_password_pools_share_slots(self):
+        """Pools on the same slots directory (one per web worker) share
+        one limit
+        """
+
+        path = tempfile.mkdtemp()
+        pool = passwords.PasswordPool(workers=0, max_pending=1, path=path)
+        other = passwords.PasswordPool(workers=0, max_pending=1, path=path)
+
+        with self.assertRaises(passwords.PasswordHasherBusy):
+            pool.run(other.run, len, "other worker")
+
+        self.assertEqual(other.run(len, "free again"), 10)
 
     # def test_is_following(self):
     #     """Is u2 following u?"""
@@ -8,6 +8,8 @@
 import os
 from unittest import TestCase
 
+from sqlalchemy import update
+
 from models import db, connect_db, Message, User, Follows, Likes
 
 # BEFORE we import our app, let's set an environmental variable
@@ -20,6 +22,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import follow_graph
+import http_cache
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -30,6 +34,7 @@ db.create_all()
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['SQL_QUERY_BUDGET_STRICT'] = True
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
 
@@ -78,6 +83,29 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("<!--Flask Testing Comment 'index.html'-->", html)
 
+    def test_search_users(self):
+        """Does search rank the exact match first and skip non-matches?"""
+
+        db.session.add(User(email="test3@test.com", username="other",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get('/users', query_string={'q': 'testuser2'})
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('@testuser2', html)
+            self.assertNotIn('@testuser<', html)
+
+            resp = c.get('/users', query_string={'q': 'TESTUSER'})
+            html = resp.get_data(as_text=True)
+
+            self.assertLess(html.index('@testuser<'), html.index('@testuser2'))
+            self.assertNotIn('@other', html)
+
+            resp = c.get('/users', query_string={'q': '%'})
+            self.assertIn('Sorry, no users found', resp.get_data(as_text=True))
+
     def test_get_user_by_id(self):
         """Can we see list of users"""
 
@@ -91,6 +119,138 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("<!--Flask Testing Comment 'show.html'-->", html)
 
+    def test_user_messages_paginate(self):
+        """Does the profile page show one page of messages with a cursor
+        link to the next?"""
+
+        for i in range(60):
+            db.session.add(Message(text=f"msg-{i:02}", user_id=self.u_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+
+            resp = c.get(f'/users/{self.u_id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count('class="warbler-post"'), 50)
+            self.assertIn('Load more', html)
+
+            messages = (Message.query
+                        .order_by(Message.timestamp.desc(), Message.id.desc())
+                        .all())
+            cursor = f"{messages[49].timestamp.isoformat()}_{messages[49].id}"
+
+            resp = c.get(f'/users/{self.u_id}', query_string={'before': cursor})
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count('class="warbler-post"'), 10)
+            self.assertNotIn('Load more', html)
+
+            resp = c.get(f'/users/{self.u_id}', query_string={'before': 'junk'})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_user_page_conditional_get(self):
+        """Does an unchanged profile answer 304, and a changed one not?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+
+            resp = c.get(f'/users/{self.u2_id}')
+            etag = resp.headers['ETag']
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('no-cache', resp.headers['Cache-Control'])
+            self.assertIn('private', resp.headers['Cache-Control'])
+
+            resp = c.get(f'/users/{self.u2_id}',
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+
+            # Following them changes the button, and both users' versions.
+            c.post(f'/users/follow/{self.u2_id}')
+
+            resp = c.get(f'/users/{self.u2_id}',
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_profile_edit_after_another_workers_write(self):
+        """Does an edit bump the database's version, not the cached one?"""
+
+        User.signup("editor", "editor@test.com", "password", None)
+        db.session.commit()
+        editor_id = User.query.filter_by(username="editor").one().id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = editor_id
+
+            # Caches the editor's row in this worker.
+            c.get('/users/profile')
+            anonymous = app.test_client()
+            etag = anonymous.get(f'/users/{editor_id}').headers['ETag']
+
+            # Another worker likes something: version 1 -> 2.
+            db.session.execute(
+                update(User).where(User.id == editor_id)
+                .values(version=User.version + 1))
+            db.session.commit()
+
+            c.post('/users/profile', data={'username': 'editor',
+                                           'email': 'editor@test.com',
+                                           'bio': 'new bio',
+                                           'password': 'password'})
+
+        db.session.expire_all()
+        self.assertEqual(User.query.get(editor_id).version, 3)
+
+        resp = anonymous.get(f'/users/{editor_id}',
+                             headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('new bio', resp.get_data(as_text=True))
+
+    def test_viewer_version_is_not_cached(self):
+        """Does the viewer's own change, made by another worker, change
+        the ETag of a page they revalidate?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+
+            etag = c.get(f'/users/{self.u2_id}').headers['ETag']
+
+            db.session.execute(
+                update(User).where(User.id == self.u_id)
+                .values(version=User.version + 1))
+            db.session.commit()
+
+            resp = c.get(f'/users/{self.u2_id}',
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_static_caching(self):
+        """Are static files cacheable, and versioned ones immutable?"""
+
+        resp = self.client.get('/users')
+        self.assertIn('no-store', resp.headers['Cache-Control'])
+
+        resp = self.client.get('/static/stylesheets/style.css')
+        self.assertIn('max-age=3600', resp.headers['Cache-Control'])
+        resp.close()
+
+        with app.test_request_context():
+            url = http_cache.static_url('stylesheets/style.css')
+
+        self.assertIn('?v=', url)
+
+        resp = self.client.get(url)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        resp.close()
+
     def test_add_follow(self):
         """Can we follow a user"""
 
@@ -110,6 +270,45 @@ class UserViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
     
+    def test_follow_and_unfollow_twice(self):
+        """Does a repeated follow or unfollow (from a stale button) change
+        nothing, rather than fail?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+
+            for _ in range(2):
+                resp = c.post(f'/users/follow/{self.u2_id}')
+                self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(Follows.query.count(), 1)
+
+            for _ in range(2):
+                resp = c.post(f'/users/stop-following/{self.u2_id}')
+                self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(Follows.query.count(), 0)
+
+    def test_users_list_follow_buttons(self):
+        """Does /users show Unfollow for users we follow, after following?"""
+
+        follow_graph.graph.invalidate()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u_id
+
+            resp = c.get('/users')
+            self.assertNotIn(f'/users/stop-following/{self.u2_id}',
+                             resp.get_data(as_text=True))
+
+            c.post(f'/users/follow/{self.u2_id}')
+
+            resp = c.get('/users')
+            self.assertIn(f'/users/stop-following/{self.u2_id}',
+                          resp.get_data(as_text=True))
+
     def test_stop_following(self):
         """Can we stop following a user"""
 
@@ -0,0 +1,186 @@
+"""Write-behind tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_write_behind.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import follow_graph
+import search
+import write_behind
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class WriteBehindTestCase(TestCase):
+    """Test queued likes and follows."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        u = User(email="test@test.com", username="testuser",
+                 password="HASHED_PASSWORD")
+        u2 = User(email="test2@test.com", username="testuser2",
+                  password="HASHED_PASSWORD")
+        db.session.add_all([u, u2])
+        db.session.commit()
+
+        msg = Message(text="Like me", user_id=u2.id)
+        db.session.add(msg)
+        db.session.flush()
+        search.index_message(msg)
+        db.session.commit()
+
+        self.u_id = u.id
+        self.u2_id = u2.id
+        self.msg_id = msg.id
+
+        self.saved_config = {key: app.config.get(key) for key in
+                             ['WRITE_BEHIND', 'WRITE_BEHIND_INTERVAL']}
+        app.config.update(WRITE_BEHIND=True, WRITE_BEHIND_INTERVAL=0)
+
+        write_behind.queue.clear()
+        follow_graph.graph.invalidate()
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u_id
+
+    def tearDown(self):
+        app.config.update(self.saved_config)
+        write_behind.queue.clear()
+        follow_graph.graph.release(list(follow_graph.graph._overrides))
+        follow_graph.graph.invalidate()
+        db.session.rollback()
+
+    def flush(self):
+        with app.app_context():
+            return write_behind.flush()
+
+    def test_like_then_unlike_cancels_out(self):
+        self.client.post(f'/messages/{self.msg_id}/togglelike')
+        self.assertEqual(len(write_behind.queue), 1)
+
+        self.client.post(f'/messages/{self.msg_id}/togglelike')
+        self.assertEqual(len(write_behind.queue), 0)
+
+        self.assertEqual(self.flush(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_queued_like_is_shown_then_flushed(self):
+        self.client.post(f'/messages/{self.msg_id}/togglelike')
+
+        self.assertEqual(Likes.query.count(), 0)
+        html = self.client.get(f'/users/{self.u2_id}').get_data(as_text=True)
+        self.assertIn('fas fa-star', html)
+
+        self.assertEqual(self.flush(), 1)
+        db.session.expire_all()
+
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(User.query.get(self.u_id).likes_count, 1)
+        self.assertEqual(Message.query.get(self.msg_id).likes_count, 1)
+
+        resp = self.client.post(f'/api/v1/messages/{self.msg_id}/like',
+                                json={})
+        self.assertEqual(resp.json, {'liked': False, 'likes_count': 0})
+
+        self.flush()
+        db.session.expire_all()
+        self.assertEqual(Message.query.get(self.msg_id).likes_count, 0)
+
+    def test_queued_follow(self):
+        self.client.post(f'/users/follow/{self.u2_id}')
+
+        self.assertEqual(Follows.query.count(), 0)
+
+        with app.test_request_context():
+            self.assertTrue(
+                follow_graph.get_graph().is_following(self.u_id, self.u2_id))
+
+            # A reload from the database keeps the queued follow.
+            follow_graph.graph.invalidate()
+            self.assertTrue(
+                follow_graph.get_graph().is_following(self.u_id, self.u2_id))
+
+        self.assertEqual(self.flush(), 1)
+        db.session.expire_all()
+
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertEqual(User.query.get(self.u_id).following_count, 1)
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
+        self.assertEqual(follow_graph.graph._overrides, {})
+
+    def test_queued_follow_reads_your_own_writes(self):
+        resp = self.client.post(f'/users/follow/{self.u2_id}',
+                                follow_redirects=True)
+        html = resp.get_data(as_text=True)
+
+        # The redirect target lists them, with the counters moved.
+        self.assertIn('@testuser2', html)
+        self.assertIn(f'<a href="/users/{self.u_id}/following">1</a>', html)
+
+        html = self.client.get(f'/users/{self.u2_id}/followers').get_data(
+            as_text=True)
+        self.assertIn('@testuser', html)
+        self.assertIn(f'<a href="/users/{self.u2_id}/followers">1</a>', html)
+
+        html = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Like me', html)
+
+        self.client.post(f'/users/stop-following/{self.u2_id}')
+        self.flush()
+        self.client.post(f'/users/follow/{self.u2_id}')
+        self.flush()
+        self.client.post(f'/users/stop-following/{self.u2_id}')
+
+        html = self.client.get('/').get_data(as_text=True)
+        self.assertNotIn('Like me', html)
+
+        html = self.client.get(f'/users/{self.u_id}/following').get_data(
+            as_text=True)
+        self.assertNotIn('@testuser2', html)
+        self.assertIn(f'<a href="/users/{self.u_id}/following">0</a>', html)
+
+    def test_queued_follow_in_materialized_timeline(self):
+        app.config['TIMELINE_MATERIALIZED'] = True
+
+        try:
+            self.client.post(f'/users/follow/{self.u2_id}')
+            html = self.client.get('/').get_data(as_text=True)
+        finally:
+            app.config['TIMELINE_MATERIALIZED'] = False
+
+        self.assertIn('Like me', html)
+
+    def test_deleted_message_is_dropped(self):
+        self.client.post(f'/messages/{self.msg_id}/togglelike')
+
+        msg = Message.query.get(self.msg_id)
+        search.unindex_message(msg)
+        db.session.delete(msg)
+        db.session.commit()
+
+        self.assertEqual(self.flush(), 0)
+        self.assertEqual(len(write_behind.queue), 0)
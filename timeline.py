@@ -0,0 +1,258 @@
+"""Materialized home timelines for Warbler.
+
+When `TIMELINE_MATERIALIZED` is on, every new message is pushed
+(fanned out) into a `timeline_entries` row for its author and for each
+of the author's followers. The homepage then reads a user's timeline
+straight off the `(owner_id, timestamp, message_id)` index instead of
+rebuilding it from the follow graph on every hit.
+
+Pushing is too expensive for accounts with huge follower counts, so
+authors above `FANOUT_FOLLOWER_THRESHOLD` followers are never fanned out.
+Their recent messages are pulled at read time instead and k-way merged
+with the pushed entries.
+"""
+
+import heapq
+
+from flask import current_app
+from sqlalchemy import delete, exists, insert, literal, select, union_all
+from sqlalchemy.orm import joinedload
+
+import pagination
+from models import db, Follows, Message, TimelineEntry, User
+
+TIMELINE_COLUMNS = ['owner_id', 'message_id', 'author_id', 'timestamp']
+
+# How many of a newly followed user's messages to copy into the follower's
+# timeline. Older messages are still reachable from the user's profile.
+DEFAULT_BACKFILL_LIMIT = 800
+
+# Authors with more followers than this are pulled at read time.
+DEFAULT_FANOUT_FOLLOWER_THRESHOLD = 10000
+
+
+def is_enabled():
+    """Is the materialized timeline store turned on for this app?"""
+
+    return current_app.config.get('TIMELINE_MATERIALIZED', False)
+
+
+def fanout_threshold():
+    """Follower count above which an author is pulled instead of pushed."""
+
+    return current_app.config.get(
+        'FANOUT_FOLLOWER_THRESHOLD', DEFAULT_FANOUT_FOLLOWER_THRESHOLD)
+
+
+def is_high_fanout(user_id):
+    """Is `user_id` followed by too many users to push their messages?"""
+
+    followers_count = db.session.execute(
+        select(User.followers_count).where(User.id == user_id)).scalar()
+
+    return (followers_count or 0) > fanout_threshold()
+
+
+def high_fanout_followed_ids(user_id):
+    """Ids of the high-fan-out accounts that `user_id` follows."""
+
+    return [followed_id for (followed_id,) in db.session.execute(
+        select(Follows.user_being_followed_id)
+        .join(User, User.id == Follows.user_being_followed_id)
+        .where(Follows.user_following_id == user_id)
+        .where(User.followers_count > fanout_threshold(),
+               User.deleted_at.is_(None)))]
+
+
+def fan_out_message(msg):
+    """Push `msg` into the timelines of its author and the author's followers.
+
+    Runs as a single INSERT ... SELECT; the caller commits. Messages from
+    high-fan-out authors only go into the author's own timeline.
+    """
+
+    author = select(
+        literal(msg.user_id),
+        literal(msg.id),
+        literal(msg.user_id),
+        literal(msg.timestamp),
+    )
+
+    if is_high_fanout(msg.user_id):
+        db.session.execute(
+            insert(TimelineEntry).from_select(TIMELINE_COLUMNS, author))
+        return
+
+    followers = select(
+        Follows.user_following_id,
+        literal(msg.id),
+        literal(msg.user_id),
+        literal(msg.timestamp),
+    ).where(Follows.user_being_followed_id == msg.user_id)
+
+    db.session.execute(
+        insert(TimelineEntry).from_select(
+            TIMELINE_COLUMNS, union_all(followers, author)))
+
+
+def remove_message(message_id):
+    """Remove a deleted message from every timeline it was pushed to."""
+
+    db.session.execute(
+        delete(TimelineEntry).where(TimelineEntry.message_id == message_id))
+
+
+def backfill_follow(follower_id, followed_id, limit=None):
+    """Copy the most recent messages of `followed_id` into the timeline of
+    `follower_id` after a new follow.
+
+    High-fan-out accounts are skipped; they are pulled at read time.
+    """
+
+    if follower_id != followed_id and is_high_fanout(followed_id):
+        return
+
+    limit = limit or current_app.config.get(
+        'TIMELINE_BACKFILL_LIMIT', DEFAULT_BACKFILL_LIMIT)
+
+    already_there = (select(TimelineEntry.message_id)
+                     .where(TimelineEntry.owner_id == follower_id)
+                     .where(TimelineEntry.message_id == Message.id))
+
+    recent = (select(literal(follower_id),
+                     Message.id,
+                     Message.user_id,
+                     Message.timestamp)
+              .where(Message.user_id == followed_id)
+              .where(~exists(already_there))
+              .order_by(Message.timestamp.desc())
+              .limit(limit))
+
+    db.session.execute(
+        insert(TimelineEntry).from_select(TIMELINE_COLUMNS, recent))
+
+
+def prune_follow(follower_id, followed_id):
+    """Drop the messages of `followed_id` from the timeline of `follower_id`
+    after an unfollow.
+    """
+
+    db.session.execute(
+        delete(TimelineEntry)
+        .where(TimelineEntry.owner_id == follower_id)
+        .where(TimelineEntry.author_id == followed_id))
+
+
+def rebuild_timeline(user):
+    """Throw away and recreate `user`'s materialized timeline from the
+    follow graph. Used when turning the store on for existing data.
+    """
+
+    db.session.execute(
+        delete(TimelineEntry).where(TimelineEntry.owner_id == user.id))
+
+    backfill_follow(user.id, user.id)
+
+    for followed_user in user.following:
+        backfill_follow(user.id, followed_user.id)
+
+
+def pushed_stream(user_id, limit, cursor=None, except_from=()):
+    """(timestamp, message_id) pairs pushed into `user_id`'s timeline,
+    newest first, older than `cursor`, leaving out authors `except_from`
+    and authors who have deleted their account.
+    """
+
+    query = (select(TimelineEntry.timestamp, TimelineEntry.message_id)
+             .join(User, User.id == TimelineEntry.author_id)
+             .where(TimelineEntry.owner_id == user_id,
+                    User.deleted_at.is_(None)))
+
+    if except_from:
+        query = query.where(TimelineEntry.author_id.notin_(except_from))
+
+    return db.session.execute(
+        pagination.before(query,
+                          TimelineEntry.timestamp,
+                          TimelineEntry.message_id,
+                          cursor)
+        .limit(limit))
+
+
+def pulled_stream(author_id, limit, cursor=None):
+    """(timestamp, message_id) pairs of `author_id`'s own messages,
+    newest first, older than `cursor`.
+    """
+
+    query = (select(Message.timestamp, Message.id)
+             .where(Message.user_id == author_id))
+
+    return db.session.execute(
+        pagination.before(query, Message.timestamp, Message.id, cursor)
+        .limit(limit))
+
+
+def merge_streams(streams, limit):
+    """K-way merge newest-first (timestamp, message_id) streams into the
+    `limit` newest distinct message ids.
+
+    A message can show up in more than one stream (an author who crossed
+    the fan-out threshold still has pushed entries), so ids are deduped.
+    """
+
+    message_ids = []
+    seen = set()
+
+    for _, message_id in heapq.merge(*streams, key=tuple, reverse=True):
+        if message_id in seen:
+            continue
+
+        seen.add(message_id)
+        message_ids.append(message_id)
+
+        if len(message_ids) == limit:
+            break
+
+    return message_ids
+
+
+def home_timeline_ids(user_id, limit=100, cursor=None, also_from=(),
+                      except_from=()):
+    """Ids of the `limit` most recent messages in `user_id`'s timeline that
+    are older than `cursor`, newest first: pushed entries merged with
+    messages pulled from the high-fan-out accounts the user follows.
+
+    Messages of authors `also_from` are pulled too, and those of authors
+    `except_from` left out (follows and unfollows not written yet, see
+    write_behind.py).
+    """
+
+    pulled = [author_id for author_id in high_fanout_followed_ids(user_id)
+              if author_id not in except_from]
+    pulled.extend(author_id for author_id in also_from
+                  if author_id not in pulled)
+
+    streams = [pushed_stream(user_id, limit, cursor, except_from)]
+    streams.extend(pulled_stream(author_id, limit, cursor)
+                   for author_id in pulled)
+
+    return merge_streams(streams, limit)
+
+
+def home_timeline(user, limit=100, cursor=None, also_from=(),
+                  except_from=()):
+    """Return the `limit` most recent messages in `user`'s timeline that
+    are older than `cursor`, newest first (see `home_timeline_ids`).
+    """
+
+    message_ids = home_timeline_ids(user.id, limit, cursor, also_from,
+                                    except_from)
+
+    messages = (Message.query
+                .filter(Message.id.in_(message_ids))
+                .options(joinedload(Message.user))
+                .all())
+    by_id = {msg.id: msg for msg in messages}
+
+    return [by_id[message_id] for message_id in message_ids
+            if message_id in by_id]
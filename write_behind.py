@@ -0,0 +1,510 @@
+"""Write-behind batching for likes and follows.
+
+With `WRITE_BEHIND` on, like toggles and follows/unfollows don't commit
+their own transactions. They are queued in this worker, keyed by the
+(user, message) or (follower, followed) pair and holding only the state
+the pair should end up in, so a like and then an unlike cancel out and
+never reach the database.
+
+A background thread flushes the queue every `WRITE_BEHIND_INTERVAL`
+seconds, or as soon as it holds `WRITE_BEHIND_BATCH_SIZE` pairs, in one
+transaction: an INSERT ... ON CONFLICT DO NOTHING and a DELETE per table,
+and one executemany UPDATE per counter.
+
+Until a flush lands, this worker overlays its queued writes on what it
+reads: like stars (`liked_message_ids`), the follow graph, following
+and follower lists (`overlay_users`), user counters (`overlay_counters`),
+whose messages make up a home timeline (`home_authors`, and the
+`also_from`/`except_from` of the materialized timeline), and the viewer
+part of page validators. Other workers see them after the flush.
+A crash loses at most one interval of likes and follows; counters that
+drift (e.g. two workers flushing the same pair at once) are fixed by
+`flask repair-counters`.
+"""
+
+import atexit
+import logging
+import os
+from threading import Event, Lock, Thread
+
+from flask import current_app
+from sqlalchemy import and_, delete, exists, or_, select, tuple_
+from sqlalchemy.orm.attributes import set_committed_value
+
+import counters
+import follow_graph
+import metrics
+import timeline
+from models import (db, insert_ignoring_duplicates, Follows, Likes, Message,
+                    User)
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+def is_enabled():
+    """Are likes and follows queued for this app?"""
+
+    return current_app.config.get('WRITE_BEHIND', False)
+
+
+##############################################################################
+# The queue
+
+
+class WriteQueue:
+    """Pending ('like' | 'follow', a, b) -> wanted state, per worker."""
+
+    def __init__(self):
+        self._pending = {}
+        self._flushing = {}
+        self._user_writes = {}
+        self._lock = Lock()
+        self.wake = Event()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def state(self, key, stored):
+        """The state of `key` as this worker should show it, given the
+        `stored` state in the database.
+        """
+
+        with self._lock:
+            return self._pending.get(key, self._flushing.get(key, stored))
+
+    def set(self, key, wanted, stored):
+        """Queue `key` to end up `wanted`; returns False if that cancelled
+        out an earlier queued write instead.
+        """
+
+        with self._lock:
+            self._user_writes[key[1]] = self._user_writes.get(key[1], 0) + 1
+
+            if wanted == self._flushing.get(key, stored):
+                self._pending.pop(key, None)
+                return False
+
+            self._pending[key] = wanted
+            return True
+
+    def changes(self):
+        """{key: wanted} for every queued write that changes what is
+        stored (a pending write that undoes one being flushed doesn't).
+        """
+
+        with self._lock:
+            changes = dict(self._flushing)
+
+            for key, wanted in self._pending.items():
+                if key in self._flushing:
+                    del changes[key]
+                else:
+                    changes[key] = wanted
+
+            return changes
+
+    def user_writes(self, user_id):
+        """How many writes `user_id` has queued in this worker."""
+
+        return self._user_writes.get(user_id, 0)
+
+    def take(self):
+        """Start flushing everything queued so far."""
+
+        with self._lock:
+            self._flushing, self._pending = self._pending, {}
+            return dict(self._flushing)
+
+    def done(self, batch, landed):
+        """Finish a flush; if it failed, requeue what wasn't overwritten."""
+
+        with self._lock:
+            if not landed:
+                for key, wanted in batch.items():
+                    self._pending.setdefault(key, wanted)
+
+            self._flushing = {}
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+            self._flushing.clear()
+            self._user_writes.clear()
+
+
+queue = WriteQueue()
+
+
+##############################################################################
+# Queuing writes
+
+
+def _queue(key, wanted, stored):
+    if queue.set(key, wanted, stored) and len(queue) >= current_app.config.get(
+            'WRITE_BEHIND_BATCH_SIZE', DEFAULT_BATCH_SIZE):
+        queue.wake.set()
+
+    _start_flusher(current_app._get_current_object())
+
+
+def toggle_like(user_id, message_id):
+    """Queue a like toggle; returns (author_id, liked, likes_count) like
+    the direct toggles in actions.py, or just the author_id when the
+    message is missing (or its author deleted) or the user's own.
+    """
+
+    row = db.session.execute(
+        select(Message.user_id,
+               Message.likes_count,
+               exists().where(Likes.user_id == user_id,
+                              Likes.message_id == Message.id))
+        .join(User, User.id == Message.user_id)
+        .where(Message.id == message_id,
+               User.deleted_at.is_(None))).one_or_none()
+
+    if row is None:
+        return None, None, None
+
+    author_id, likes_count, stored = row
+
+    if author_id == user_id:
+        return author_id, None, None
+
+    key = ('like', user_id, message_id)
+    liked = not queue.state(key, stored)
+    _queue(key, liked, stored)
+
+    return author_id, liked, likes_count + (liked - stored)
+
+
+def set_follow(follower_id, followed_id, following):
+    """Queue `follower_id` following (or unfollowing) `followed_id`."""
+
+    stored = db.session.execute(
+        select(exists().where(
+            Follows.user_following_id == follower_id,
+            Follows.user_being_followed_id == followed_id))).scalar()
+
+    _queue(('follow', follower_id, followed_id), following, stored)
+
+    follow_graph.graph.override(follower_id, followed_id, following)
+
+
+def liked_message_ids(user, message_ids):
+    """`user.liked_message_ids`, with this worker's queued likes on top."""
+
+    return overlay_likes(user.id, message_ids,
+                         user.liked_message_ids(message_ids))
+
+
+def overlay_likes(user_id, message_ids, liked):
+    """Update `liked`, the stored likes of `user_id` among `message_ids`,
+    with this worker's queued likes; returns it.
+    """
+
+    if not queue.user_writes(user_id):
+        return liked
+
+    for message_id in message_ids:
+        if queue.state(('like', user_id, message_id), message_id in liked):
+            liked.add(message_id)
+        else:
+            liked.discard(message_id)
+
+    return liked
+
+
+def queued_follows(user_id):
+    """(followed, unfollowed): ids `user_id` has queued following or
+    unfollowing in this worker.
+    """
+
+    followed, unfollowed = [], []
+
+    if not queue.user_writes(user_id):
+        return followed, unfollowed
+
+    for (kind, follower_id, followed_id), following in queue.changes().items():
+        if kind == 'follow' and follower_id == user_id:
+            (followed if following else unfollowed).append(followed_id)
+
+    return followed, unfollowed
+
+
+def queued_followers(user_id):
+    """(followers, unfollowers): ids queued following or unfollowing
+    `user_id` in this worker.
+    """
+
+    followers, unfollowers = [], []
+
+    for (kind, follower_id, followed_id), following in queue.changes().items():
+        if kind == 'follow' and followed_id == user_id:
+            (followers if following else unfollowers).append(follower_id)
+
+    return followers, unfollowers
+
+
+def overlay_users(users, added_ids, removed_ids):
+    """`users` (a following or followers list) without `removed_ids` and
+    with the users `added_ids` on the end.
+    """
+
+    removed_ids = set(removed_ids)
+    users = [user for user in users if user.id not in removed_ids]
+    listed = {user.id for user in users}
+    added_ids = [id for id in added_ids if id not in listed]
+
+    if added_ids:
+        users.extend(User.query.filter(User.id.in_(added_ids))
+                     .order_by(User.id))
+
+    return users
+
+
+def overlay_following(user):
+    """Whom `user` follows, with this worker's queued follows on top."""
+
+    return overlay_users(user.following, *queued_follows(user.id))
+
+
+def overlay_followers(user):
+    """Who follows `user`, with this worker's queued follows on top."""
+
+    return overlay_users(user.followers, *queued_followers(user.id))
+
+
+# (kind, position of the user in the key) -> User counter
+QUEUED_COUNTERS = {
+    ('like', 1): 'likes_count',
+    ('follow', 1): 'following_count',
+    ('follow', 2): 'followers_count',
+}
+
+
+def overlay_counters(user):
+    """Add this worker's queued likes and follows to `user`'s counters,
+    for display only: they stay unchanged as far as the session (and so
+    the database) is concerned. Safe to call more than once.
+    """
+
+    if user is None or user.__dict__.get('_queued_counters'):
+        return user
+
+    user._queued_counters = True
+    changes = queue.changes()
+
+    if not changes:
+        return user
+
+    deltas = {}
+
+    for key, wanted in changes.items():
+        for position in (1, 2):
+            name = QUEUED_COUNTERS.get((key[0], position))
+
+            if name is not None and key[position] == user.id:
+                deltas[name] = deltas.get(name, 0) + (1 if wanted else -1)
+
+    for name, delta in deltas.items():
+        set_committed_value(user, name, getattr(user, name) + delta)
+
+    return user
+
+
+def home_authors(user_id, followed_ids):
+    """SQL criterion for messages in `user_id`'s home timeline: theirs
+    and those of `followed_ids` (a list or subquery), with this worker's
+    queued follows and unfollows on top. Authors who have deleted their
+    account drop out at once; their follows go later (see jobs.py).
+    """
+
+    followed, unfollowed = queued_follows(user_id)
+    followed_authors = select(User.id).where(User.id.in_(followed_ids),
+                                             User.deleted_at.is_(None))
+
+    criterion = or_(Message.user_id.in_(followed_authors),
+                    Message.user_id == user_id)
+
+    if followed:
+        criterion = or_(criterion, Message.user_id.in_(followed))
+
+    if unfollowed:
+        criterion = and_(criterion, Message.user_id.notin_(unfollowed))
+
+    return criterion
+
+
+##############################################################################
+# Flushing
+
+
+def _existing_ids(model, ids):
+    return set(db.session.execute(
+        select(model.id).where(model.id.in_(set(ids)))).scalars())
+
+
+def _apply(model, a_col, b_col, wanted_by_pair, a_model, b_model):
+    """Write `wanted_by_pair` {(a, b): wanted} into `model`; returns the
+    (added, removed) pairs that really changed. `a_model` and `b_model`
+    are what the columns point at; pairs whose user or message has been
+    deleted meanwhile are dropped.
+    """
+
+    a_ids = _existing_ids(a_model, [a for a, _ in wanted_by_pair])
+    b_ids = _existing_ids(b_model, [b for _, b in wanted_by_pair])
+    pairs = [(a, b) for a, b in wanted_by_pair if a in a_ids and b in b_ids]
+
+    if not pairs:
+        return [], []
+
+    stored = {tuple(row) for row in db.session.execute(
+        select(a_col, b_col).where(tuple_(a_col, b_col).in_(pairs)))}
+
+    added = [pair for pair in pairs
+             if wanted_by_pair[pair] and pair not in stored]
+    removed = [pair for pair in pairs
+               if not wanted_by_pair[pair] and pair in stored]
+
+    if added:
+        db.session.execute(
+            insert_ignoring_duplicates(model),
+            [{a_col.key: a, b_col.key: b} for a, b in added])
+
+    if removed:
+        db.session.execute(
+            delete(model).where(tuple_(a_col, b_col).in_(removed)))
+
+    return added, removed
+
+
+def _deltas(added, removed, index):
+    deltas = {}
+
+    for pairs, delta in [(added, 1), (removed, -1)]:
+        for pair in pairs:
+            deltas[pair[index]] = deltas.get(pair[index], 0) + delta
+
+    return deltas
+
+
+def _flush_likes(likes):
+    added, removed = _apply(Likes, Likes.user_id, Likes.message_id, likes,
+                            User, Message)
+
+    counters.bump_many(User, 'likes_count', _deltas(added, removed, 0))
+    counters.bump_many(Message, 'likes_count', _deltas(added, removed, 1))
+
+    return len(added) + len(removed)
+
+
+def _flush_follows(follows):
+    added, removed = _apply(Follows,
+                            Follows.user_following_id,
+                            Follows.user_being_followed_id,
+                            follows, User, User)
+
+    counters.bump_many(User, 'following_count', _deltas(added, removed, 0))
+    counters.bump_many(User, 'followers_count', _deltas(added, removed, 1))
+
+    if timeline.is_enabled():
+        for follower_id, followed_id in added:
+            timeline.backfill_follow(follower_id, followed_id)
+
+        for follower_id, followed_id in removed:
+            timeline.prune_follow(follower_id, followed_id)
+
+    return len(added) + len(removed)
+
+
+def flush():
+    """Write everything queued so far in one transaction; returns how
+    many rows changed.
+    """
+
+    batch = queue.take()
+
+    if not batch:
+        return 0
+
+    by_kind = {'like': {}, 'follow': {}}
+    for (kind, a, b), wanted in batch.items():
+        by_kind[kind][(a, b)] = wanted
+
+    landed = False
+
+    try:
+        changed = {}
+
+        if by_kind['like']:
+            changed['like'] = _flush_likes(by_kind['like'])
+
+        if by_kind['follow']:
+            changed['follow'] = _flush_follows(by_kind['follow'])
+
+        db.session.commit()
+        landed = True
+
+    except Exception:
+        db.session.rollback()
+        raise
+
+    finally:
+        queue.done(batch, landed)
+
+    follow_graph.graph.release(
+        pair for pair in by_kind['follow']
+        if queue.state(('follow',) + pair, None) is None)
+
+    for kind, rows in changed.items():
+        metrics.write_behind_rows.inc(rows, kind=kind)
+
+    return sum(changed.values())
+
+
+##############################################################################
+# Background flusher
+
+
+_flusher = {'pid': None}
+
+
+def _run_flusher(app):
+    interval = app.config.get('WRITE_BEHIND_INTERVAL', DEFAULT_INTERVAL)
+
+    while True:
+        queue.wake.wait(interval)
+        queue.wake.clear()
+
+        with app.app_context():
+            try:
+                flush()
+            except Exception:
+                logger.exception("write-behind flush failed; will retry")
+
+
+def _flush_at_exit(app):
+    with app.app_context():
+        flush()
+
+
+def _start_flusher(app):
+    """Start this process's flusher thread, once per (forked) worker.
+
+    With `WRITE_BEHIND_INTERVAL` set to 0 there is no thread; `flush()`
+    is left to the caller (tests).
+    """
+
+    if _flusher['pid'] == os.getpid():
+        return
+
+    if not app.config.get('WRITE_BEHIND_INTERVAL', DEFAULT_INTERVAL):
+        return
+
+    _flusher['pid'] = os.getpid()
+    Thread(target=_run_flusher, args=(app,), daemon=True,
+           name='write-behind').start()
+    atexit.register(_flush_at_exit, app)